@@ -1,9 +1,18 @@
 import asyncio
+import time
+
 import discord
 import discord.ext.commands
 
+from lib.stats import Samples
+
 
 class Client(discord.Client):
+    def __init__(self, *args, **kwargs):
+        super(Client, self).__init__(*args, **kwargs)
+        # How long each step of joining a voice channel took, in seconds.
+        self.join_timings = {phase: Samples() for phase in ('allocate', 'gateway', 'worker', 'total')}
+        self.failed_joins = 0
 
     ## This works for now but is not ideal. The shim works though.
     @asyncio.coroutine
@@ -19,10 +28,14 @@ class Client(discord.Client):
         if self.is_voice_connected(server):
             raise discord.ClientException('Already connected to a voice channel in this server')
 
-        proxy = yield from self.rpc_server.make_voice_client_proxy(str(server.region))
+        started_at = time.monotonic()
+        # Picking the worker is all done here, it only hears about the client once we have everything it needs.
+        proxy = self.rpc_server.make_voice_client_proxy(str(server.region))
         if not proxy:
             return None
 
+        allocated_at = time.monotonic()
+
         # log.info('attempting to join voice channel {0.name}'.format(channel))
 
         def session_id_found(data):
@@ -33,10 +46,19 @@ class Client(discord.Client):
         session_id_future = self.ws.wait_for('VOICE_STATE_UPDATE', session_id_found)
         voice_data_future = self.ws.wait_for('VOICE_SERVER_UPDATE', lambda d: True)
 
-        # request joining
-        yield from self.ws.voice_state(server.id, channel.id)
-        session_id_data = yield from asyncio.wait_for(session_id_future, timeout=10.0, loop=self.loop)
-        data = yield from asyncio.wait_for(voice_data_future, timeout=10.0, loop=self.loop)
+        # request joining, both updates are on their way at once, in whichever order.
+        try:
+            yield from self.ws.voice_state(server.id, channel.id)
+            session_id_data, data = yield from asyncio.wait_for(
+                asyncio.gather(session_id_future, voice_data_future, loop=self.loop), timeout=10.0, loop=self.loop
+            )
+
+        except Exception:
+            self.failed_joins += 1
+            proxy.release()
+            raise
+
+        gateway_done_at = time.monotonic()
 
         kwargs = {
             'user_id': self.user.id,
@@ -47,24 +69,36 @@ class Client(discord.Client):
             'main_ws': self.ws
         }
 
-        voice = yield from proxy(**kwargs)
-
         try:
-            yield from voice.connect()
+            # Sets up the client on the worker and connects it, in one round trip.
+            voice = yield from proxy(**kwargs)
 
         except Exception as e:
+            self.failed_joins += 1
 
             try:
-                yield from voice.disconnect()
+                yield from proxy.disconnect()
             except:
                 # we don't care if disconnect failed because connection failed
                 pass
 
             raise e # re-raise
 
+        finished_at = time.monotonic()
+        timings = self.join_timings
+        timings['allocate'].add(allocated_at - started_at)
+        timings['gateway'].add(gateway_done_at - allocated_at)
+        timings['worker'].add(finished_at - gateway_done_at)
+        timings['total'].add(finished_at - started_at)
+
         self.connection._add_voice_client(server.id, voice)
         return voice
 
+    def get_join_stats(self):
+        stats = {'%s_ms' % phase: samples.summary(scale=1000) for phase, samples in self.join_timings.items()}
+        stats['failed'] = self.failed_joins
+        return stats
+
 
 class Bot(discord.ext.commands.Bot, Client):
     pass
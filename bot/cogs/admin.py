@@ -5,6 +5,9 @@
 """
 from discord.ext import commands
 
+import player
+import player.ytdl
+
 
 def setup(bot):
     bot.add_cog(Admin(bot))
@@ -23,12 +26,53 @@ class Admin:
     async def cluster_info(self):
         parts = []
         for client in self.bot.rpc_server.clients_by_connection_id.values():
-            parts.append('- `%s`: %s/%s clients, acceptable regions: %s, %s ms' % (
+            parts.append('- `%s`: %s/%s clients, acceptable regions: %s, %s ms, clock offset %+d ms' % (
                 client.client_connection_id,  client.client_count, client.remote_info['max_clients'],
-                client.remote_info['acceptable_regions'], ', '.join(str(int(i * 1000)) for i in client._pings)
+                client.remote_info['acceptable_regions'], ', '.join(str(int(i * 1000)) for i in client._pings),
+                client.clock_offset * 1000
             ))
+            for region, measured in sorted(client.region_latency.items()):
+                parts.append('  - %s: %s ms, %.0f%% loss' % (region, measured['latency_ms'], measured['loss'] * 100))
 
         if not parts:
             parts.append('No connected clients')
 
         await self.bot.say('\n'.join(parts))
+
+    @admin.command()
+    async def worker_stats(self):
+        parts = []
+        for client in self.bot.rpc_server.clients_by_connection_id.values():
+            parts.append('- `%s`:' % client.client_connection_id)
+            for name, value in sorted(client.stats.items()):
+                parts.append('  - %s: `%s`' % (name, value))
+
+        if not parts:
+            parts.append('No connected clients')
+
+        await self.bot.say('\n'.join(parts))
+
+    async def _send_stats(self, title, stats):
+        lines = ['**%s**' % title]
+        lines.extend('- %s: `%s`' % (name, value) for name, value in sorted(stats.items()))
+        await self.bot.say('\n'.join(lines))
+
+    @admin.command()
+    async def syncer_stats(self):
+        await self._send_stats('Syncer', self.bot.syncer_scheduler.get_stats())
+
+    @admin.command()
+    async def extraction_stats(self):
+        await self._send_stats('Extraction', player.ytdl.get_stats())
+
+    @admin.command()
+    async def player_stats(self):
+        await self._send_stats('Player', player.get_stats())
+
+    @admin.command()
+    async def outbox_stats(self):
+        await self._send_stats('Outbox', self.bot.outbox.get_stats())
+
+    @admin.command()
+    async def join_stats(self):
+        await self._send_stats('Joins', self.bot.get_join_stats())
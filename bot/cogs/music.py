@@ -1,11 +1,13 @@
 """
     via discord.py - rapptz's code.
 """
+import itertools
+
 import discord
 from discord.ext import commands
 import player
 from lib.time_format import format_seconds_to_hhmmss
-from player.ytdl import extract_info
+from player.ytdl import extract_playlist, ExtractionError
 
 from syncer.voice_syncer import SyncerState
 
@@ -24,6 +26,11 @@ class Music:
     def __init__(self, bot):
         self.bot = bot
 
+    async def on_voice_state_update(self, before, after):
+        state = player.get_player_state(after.server)
+        if state:
+            state.handle_voice_state_update()
+
     @commands.command(pass_context=True, no_pm=True)
     async def summon(self, ctx):
         """Summons the bot to join your voice channel."""
@@ -47,18 +54,50 @@ class Music:
                 return
 
         state.channel = ctx.message.channel
-        info = await extract_info(self.bot.loop, song, ytdl_options={
-            'default_search': 'auto',
-            'quiet': True,
-        })
-        await self.bot.say('Playing %s %s' % (info.title, info.duration))
-        state.syncer.play(info.download_url)
+        try:
+            playlist = await extract_playlist(self.bot.loop, song, ytdl_options=state.playlist.ytdl_options)
+
+        except ExtractionError as e:
+            await self.bot.say('Could not play that: %s' % e)
+            return
+
+        if playlist.next_page:
+            await self.bot.say('Queued the first %s tracks, the rest are on their way' % len(playlist))
+        elif state.playlist.current is not None or len(playlist) > 1:
+            await self.bot.say('Queued %s tracks' % len(playlist) if len(playlist) > 1 else 'Queued %s' % song)
+
+        state.playlist.enqueue(playlist)
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def skip(self, ctx):
+        """Skips to the next track in the queue."""
+        state = player.get_player_state(ctx.message.server)
+        if state:
+            state.playlist.skip()
+
+    @commands.command(pass_context=True, no_pm=True)
+    async def queue(self, ctx):
+        """Shows what's coming up next."""
+        state = player.get_player_state(ctx.message.server)
+        if not state or not len(state.playlist.queue):
+            await self.bot.say('The queue is empty.')
+            return
+
+        lines = []
+        for i, track in enumerate(itertools.islice(state.playlist.queue, 10), 1):
+            lines.append('%s. %s' % (i, track.info.title if track.info else track.title or track.url))
+
+        if len(state.playlist.queue) > 10:
+            lines.append('...and %s more' % (len(state.playlist.queue) - 10))
+
+        await self.bot.say('\n'.join(lines))
 
     @commands.command(pass_context=True, no_pm=True)
     async def stop(self, ctx):
         state = player.get_player_state(ctx.message.server)
         if state:
-            state.syncer.stop()\
+            state.playlist.clear()
+            state.syncer.stop()
 
     @commands.command(pass_context=True, no_pm=True)
     async def progress(self, ctx):
@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import traceback
+
+from lib.rate_limit import RateLimit
+
+
+class ChannelQueue(object):
+    __slots__ = ('channel', 'messages', 'rate_limit', 'task')
+
+    def __init__(self, channel, rate_limit):
+        self.channel = channel
+        # (key, message) pairs, oldest first.
+        self.messages = collections.deque()
+        self.rate_limit = rate_limit
+        self.task = None
+
+
+class MessageOutbox(object):
+    """
+    Sends the bot's own messages (as opposed to command replies) to text channels, one queue per channel.
+
+    Messages that arrive within `coalesce_delay` of each other, or while the channel is waiting on its rate limit,
+    go out together as one message. A message sent with a key replaces one with the same key that's still queued,
+    so status updates that have been superseded are never sent. Each channel gets at most `channel_rate` messages
+    per `channel_per` seconds, and the bot `global_rate` per `global_per` seconds, which keeps us under Discord's
+    limits rather than finding out from a 429. A channel never has more than `max_queued` messages waiting, the
+    oldest are dropped first.
+    """
+
+    max_message_length = 2000
+
+    def __init__(self, loop, send_message, coalesce_delay=0.5, channel_rate=5, channel_per=5, global_rate=40,
+                 global_per=1, max_queued=20):
+        self.loop = loop
+        self.send_message = send_message
+        self.coalesce_delay = coalesce_delay
+        self.channel_rate = channel_rate
+        self.channel_per = channel_per
+        self.max_queued = max_queued
+        self.global_rate_limit = RateLimit(global_rate, global_per, clock=loop.time)
+
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queues = {}
+
+    def send(self, channel, message, key=None):
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            queue = self._queues[channel.id] = ChannelQueue(
+                channel, RateLimit(self.channel_rate, self.channel_per, clock=self.loop.time)
+            )
+
+        messages = queue.messages
+        if key is not None:
+            for queued in messages:
+                if queued[0] == key:
+                    messages.remove(queued)
+                    self.superseded += 1
+                    break
+
+        messages.append((key, message))
+        self.queued += 1
+        if len(messages) > self.max_queued:
+            messages.popleft()
+            self.dropped += 1
+
+        if queue.task is None:
+            queue.task = self.loop.create_task(self._flush(queue))
+
+    def _take(self, messages):
+        """As many of the oldest messages as fit in one, joined together."""
+        parts = []
+        length = 0
+        while messages:
+            message = messages[0][1]
+            if parts and length + 1 + len(message) > self.max_message_length:
+                break
+
+            messages.popleft()
+            parts.append(message)
+            length += len(message) + (1 if length else 0)
+
+        self.coalesced += len(parts) - 1
+        return '\n'.join(parts)[:self.max_message_length]
+
+    async def _flush(self, queue):
+        try:
+            await asyncio.sleep(self.coalesce_delay)
+            while queue.messages:
+                # Whatever else arrives for this channel meanwhile goes out with it.
+                for rate_limit in (queue.rate_limit, self.global_rate_limit):
+                    delay = rate_limit.reserve()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                message = self._take(queue.messages)
+                try:
+                    await self.send_message(queue.channel, message)
+                    self.sent += 1
+
+                except asyncio.CancelledError:
+                    raise
+
+                except Exception:
+                    self.errors += 1
+                    traceback.print_exc()
+
+        finally:
+            queue.task = None
+            # The rate limit has to outlast the queue's last message, or the next one could skip it.
+            self.loop.call_later(self.channel_per, self._discard, queue)
+
+    def _discard(self, queue):
+        if not queue.messages and queue.task is None and self._queues.get(queue.channel.id) is queue:
+            del self._queues[queue.channel.id]
+
+    def depth(self, channel):
+        queue = self._queues.get(channel.id)
+        return len(queue.messages) if queue else 0
+
+    def get_stats(self):
+        depths = [len(queue.messages) for queue in self._queues.values()]
+        return {
+            'channels': len(depths),
+            'waiting': sum(depths),
+            'max_depth': max(depths) if depths else 0,
+            'queued': self.queued,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'superseded': self.superseded,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
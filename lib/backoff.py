@@ -0,0 +1,22 @@
+import random
+
+
+class Backoff(object):
+    """
+    Exponential backoff with full jitter: each delay is picked uniformly between zero and an exponentially
+    growing cap, so that many callers failing at the same moment don't all retry at the same moment.
+    """
+
+    def __init__(self, base=1.0, maximum=30.0, factor=2.0):
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def delay(self):
+        cap = min(self.maximum, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, cap)
+
+    def reset(self):
+        self.attempts = 0
@@ -1,43 +1,142 @@
 import asyncio
-import traceback
 import collections
+import traceback
+import weakref
+
+
+class Subscription(object):
+    """
+    One listener for one event. Whether the callback is a coroutine function is worked out once, here, rather than
+    on every emit. A weak subscription only holds a weak reference to its callback (or to the object a bound
+    method is bound to), and goes away once that's collected.
+    """
+    __slots__ = ('emitter', 'event', 'func', 'target', 'is_coroutine', 'once')
+
+    def __init__(self, emitter, event, callback, once=False, weak=False):
+        self.emitter = emitter
+        self.event = event
+        self.is_coroutine = asyncio.iscoroutinefunction(callback)
+        self.once = once
+
+        if not weak:
+            self.func = callback
+            self.target = None
+        elif hasattr(callback, '__self__') and hasattr(callback, '__func__'):
+            # A bound method only lives as long as we hold on to it, so we hold on to its parts instead.
+            self.func = callback.__func__
+            self.target = weakref.ref(callback.__self__)
+        else:
+            self.func = None
+            self.target = weakref.ref(callback)
+
+    def resolve(self):
+        """The callback, or None if it was weakly held and has been collected."""
+        if self.target is None:
+            return self.func
+
+        target = self.target()
+        if target is None or self.func is None:
+            return target
+
+        return self.func.__get__(target)
+
+    def cancel(self):
+        self.emitter._remove(self)
+
+
+class SubscriptionScope(object):
+    """Subscriptions made through a scope are all removed together when it's closed."""
+    __slots__ = ('emitter', 'weak', '_subscriptions')
+
+    def __init__(self, emitter, weak=False):
+        self.emitter = emitter
+        self.weak = weak
+        self._subscriptions = []
+
+    def on(self, event, cb):
+        subscription = self.emitter.on(event, cb, weak=self.weak)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def once(self, event, cb):
+        subscription = self.emitter.once(event, cb, weak=self.weak)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def close(self):
+        subscriptions, self._subscriptions = self._subscriptions, []
+        for subscription in subscriptions:
+            subscription.cancel()
 
 
 class EventEmitter:
     def __init__(self):
-        self._events = collections.defaultdict(list)
+        # Each event's listeners are a tuple that's replaced whenever they change, so emitting never has to copy it.
+        self._events = {}
+        self.emit_counts = collections.Counter()
         self.loop = asyncio.get_event_loop()
 
     def emit(self, event, *args, **kwargs):
-        if event not in self._events:
+        self.emit_counts[event] += 1
+        subscriptions = self._events.get(event)
+        if not subscriptions:
             return
 
-        for cb in list(self._events[event]):
+        for subscription in subscriptions:
+            func = subscription.func
+            target = subscription.target
+            if target is not None:
+                target = target()
+                if target is None:
+                    # Collected, weak subscriptions are dropped the first time that's noticed.
+                    subscription.cancel()
+                    continue
+
+                if func is None:
+                    func, target = target, None
+
+            if subscription.once:
+                subscription.cancel()
+
             # noinspection PyBroadException
             try:
-                if asyncio.iscoroutinefunction(cb):
-                    asyncio.ensure_future(cb(*args, **kwargs), loop=self.loop)
-                else:
-                    cb(*args, **kwargs)
+                result = func(*args, **kwargs) if target is None else func(target, *args, **kwargs)
+                if subscription.is_coroutine:
+                    asyncio.ensure_future(result, loop=self.loop)
 
             except:
                 traceback.print_exc()
 
-    def on(self, event, cb):
-        self._events[event].append(cb)
-        return self
+    def on(self, event, cb, weak=False):
+        """Adds a listener, returning the Subscription, which can be cancelled to remove it again."""
+        return self._add(Subscription(self, event, cb, weak=weak))
+
+    def once(self, event, cb, weak=False):
+        return self._add(Subscription(self, event, cb, once=True, weak=weak))
 
     def off(self, event, cb):
-        self._events[event].remove(cb)
+        for subscription in self._events.get(event, ()):
+            if subscription.resolve() == cb:
+                self._remove(subscription)
+                return self
 
-        if not self._events[event]:
-            del self._events[event]
+        raise ValueError('%r is not listening to %s' % (cb, event))
 
-        return self
+    def scope(self, weak=False):
+        """A SubscriptionScope on this emitter, to subscribe to several events and later drop them all at once."""
+        return SubscriptionScope(self, weak=weak)
 
-    def once(self, event, cb):
-        def callback(*args, **kwargs):
-            self.off(event, callback)
-            return cb(*args, **kwargs)
+    def _add(self, subscription):
+        self._events[subscription.event] = self._events.get(subscription.event, ()) + (subscription,)
+        return subscription
+
+    def _remove(self, subscription):
+        subscriptions = self._events.get(subscription.event)
+        if not subscriptions or subscription not in subscriptions:
+            return
 
-        return self.on(event, callback)
+        subscriptions = tuple(s for s in subscriptions if s is not subscription)
+        if subscriptions:
+            self._events[subscription.event] = subscriptions
+        else:
+            del self._events[subscription.event]
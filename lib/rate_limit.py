@@ -0,0 +1,22 @@
+import collections
+import time
+
+
+class RateLimit(object):
+    """At most `count` events in any `per` seconds, over a sliding window."""
+
+    def __init__(self, count, per, clock=time.monotonic):
+        self.count = count
+        self.per = per
+        self.clock = clock
+        self._times = collections.deque(maxlen=count)
+
+    def reserve(self):
+        """Takes the next slot, returning how long to wait until it's ours."""
+        now = self.clock()
+        at = now
+        if len(self._times) == self.count:
+            at = max(now, self._times[0] + self.per)
+
+        self._times.append(at)
+        return at - now
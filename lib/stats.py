@@ -0,0 +1,33 @@
+from collections import deque
+
+
+class Samples(object):
+    """A bounded window of recent measurements, used for reporting timings."""
+
+    def __init__(self, maxlen=100):
+        self._values = deque(maxlen=maxlen)
+
+    def add(self, value):
+        self._values.append(value)
+
+    def __len__(self):
+        return len(self._values)
+
+    def percentile(self, p):
+        if not self._values:
+            return None
+
+        values = sorted(self._values)
+        index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+        return values[index]
+
+    def summary(self, scale=1.0):
+        if not self._values:
+            return {'count': 0}
+
+        return {
+            'count': len(self._values),
+            'p50': self.percentile(50) * scale,
+            'p95': self.percentile(95) * scale,
+            'max': max(self._values) * scale,
+        }
@@ -1,48 +1,541 @@
-from syncer.voice_syncer import VoiceStateSyncer
+import asyncio
+import collections
+import itertools
+import time
+import traceback
+
+from player.ytdl import extract_info, is_expired, download_url_expiry, ExtractionError
+from syncer.voice_syncer import VoiceStateSyncer, SyncerState
+
+
+class QueuedTrack(object):
+    __slots__ = ('url', 'title', 'info', 'resolving', 'failed')
+
+    def __init__(self, url, title=None, info=None):
+        self.url = url
+        self.title = title
+        self.info = info
+        self.resolving = None
+        self.failed = False
+
+    @property
+    def is_ready(self):
+        return self.info is not None and not is_expired(self.info)
+
+
+class TrackQueue(object):
+    """
+    The tracks waiting to be played, of which the first `lookahead` are kept resolved, with download urls that
+    haven't expired, so that moving on to the next one never waits on an extraction.
+    """
+
+    def __init__(self, loop, ytdl_options=None, lookahead=3, on_resolved=None):
+        self.loop = loop
+        self.ytdl_options = ytdl_options
+        self.lookahead = lookahead
+        self.on_resolved = on_resolved
+        self._tracks = collections.deque()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __iter__(self):
+        return iter(self._tracks)
+
+    def extend(self, playlist):
+        entries = iter(playlist.entries)
+        if playlist.first is not None:
+            url, title = next(entries)
+            self._tracks.append(QueuedTrack(url, title, playlist.first))
+
+        self._tracks.extend(QueuedTrack(url, title) for url, title in entries)
+        self.resolve_ahead()
+
+    def peek(self):
+        return self._tracks[0] if self._tracks else None
+
+    def pop(self):
+        track = self._tracks.popleft() if self._tracks else None
+        self.resolve_ahead()
+        return track
+
+    def clear(self):
+        for track in self._tracks:
+            if track.resolving:
+                track.resolving.cancel()
+
+        self._tracks.clear()
+
+    def resolve_ahead(self):
+        for track in itertools.islice(self._tracks, self.lookahead):
+            if not track.is_ready and not track.resolving and not track.failed:
+                track.resolving = self.loop.create_task(self._resolve(track))
+
+    async def resolve(self, track):
+        """Waits for the track to be resolved, returning whether it was."""
+        if not track.is_ready and not track.resolving and not track.failed:
+            track.resolving = self.loop.create_task(self._resolve(track))
+
+        if track.resolving:
+            await asyncio.shield(track.resolving)
+
+        return track.is_ready
+
+    async def _resolve(self, track):
+        try:
+            track.info = await extract_info(self.loop, track.url, ytdl_options=self.ytdl_options)
+
+        except ExtractionError:
+            # Unplayable tracks are skipped when we get to them.
+            traceback.print_exc()
+            track.info = None
+            track.failed = True
+
+        finally:
+            track.resolving = None
+
+        if track.info is not None and self.on_resolved:
+            self.on_resolved(track)
 
 
 class Playlist(object):
+    __slots__ = (
+        'player_state', 'syncer', 'queue', 'current', '_preloaded', '_advance_task', '_refresh_handle', '_retries',
+        '_loading_task', '_waiting', '_client_listeners', '__weakref__'
+    )
+
+    lookahead = 3
+    # Download urls of what's playing and what's preloaded are replaced this long before they expire, so a worker
+    # taking over is never handed a dead one.
+    refresh_ahead = 300
+    refresh_retry_delay = 60
+    # How many times a track that fails to start is re-resolved and tried again, before we give up on it.
+    max_play_retries = 2
+    ytdl_options = {
+        'default_search': 'auto',
+        'quiet': True,
+    }
+
     def __init__(self, player_state):
         self.player_state = player_state
         self.syncer = player_state.syncer
         self.syncer.on('client:connected', self._handle_client_connected)
+        self.queue = TrackQueue(
+            player_state.bot.loop, self.ytdl_options, lookahead=self.lookahead, on_resolved=self._handle_track_resolved
+        )
+        self.current = None
+        self._preloaded = None
+        self._advance_task = None
+        self._refresh_handle = None
+        self._retries = 0
+        # Fetches the next page of a playlist that's still loading, and what was enqueued since, which goes after it.
+        self._loading_task = None
+        self._waiting = collections.deque()
+        # Our listeners on the current voice client, which go when it does.
+        self._client_listeners = None
+
+    def enqueue(self, playlist):
+        """Adds the tracks of an ExtractedPlaylist to the end of the queue, starting them if nothing is playing."""
+        if self._loading_task:
+            self._waiting.append(playlist)
+            return
+
+        self.queue.extend(playlist)
+        if self.current is None:
+            self._advance()
+        else:
+            self._preload_next()
+
+        if playlist.next_page:
+            self._loading_task = self.player_state.bot.loop.create_task(self._load_next_page(playlist))
+
+    async def _load_next_page(self, playlist):
+        try:
+            playlist = await playlist.next_page()
+
+        except ExtractionError:
+            # What we have of it stays queued.
+            traceback.print_exc()
+            playlist = None
+
+        self._loading_task = None
+        if playlist is not None:
+            self.enqueue(playlist)
+
+        while self._waiting and not self._loading_task:
+            self.enqueue(self._waiting.popleft())
+
+    def skip(self):
+        self._advance()
+
+    @property
+    def is_idle(self):
+        """Nothing is playing, queued, or about to start."""
+        return self.current is None and not self.queue and self._advance_task is None and self._loading_task is None
+
+    def close(self):
+        self.clear()
+        self._remove_client_listeners()
+        self.syncer.off('client:connected', self._handle_client_connected)
+
+    def clear(self):
+        if self._advance_task:
+            self._advance_task.cancel()
+            self._advance_task = None
+
+        if self._loading_task:
+            self._loading_task.cancel()
+            self._loading_task = None
+
+        self._waiting.clear()
+        self._cancel_refresh()
+        self.queue.clear()
+        self.current = None
+        self._set_preloaded(None)
+
+    def resume(self, source_url, progress):
+        """Resolves the source url again and carries on playing it from `progress`, like after a restart."""
+        track = QueuedTrack(source_url)
+        self.current = track
+        self.player_state.bot.loop.create_task(self._resume(track, progress))
+
+    async def _resume(self, track, progress):
+        started_at = time.time()
+        resolved = await self.queue.resolve(track)
+        if track is not self.current:
+            return
+
+        if not resolved:
+            self.current = None
+            self.player_state.say('Could not pick %s back up' % track.url)
+            self._advance()
+            return
+
+        self._start_track(track, progress + time.time() - started_at)
+
+    def _advance(self):
+        if self._advance_task:
+            return
+
+        self._advance_task = self.player_state.bot.loop.create_task(self._play_next())
+
+    async def _play_next(self):
+        try:
+            while True:
+                track = self.queue.pop()
+                if track is None:
+                    if self.current is not None:
+                        self.current = None
+                        self.syncer.stop()
+                    self._set_preloaded(None)
+                    return
+
+                if await self.queue.resolve(track):
+                    break
+
+                self.player_state.say('Skipping %s, it could not be played' % (track.title or track.url))
+
+        finally:
+            # Unless we were cancelled, and another has already taken our place.
+            if self._advance_task is asyncio.Task.current_task(loop=self.player_state.bot.loop):
+                self._advance_task = None
+
+        self.player_state.say('Playing %s %s' % (track.info.title, track.info.duration), key='playing')
+        self._start_track(track)
+
+    def _start_track(self, track, progress=0):
+        self.current = track
+        self._retries = 0
+        info = track.info
+        self.syncer.play(
+            info.download_url, source_key=info.source_key, progress=progress, codec=info.codec, is_live=info.is_live
+        )
+        self._preload_next()
+        self._schedule_refresh()
+
+    def _cancel_refresh(self):
+        if self._refresh_handle:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+
+    def _schedule_refresh(self, delay=None, min_delay=0):
+        self._cancel_refresh()
+        if delay is None:
+            expiries = [
+                download_url_expiry(track.info.download_url)
+                for track in (self.current, self._preloaded) if track is not None and track.info is not None
+            ]
+            expiries = [expiry for expiry in expiries if expiry is not None]
+            if not expiries:
+                return
+
+            delay = max(min_delay, min(expiries) - self.refresh_ahead - time.time())
+
+        loop = self.player_state.bot.loop
+        self._refresh_handle = loop.call_later(delay, lambda: loop.create_task(self._refresh()))
+
+    def _re_resolve(self, track):
+        # Skips the cache, which would hand us back the same download url.
+        return extract_info(self.player_state.bot.loop, track.url, ytdl_options=self.ytdl_options, refresh=True)
+
+    def _expires_soon(self, track):
+        if track is None or track.info is None:
+            return False
+
+        expiry = download_url_expiry(track.info.download_url)
+        return expiry is not None and expiry - self.refresh_ahead <= time.time()
+
+    async def _refresh(self):
+        self._refresh_handle = None
+        try:
+            track = self.current
+            if self._expires_soon(track):
+                info = await self._re_resolve(track)
+                if track is self.current:
+                    old_url, track.info = track.info.download_url, info
+                    self.syncer.refresh_url(old_url, info.download_url)
+
+            track = self._preloaded
+            if self._expires_soon(track):
+                track.info = await self._re_resolve(track)
+                if track is self._preloaded:
+                    self._preloaded = None
+                    self._preload_next()
+
+        except ExtractionError:
+            traceback.print_exc()
+            self._schedule_refresh(self.refresh_retry_delay)
+            return
+
+        # Some sources hand out urls that never last long, which mustn't turn into back to back extractions.
+        self._schedule_refresh(min_delay=self.refresh_retry_delay)
+
+    def _set_preloaded(self, track):
+        if track is self._preloaded:
+            return
+
+        self._preloaded = track
+        if track is None:
+            self.syncer.preload(None)
+        else:
+            info = track.info
+            self.syncer.preload(info.download_url, source_key=info.source_key, codec=info.codec, is_live=info.is_live)
+            self._schedule_refresh()
+
+    def _preload_next(self):
+        track = self.queue.peek()
+        if track is not None and not track.is_ready:
+            # It gets preloaded once it has been resolved.
+            self.queue.resolve_ahead()
+            track = None
+
+        self._set_preloaded(track)
+
+    def _handle_track_resolved(self, track):
+        if track is self.queue.peek() and self.current is not None:
+            self._preloaded = None
+            self._preload_next()
+
+    def _handle_playback_advanced(self, previous_ref, playback_ref, download_url):
+        # The worker moved on to the track we preloaded without waiting for us, so catch up with it.
+        track = self._preloaded
+        if track is None or track is not self.queue.peek() or track.info.download_url != download_url:
+            return
+
+        self.queue.pop()
+        self._preloaded = None
+        self.current = track
+        self._retries = 0
+        self.player_state.say('Playing %s %s' % (track.info.title, track.info.duration), key='playing')
+        self._preload_next()
+        self._schedule_refresh()
+
+    def _handle_playback_error(self, playback_ref, position=0, reason=None):
+        print("playback error", playback_ref, reason)
+        if playback_ref != self.syncer.playback_ref:
+            return
+
+        track = self.current
+        self._retries += 1
+        if track is None or self._retries > self.max_play_retries:
+            if track is not None:
+                self.player_state.say('Skipping %s, it stopped playing: %s' % (track.info.title, reason))
+
+            self._advance()
+            return
+
+        self.player_state.bot.loop.create_task(self._retry(track, position))
+
+    async def _retry(self, track, position):
+        # Most likely the download url expired, so we get a new one and carry on from the same spot.
+        try:
+            info = await self._re_resolve(track)
+        except ExtractionError:
+            traceback.print_exc()
+            info = None
+
+        if track is not self.current:
+            return
+
+        if info is None:
+            self.player_state.say('Skipping %s, it could not be played' % (track.title or track.url))
+            self._advance()
+            return
+
+        track.info = info
+        self.syncer.play(
+            info.download_url, source_key=info.source_key, progress=position, codec=info.codec, is_live=info.is_live
+        )
+        self._schedule_refresh()
+
+    def _remove_client_listeners(self):
+        if self._client_listeners:
+            self._client_listeners.close()
+            self._client_listeners = None
 
     def _handle_client_connected(self, remote_client):
         # We should never capture the client here. All interaction with the client will be done via the syncer.
-        remote_client.on('playback:start', self._handle_playback_start)
-        remote_client.on('playback:done', self._handle_playback_done)
-        remote_client.on('playback:progress', self._handle_playback_progress)
-        remote_client.once('remote:down', self._handle_remote_down)
+        # Weakly, so a client that outlives its connection can't keep us around either.
+        self._remove_client_listeners()
+        listeners = self._client_listeners = remote_client.scope(weak=True)
+        listeners.on('playback:start', self._handle_playback_start)
+        listeners.on('playback:done', self._handle_playback_done)
+        listeners.on('playback:advanced', self._handle_playback_advanced)
+        listeners.on('playback:error', self._handle_playback_error)
+        listeners.on('playback:progress', self._handle_playback_progress)
+        listeners.once('remote:down', self._handle_remote_down)
 
-        self.player_state.say('Voice client connected %r' % remote_client)
+        self.player_state.say('Voice client connected %r' % remote_client, key='client')
 
     def _handle_playback_start(self, playback_ref):
         print("playback start", playback_ref)
-        self.player_state.say('Voice client playback start %r' % playback_ref)
+        self.player_state.say('Voice client playback start %r' % playback_ref, key='playback')
 
-    def _handle_playback_done(self, playback_ref):
+    def _handle_playback_done(self, playback_ref, finished=False):
         print("playback stop", playback_ref)
-        self.player_state.say('Voice client playback stop %r' % playback_ref)
+        self.player_state.say('Voice client playback stop %r' % playback_ref, key='playback')
+        # Anything else is a track we replaced or stopped ourselves.
+        if finished and playback_ref == self.syncer.playback_ref:
+            self._advance()
 
     def _handle_remote_down(self, reason=None):
-        self.player_state.say('Remote client split, reason: %s' % reason)
+        self._remove_client_listeners()
+        self.player_state.say('Remote client split, reason: %s' % reason, key='client')
 
-    def _handle_playback_progress(self, playback_ref, progress):
+    def _handle_playback_progress(self, playback_ref, playback_progress, timestamp=None):
         pass
 
 
 class PlayerState(object):
+    __slots__ = ('bot', 'syncer', 'playlist', 'channel', 'idle_since', '_suspend_handle')
+
+    # How long the voice channel has to be without listeners before we stop streaming to it.
+    empty_channel_timeout = 60
+
     def __init__(self, bot):
         self.bot = bot
-        self.syncer = VoiceStateSyncer(self).start()
+        self.syncer = VoiceStateSyncer(self)
         self.playlist = Playlist(self)
         self.channel = None
+        # When the eviction sweep first found us with nothing to do.
+        self.idle_since = None
+        self._suspend_handle = None
 
-    def say(self, message):
+    def say(self, message, key=None):
+        """
+        Posts to the text channel we were summoned from. A message with a key replaces any with the same key that
+        haven't gone out yet.
+        """
         if self.channel:
-            self.bot.loop.create_task(self.bot.send_message(self.channel, message))
+            self.bot.outbox.send(self.channel, message, key=key)
+
+    def has_listeners(self):
+        channel = self.syncer.state.get('channel')
+        if channel is None:
+            return False
+
+        channel = self.bot.get_channel(channel.id) or channel
+        for member in channel.voice_members:
+            if member.bot or member.id == self.bot.user.id:
+                continue
+
+            if not (member.deaf or member.self_deaf):
+                return True
+
+        return False
+
+    def handle_voice_state_update(self):
+        if self.syncer.fsm_state == SyncerState.DISCONNECTED or self.has_listeners():
+            if self._suspend_handle:
+                self._suspend_handle.cancel()
+                self._suspend_handle = None
+
+            if self.syncer.suspended:
+                self.syncer.unsuspend()
+
+        elif not self._suspend_handle and not self.syncer.suspended:
+            self._suspend_handle = self.bot.loop.call_later(self.empty_channel_timeout, self._suspend)
+
+    def _suspend(self):
+        self._suspend_handle = None
+        if not self.has_listeners():
+            self.syncer.suspend()
+
+    def is_idle(self):
+        if self.syncer.fsm_state == SyncerState.HALT:
+            return True
+
+        return self.playlist.is_idle and not self.syncer.state.get('playing_url')
+
+    def close(self):
+        """Stops everything this guild has going, leaving the voice channel if we're in one."""
+        if self._suspend_handle:
+            self._suspend_handle.cancel()
+            self._suspend_handle = None
+
+        self.playlist.close()
+        self.syncer.disconnect()
+        self.channel = None
+
+    def snapshot(self):
+        """A JSON friendly record of what this guild is doing, enough to pick it back up after a restart."""
+        state = self.syncer.state
+        if state['fsm_state'] in (SyncerState.DISCONNECTED, SyncerState.HALT) or not state.get('channel'):
+            return None
+
+        playing_url = state.get('playing_url')
+        current = self.playlist.current
+        return {
+            'voice_channel_id': state['channel'].id,
+            'text_channel_id': self.channel.id if self.channel else None,
+            'playing_url': playing_url,
+            # Lets us get a new download url, since the one we have will likely have expired by the time we restore.
+            'source_url': current.url if playing_url and current and current.info else None,
+            'source_key': state.get('source_key'),
+            'codec': state.get('codec'),
+            'is_live': state.get('is_live', False),
+            'volume': state['volume'],
+            'progress': self.syncer.estimated_progress if playing_url else 0,
+        }
+
+    def restore(self, record):
+        self.channel = self.bot.get_channel(record['text_channel_id']) if record['text_channel_id'] else None
+        self.syncer.connect(self.bot.get_channel(record['voice_channel_id']))
+        self.syncer.volume(record['volume'])
+        if record.get('source_url'):
+            self.playlist.resume(record['source_url'], record['progress'])
+
+        elif record['playing_url']:
+            # We only kept the download url, which is enough to carry on, and for the queue to know we're busy.
+            self.playlist.current = QueuedTrack(record['playing_url'])
+            self.syncer.play(
+                record['playing_url'], source_key=record['source_key'], progress=record['progress'],
+                codec=record.get('codec'), is_live=record.get('is_live', False)
+            )
+
 
 _player_states = {}
+_eviction_stats = {'evicted': 0}
 
 
 def get_player_state(server, bot=None, create=False):
@@ -52,4 +545,47 @@ def get_player_state(server, bot=None, create=False):
         state = PlayerState(bot)
         _player_states[server.id] = state
 
-    return state
\ No newline at end of file
+    return state
+
+
+def iter_player_states():
+    return list(_player_states.items())
+
+
+def evict_idle_player_states(idle_after=900):
+    """Closes and forgets the player states that have been idle for `idle_after` seconds, returning how many."""
+    now = time.monotonic()
+    evicted = 0
+    for server_id, state in iter_player_states():
+        if not state.is_idle():
+            state.idle_since = None
+            continue
+
+        if state.idle_since is None:
+            state.idle_since = now
+
+        if now - state.idle_since >= idle_after:
+            del _player_states[server_id]
+            state.close()
+            evicted += 1
+
+    _eviction_stats['evicted'] += evicted
+    return evicted
+
+
+async def run_player_state_eviction(interval=60, idle_after=900):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            evict_idle_player_states(idle_after)
+
+        except Exception:
+            traceback.print_exc()
+
+
+def get_stats():
+    return {
+        'player_states': len(_player_states),
+        'idle_player_states': sum(1 for state in _player_states.values() if state.idle_since is not None),
+        'evicted_player_states': _eviction_stats['evicted'],
+    }
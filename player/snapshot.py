@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import time
+import traceback
+
+import player
+
+SNAPSHOT_VERSION = 1
+
+
+class PlayerStateSnapshotter(object):
+    """
+    Periodically writes what every guild is playing to disk, so that after a restart we can rejoin the same
+    voice channels and carry on from the same spot.
+    """
+
+    def __init__(self, bot, path='player_states.json', interval=30, restore_batch_size=5, restore_batch_interval=2):
+        self.bot = bot
+        self.path = path
+        self.interval = interval
+        self.restore_batch_size = restore_batch_size
+        self.restore_batch_interval = restore_batch_interval
+        self._restore_started = False
+        self._restore_done = False
+
+    def take(self):
+        guilds = {}
+        for server_id, state in player.iter_player_states():
+            record = state.snapshot()
+            if record:
+                guilds[server_id] = record
+
+        return {'version': SNAPSHOT_VERSION, 'taken_at': time.time(), 'guilds': guilds}
+
+    def save(self):
+        # Until the old snapshot has been restored, it's the only record of those guilds.
+        if not self._restore_done:
+            return 0
+
+        snapshot = self.take()
+        # Write then rename, so a crash mid-write never leaves us with half a snapshot.
+        temp_path = '%s.tmp' % self.path
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+
+        os.replace(temp_path, self.path)
+        return len(snapshot['guilds'])
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+
+        except FileNotFoundError:
+            return {}
+
+        except ValueError:
+            traceback.print_exc()
+            return {}
+
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return {}
+
+        return snapshot['guilds']
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.save()
+
+            except Exception:
+                traceback.print_exc()
+
+    async def restore(self):
+        # on_ready fires again on every gateway reconnect, we only want to restore once.
+        if self._restore_started:
+            return
+
+        self._restore_started = True
+        records = list(self.load().items())
+        restored = 0
+
+        try:
+            # Joining voice channels goes through the gateway, which is rate limited, so we go in batches.
+            for i in range(0, len(records), self.restore_batch_size):
+                if i:
+                    await asyncio.sleep(self.restore_batch_interval)
+
+                for server_id, record in records[i:i + self.restore_batch_size]:
+                    server = self.bot.get_server(server_id)
+                    if not server or not self.bot.get_channel(record['voice_channel_id']):
+                        continue
+
+                    player.get_player_state(server, self.bot, create=True).restore(record)
+                    restored += 1
+
+        finally:
+            self._restore_done = True
+
+        print("Restored %s of %s player states" % (restored, len(records)))
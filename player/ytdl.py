@@ -1,56 +1,418 @@
+import asyncio
+import collections
 import datetime
-import functools
-import youtube_dl
+import multiprocessing
+import re
+import time
+import urllib.parse
+
+# How long extracted info is reused for, and how long before the signed download url expires we stop reusing it.
+CACHE_TTL = 600
+CACHE_EXPIRY_MARGIN = 120
+CACHE_MAX_ENTRIES = 512
+# Playlists are extracted this many entries at a time, so the first ones can start playing while the rest load.
+PLAYLIST_PAGE_SIZE = 50
+
 
 class ExtractedInfo(object):
+    # Every queued track holds one of these, and the cache hundreds more.
+    __slots__ = (
+        'download_url', 'url', 'source_key', 'views', 'is_live', 'codec', 'likes', 'dislikes', 'duration',
+        'uploader', 'title', 'description', 'upload_date'
+    )
+
+
+def normalize_query(url):
+    url = url.strip()
+    if re.match(r'^[a-z][a-z0-9+.-]*://', url, re.IGNORECASE):
+        # Video ids are case sensitive, so only the scheme and host are safe to lower case.
+        parts = urllib.parse.urlsplit(url)
+        return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+    # A search, which isn't case sensitive.
+    return ' '.join(url.lower().split())
+
+
+def download_url_expiry(download_url):
+    """When a signed download url stops working, if it says so (googlevideo urls carry an `expire` parameter)."""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(download_url).query)
+    expire = query.get('expire')
+    if expire:
+        try:
+            return float(expire[0])
+        except ValueError:
+            pass
+
+    return None
+
+
+class ExtractionCache(object):
+    def __init__(self, ttl=CACHE_TTL, expiry_margin=CACHE_EXPIRY_MARGIN, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, info = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return info
+
+            del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def put(self, key, info):
+        expires_at = time.time() + self.ttl
+        url_expiry = download_url_expiry(info.download_url)
+        if url_expiry is not None:
+            expires_at = min(expires_at, url_expiry - self.expiry_margin)
+
+        if expires_at <= time.time():
+            return
+
+        self._entries[key] = (expires_at, info)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class ExtractionError(Exception):
     pass
 
-async def extract_info(loop, url, *, ytdl_options=None, **kwargs):
-    use_avconv = kwargs.get('use_avconv', False)
+
+# Lives in the extraction processes. Each one only runs one extraction at a time, so one instance per set of
+# options is all it needs.
+_ydl_instances = {}
+
+
+def _flat_entry_url(entry):
+    url = entry.get('url') or entry.get('id')
+    if url and entry.get('ie_key') == 'Youtube' and '://' not in url:
+        url = 'https://www.youtube.com/watch?v=%s' % url
+
+    return url
+
+
+def _extract_fields(url, opts, options_key, flat=False, page=None):
+    """
+    Runs in an extraction process, and only sends back the fields we use, rather than the whole info dict.
+
+    With `flat`, playlists aren't resolved, and come back as {'entries': [(url, title), ...], 'count': n} instead,
+    holding only the entries from `page`, a (first, last) pair counting from 1, if one is given.
+    """
+    # Only the extraction processes need youtube_dl, the bot itself never has to load it.
+    import youtube_dl
+
+    try:
+        ydl_key = (options_key, flat)
+        ydl = _ydl_instances.get(ydl_key)
+        if ydl is None:
+            ydl = _ydl_instances[ydl_key] = youtube_dl.YoutubeDL(dict(opts, extract_flat='in_playlist') if flat else opts)
+
+        if flat:
+            ydl.params['playliststart'], ydl.params['playlistend'] = page or (1, None)
+
+        return _select_fields(ydl.extract_info(url, download=False), flat)
+
+    except Exception as e:
+        # youtube_dl's exceptions carry tracebacks, which can't be sent back to the main process.
+        raise ExtractionError(str(e))
+
+
+def _select_fields(info, flat):
+    if "entries" in info:
+        if flat:
+            entries = [(_flat_entry_url(entry), entry.get('title')) for entry in info['entries']]
+            return {'entries': [(entry_url, title) for entry_url, title in entries if entry_url], 'count': len(entries)}
+
+        info = info['entries'][0]
+
+    return {
+        'download_url': info['url'],
+        'source_key': '%s:%s' % (info.get('extractor_key'), info.get('id') or info.get('webpage_url')),
+        'views': info.get('view_count'),
+        'is_live': bool(info.get('is_live')),
+        'codec': info.get('acodec'),
+        'likes': info.get('like_count'),
+        'dislikes': info.get('dislike_count'),
+        'duration': info.get('duration'),
+        'uploader': info.get('uploader'),
+        'title': info.get('title'),
+        'description': info.get('description'),
+        'upload_date': info.get('upload_date'),
+    }
+
+
+class ExtractionPool(object):
+    """
+    Runs extractions in a pool of processes, so their CPU time and GIL holding stay away from the gateway and RPC
+    server. At most `max_queued` extractions can be waiting or running, each one gets `timeout` seconds once it's
+    running, and every process is replaced after `recycle_after` extractions.
+    """
+
+    def __init__(self, processes=2, max_queued=32, timeout=30, recycle_after=50):
+        self.processes = processes
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.recycle_after = recycle_after
+        self.timeouts = 0
+        self.rejected = 0
+
+        self._pool = None
+        self._pool_futures = set()
+        self._queued = 0
+        self._running = None
+
+    def start(self):
+        # The pool keeps starting processes as it recycles them, long after the bot has started its threads, and
+        # forking a threaded process can leave the child with locks nobody will ever release. A fork server is
+        # started from a clean process, and all the pool's processes are forked from that instead.
+        if self._pool is None:
+            context = multiprocessing.get_context('forkserver')
+            self._pool = context.Pool(self.processes, maxtasksperchild=self.recycle_after)
+            self._pool_futures = set()
+
+    async def run(self, loop, func, *args):
+        if self._queued >= self.max_queued:
+            self.rejected += 1
+            raise ExtractionError('Too many extractions in progress, try again in a bit.')
+
+        if self._running is None:
+            self._running = asyncio.Semaphore(self.processes, loop=loop)
+
+        self._queued += 1
+        try:
+            # Only hand the pool as many as it has processes for, so the timeout doesn't count time spent waiting
+            # behind others, and a timeout always means the extraction itself is stuck.
+            async with self._running:
+                return await self._run(loop, func, args)
+
+        finally:
+            self._queued -= 1
+
+    async def _run(self, loop, func, args):
+        self.start()
+        pool, pool_futures = self._pool, self._pool_futures
+        future = loop.create_future()
+        pool_futures.add(future)
+
+        def resolve(setter, value):
+            if not future.done():
+                setter(value)
+
+        # The callbacks are called on the pool's result thread.
+        pool.apply_async(
+            func, args,
+            callback=lambda result: loop.call_soon_threadsafe(resolve, future.set_result, result),
+            error_callback=lambda e: loop.call_soon_threadsafe(resolve, future.set_exception, e)
+        )
+
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._recycle(loop, pool)
+            raise ExtractionError('Extraction timed out.')
+
+        finally:
+            pool_futures.discard(future)
+
+    def _recycle(self, loop, pool):
+        # A stuck extraction keeps its process forever. The only way to get it back is to replace the whole pool.
+        if pool is not self._pool:
+            return
+
+        self._pool = None
+        for future in self._pool_futures:
+            if not future.done():
+                future.set_exception(ExtractionError('Extraction was interrupted, try again.'))
+
+        loop.run_in_executor(None, pool.terminate)
+
+    def get_stats(self):
+        return {
+            'processes': self.processes,
+            'queued': self._queued,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+        }
+
+
+_cache = ExtractionCache()
+_inflight = {}
+extraction_pool = ExtractionPool()
+
+
+def _options_key(opts):
+    return tuple(sorted((key, repr(value)) for key, value in opts.items()))
+
+
+def _build_options(ytdl_options, use_avconv=False):
     opts = {
         'format': 'webm[abr>0]/bestaudio/best',
         'prefer_ffmpeg': not use_avconv
     }
-    
+
     if ytdl_options is not None and isinstance(ytdl_options, dict):
         opts.update(ytdl_options)
-    
-    ydl = youtube_dl.YoutubeDL(opts)
-    func = functools.partial(ydl.extract_info, url, download=False)
-    info = await loop.run_in_executor(None, func)
-    if "entries" in info:
-        info = info['entries'][0]
-    
-    download_url = info['url']
+
+    return opts
+
+
+async def extract_info(loop, url, *, ytdl_options=None, refresh=False, **kwargs):
+    """Extracts the url, or finds it in the cache. With `refresh`, we need a new download url, cached or not."""
+    opts = _build_options(ytdl_options, kwargs.get('use_avconv', False))
+    options_key = _options_key(opts)
+    key = (normalize_query(url), options_key)
+    if refresh:
+        _cache.invalidate(key)
+
+    info = _cache.get(key)
+    if info is not None:
+        return info
+
+    # If someone else is already extracting the same thing, wait for theirs instead of starting another.
+    future = _inflight.get(key)
+    if future is None:
+        future = _inflight[key] = asyncio.ensure_future(_extract_info(loop, url, opts, options_key, key), loop=loop)
+        future.add_done_callback(lambda f: _inflight.pop(key, None))
+
+    return await asyncio.shield(future)
+
+
+async def _extract_info(loop, url, opts, options_key, key):
+    fields = await extraction_pool.run(loop, _extract_fields, url, opts, options_key)
+    extracted_info = _build_extracted_info(url, fields)
+    _cache.put(key, extracted_info)
+    return extracted_info
+
+
+def _build_extracted_info(url, fields):
     extracted_info = ExtractedInfo()
-    
+
     # set the dynamic attributes from the info extraction
-    extracted_info.download_url = download_url
+    extracted_info.download_url = fields['download_url']
     extracted_info.url = url
-    extracted_info.yt = ydl
-    extracted_info.views = info.get('view_count')
-    extracted_info.is_live = bool(info.get('is_live'))
-    extracted_info.likes = info.get('like_count')
-    extracted_info.dislikes = info.get('dislike_count')
-    extracted_info.duration = info.get('duration')
-    extracted_info.uploader = info.get('uploader')
-    
+    # Stable across extractions, unlike the signed download url.
+    extracted_info.source_key = fields['source_key']
+    extracted_info.views = fields['views']
+    extracted_info.is_live = fields['is_live']
+    # Lets the worker skip decoding Opus sources altogether.
+    extracted_info.codec = fields.get('codec')
+    extracted_info.likes = fields['likes']
+    extracted_info.dislikes = fields['dislikes']
+    extracted_info.duration = fields['duration']
+    extracted_info.uploader = fields['uploader']
+
     is_twitch = 'twitch' in url
     if is_twitch:
         # twitch has 'title' and 'description' sort of mixed up.
-        extracted_info.title = info.get('description')
+        extracted_info.title = fields['description']
         extracted_info.description = None
     else:
-        extracted_info.title = info.get('title')
-        extracted_info.description = info.get('description')
-    
+        extracted_info.title = fields['title']
+        extracted_info.description = fields['description']
+
     # upload date handling
-    date = info.get('upload_date')
+    date = fields['upload_date']
     if date:
         try:
             date = datetime.datetime.strptime(date, '%Y%M%d').date()
         except ValueError:
             date = None
-    
+
     extracted_info.upload_date = date
     return extracted_info
+
+
+class ExtractedPlaylist(object):
+    """
+    The tracks of a playlist as (url, title) pairs, with the first one already resolved if it had to be. If there's
+    more to it, `next_page` is a coroutine function that extracts the next ExtractedPlaylist, or None at the end.
+    """
+
+    def __init__(self, entries, first=None, next_page=None):
+        self.entries = entries
+        self.first = first
+        self.next_page = next_page
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def is_expired(info, margin=CACHE_EXPIRY_MARGIN):
+    expiry = download_url_expiry(info.download_url)
+    return expiry is not None and expiry - margin <= time.time()
+
+
+async def extract_playlist(loop, url, *, ytdl_options=None, page_size=PLAYLIST_PAGE_SIZE):
+    """
+    Like `extract_info`, but a playlist url comes back as an ExtractedPlaylist of its first `page_size` tracks,
+    without resolving any of them, and the rest to follow page by page. Anything else comes back as an
+    ExtractedPlaylist of one, already resolved.
+    """
+    opts = _build_options(ytdl_options)
+
+    # Searches are always resolved to their first result, there's no playlist to stream.
+    query = normalize_query(url)
+    if '://' not in query:
+        info = await extract_info(loop, url, ytdl_options=ytdl_options)
+        return ExtractedPlaylist([(url, info.title)], first=info)
+
+    options_key = _options_key(opts)
+    key = (query, options_key)
+    info = _cache.get(key)
+    if info is None:
+        fields = await extraction_pool.run(loop, _extract_fields, url, opts, options_key, True, (1, page_size))
+        if 'entries' in fields:
+            return _playlist_page(loop, url, opts, options_key, fields, 1, page_size)
+
+        # It wasn't a playlist after all, so we already have everything extract_info would have found.
+        info = _build_extracted_info(url, fields)
+        _cache.put(key, info)
+
+    return ExtractedPlaylist([(url, info.title)], first=info)
+
+
+def _playlist_page(loop, url, opts, options_key, fields, start, page_size):
+    next_page = None
+    # A short page is the last one. A full one may be too, which the next (empty) page tells us.
+    if fields['count'] >= page_size:
+        next_start = start + page_size
+        next_page = lambda: _extract_playlist_page(loop, url, opts, options_key, next_start, page_size)
+
+    return ExtractedPlaylist(fields['entries'], next_page=next_page)
+
+
+async def _extract_playlist_page(loop, url, opts, options_key, start, page_size):
+    page = (start, start + page_size - 1)
+    fields = await extraction_pool.run(loop, _extract_fields, url, opts, options_key, True, page)
+    if not fields.get('count'):
+        return None
+
+    return _playlist_page(loop, url, opts, options_key, fields, start, page_size)
+
+
+def get_stats():
+    return {
+        'cache_entries': len(_cache),
+        'cache_hits': _cache.hits,
+        'cache_misses': _cache.misses,
+        'inflight': len(_inflight),
+        'pool': extraction_pool.get_stats(),
+    }
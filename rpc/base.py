@@ -65,6 +65,8 @@ class ClientBase(object):
         self._ref_futures = {}
         self._last_ping_time = 0
         self._pings = deque(maxlen=15)
+        # (round trip delay, clock offset) pairs from recent pings, see `_add_clock_sample`.
+        self._clock_samples = deque(maxlen=8)
 
     async def write_packet(self, op, data, drain=False):
         serialized_data = json.dumps({"op": op, "d": data})
@@ -149,7 +151,7 @@ class ClientBase(object):
 
                 else:
                     self._last_ping_time = time.time()
-                    await self.write_packet("ping", True)
+                    await self.write_packet("ping", {"t0": self._last_ping_time})
 
                 await asyncio.sleep(self.heartbeat_interval)
 
@@ -165,13 +167,22 @@ class ClientBase(object):
 
     async def _handle_internal(self, opcode, data):
         if opcode == "ping":
+            if isinstance(data, dict) and 't0' in data:
+                # We reply straight away, so the time we got it and the time we reply are the same.
+                now = time.time()
+                data = {"t0": data['t0'], "t1": now, "t2": now}
+
             await self.write_packet("pong", data)
             return True
 
         elif opcode == "pong":
+            now = time.time()
             self._ping_was_ponged = True
-            latest_latency = time.time() - self._last_ping_time
+            latest_latency = now - self._last_ping_time
             self._pings.append(latest_latency)
+            if isinstance(data, dict) and 't1' in data:
+                self._add_clock_sample(data['t0'], data['t1'], data['t2'], now)
+
             self._maybe_task(self.handle_pong(latest_latency))
             return True
 
@@ -316,6 +327,34 @@ class ClientBase(object):
     def handle_pong(self, latest_latency):
         pass
 
+    def _add_clock_sample(self, t0, t1, t2, t3):
+        # NTP style: we sent at t0, they received at t1 and replied at t2, and we got the reply at t3.
+        # Their clock minus ours, assuming the trip there took as long as the trip back.
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        delay = (t3 - t0) - (t2 - t1)
+        self._clock_samples.append((delay, offset))
+
+    @property
+    def clock_offset(self):
+        """How far the remote's clock is ahead of ours, taken from the recent ping with the least delay."""
+        if not self._clock_samples:
+            return 0
+
+        return min(self._clock_samples)[1]
+
+    @property
+    def one_way_delay(self):
+        if not self._clock_samples:
+            return 0
+
+        return min(self._clock_samples)[0] / 2
+
+    def to_remote_time(self, timestamp):
+        return timestamp + self.clock_offset
+
+    def to_local_time(self, remote_timestamp):
+        return remote_timestamp - self.clock_offset
+
     @property
     def latest_ping(self):
         if self._pings:
@@ -3,25 +3,46 @@ import asyncio
 from discord.ext import commands
 
 import bot.client
+import bot.outbox
+import player
+import player.ytdl
 import secrets
 import voice.server
-
-loop = asyncio.get_event_loop()
-discord = bot.client.Bot(loop=loop, command_prefix=commands.when_mentioned_or('$'),
-                         description='A playlist example for discord.py')
-rpc_server = voice.server.Server(loop=loop, discord=discord)
-
-
-@discord.event
-async def on_ready():
-    print('Logged in as')
-    print(discord.user.name)
-    print(discord.user.id)
-    print('------')
-
-
-rpc_server.start()
-discord.rpc_server = rpc_server
-discord.load_extension('bot.cogs.loader')
-
-discord.run(secrets.discord_token)
+from player.snapshot import PlayerStateSnapshotter
+from syncer.scheduler import SyncerScheduler
+
+
+def run():
+    loop = asyncio.get_event_loop()
+    discord = bot.client.Bot(loop=loop, command_prefix=commands.when_mentioned_or('$'),
+                             description='A playlist example for discord.py')
+    rpc_server = voice.server.Server(loop=loop, discord=discord)
+    snapshotter = PlayerStateSnapshotter(discord)
+
+    @discord.event
+    async def on_ready():
+        print('Logged in as')
+        print(discord.user.name)
+        print(discord.user.id)
+        print('------')
+        await snapshotter.restore()
+
+    # Have the extraction processes ready before the first request comes in.
+    player.ytdl.extraction_pool.start()
+    rpc_server.start()
+    discord.rpc_server = rpc_server
+    discord.syncer_scheduler = SyncerScheduler(loop)
+    discord.outbox = bot.outbox.MessageOutbox(loop, discord.send_message)
+    discord.load_extension('bot.cogs.loader')
+    loop.create_task(snapshotter.run())
+    loop.create_task(player.run_player_state_eviction())
+
+    try:
+        discord.run(secrets.discord_token)
+    finally:
+        print("Saved %s player states" % snapshotter.save())
+
+
+# The extraction processes import this module too, and mustn't start a bot of their own.
+if __name__ == '__main__':
+    run()
@@ -9,7 +9,8 @@ def run():
         host='localhost',
         port=3000,
         client_id='1512',
-        client_secret='hello_world'
+        client_secret='hello_world',
+        max_clients=15
     )
 
     try:
@@ -29,6 +30,8 @@ def run():
             pass
 
     finally:
+        client.frame_scheduler.close()
+        client.ffmpeg_pool.close()
         loop.close()
 
 
@@ -0,0 +1,23 @@
+import argparse
+import json
+
+from sim.memory_bench import BenchConfig, MemoryBench
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Measure how much memory each guild\'s player state holds on to.')
+    parser.add_argument('--guilds', type=int, default=500)
+    parser.add_argument('--tracks-per-guild', type=int, default=20)
+    parser.add_argument('--description-length', type=int, default=1000)
+    args = parser.parse_args()
+
+    config = BenchConfig(
+        guilds=args.guilds,
+        tracks_per_guild=args.tracks_per_guild,
+        description_length=args.description_length
+    )
+    print(json.dumps(MemoryBench(config).run(), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,48 @@
+import argparse
+import json
+import sys
+
+from sim.syncer_sim import SimConfig, Simulation
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Simulate VoiceStateSyncer convergence on a virtual clock.')
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--call-failure-rate', type=float, default=0.01)
+    parser.add_argument('--join-failure-rate', type=float, default=0.05)
+    parser.add_argument('--command-rate', type=float, default=1.0)
+    parser.add_argument('--kill', action='append', default=None, metavar='WORKER@SECONDS',
+                        help='take a worker down at a point in time, e.g. 0@3.5 (default: 0@3)')
+    parser.add_argument('--worker-down-for', type=float, default=10.0)
+    parser.add_argument('--duration', type=float, default=120.0)
+    args = parser.parse_args()
+
+    kills = [(0, 3.0)]
+    if args.kill is not None:
+        kills = [(int(worker), float(at)) for worker, at in (kill.split('@') for kill in args.kill)]
+
+    config = SimConfig(
+        guilds=args.guilds,
+        workers=args.workers,
+        seed=args.seed,
+        call_failure_rate=args.call_failure_rate,
+        join_failure_rate=args.join_failure_rate,
+        command_rate=args.command_rate,
+        worker_kills=kills,
+        worker_down_for=args.worker_down_for,
+        duration=args.duration
+    )
+    report = Simulation(config).run()
+    print(json.dumps(report, indent=2, sort_keys=True))
+    # Every guild has to end up where its users asked it to be, anything else is a bug.
+    if report['unconverged_guilds']:
+        sys.exit('%s guilds never converged' % report['unconverged_guilds'])
+
+    if report['task_errors']:
+        sys.exit('%s unexpected exceptions, see above' % report['task_errors'])
+
+
+if __name__ == '__main__':
+    run()
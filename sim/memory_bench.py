@@ -0,0 +1,191 @@
+"""
+Measures, with tracemalloc, how much memory each guild's player state holds on to: while it's playing through a
+queue, once it has gone idle (which is all a guild that's done with us used to keep forever), and once the idle
+state has been evicted. Also compares one track's ExtractedInfo with and without slots.
+"""
+import asyncio
+import gc
+import tracemalloc
+
+import player
+import player.ytdl
+from lib.event_emitter import EventEmitter
+from sim.virtual_loop import VirtualClockLoop
+from syncer.scheduler import SyncerScheduler
+
+
+class BenchConfig(object):
+    def __init__(self, **kwargs):
+        self.guilds = 500
+        self.tracks_per_guild = 20
+        # youtube descriptions are easily this long.
+        self.description_length = 1000
+        self.infos = 2000
+
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise TypeError('Unknown benchmark option %s' % key)
+
+            setattr(self, key, value)
+
+
+class FakeServer(object):
+    def __init__(self, server_id):
+        self.id = server_id
+
+
+class FakeChannel(object):
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class FakeRemoteVoiceClient(EventEmitter):
+    """Answers everything straight away, we only care about what the bot keeps around."""
+
+    def __init__(self):
+        super(FakeRemoteVoiceClient, self).__init__()
+        self._playback_ref_seq = 0
+
+    async def play(self, volume, url, progress=0, source_key=None, started_at=None, codec=None, is_live=False):
+        self._playback_ref_seq += 1
+        return '%s.%s' % (id(self), self._playback_ref_seq)
+
+    async def stop(self):
+        pass
+
+    async def preload(self, url=None, source_key=None, codec=None, is_live=False):
+        pass
+
+    async def set_volume(self, volume):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    @staticmethod
+    def to_local_time(remote_timestamp):
+        return remote_timestamp
+
+    @staticmethod
+    def to_remote_time(timestamp):
+        return timestamp
+
+
+class FakeBot(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.syncer_scheduler = SyncerScheduler(loop)
+
+    async def join_voice_channel(self, channel):
+        return FakeRemoteVoiceClient()
+
+
+class _UnslottedInfo(object):
+    pass
+
+
+def _fields(config, url):
+    return {
+        'download_url': 'https://media.example.com/%s/audio.webm?signature=%s' % (url, 'x' * 120),
+        'source_key': 'Youtube:%s' % url,
+        'views': 123456,
+        'is_live': False,
+        'codec': 'opus',
+        'likes': 1234,
+        'dislikes': 12,
+        'duration': 215,
+        'uploader': 'Some Uploader',
+        'title': 'Some track called %s' % url,
+        'description': 'd' * config.description_length,
+        'upload_date': '20170101',
+    }
+
+
+class MemoryBench(object):
+    def __init__(self, config=None):
+        self.config = config or BenchConfig()
+        self.loop = VirtualClockLoop()
+        self.bot = None
+
+    async def _extract_info(self, loop, url, *, ytdl_options=None, refresh=False, **kwargs):
+        return player.ytdl._build_extracted_info(url, _fields(self.config, url))
+
+    def _settle(self):
+        self.loop.run_until_complete(asyncio.sleep(5))
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    def _measure_guilds(self):
+        config = self.config
+        baseline = self._settle()
+
+        states = []
+        for i in range(config.guilds):
+            state = player.get_player_state(FakeServer(str(i)), self.bot, create=True)
+            state.syncer.connect(FakeChannel(str(i)))
+            entries = [('track-%s-%s' % (i, n), 'Track %s' % n) for n in range(config.tracks_per_guild)]
+            state.playlist.enqueue(player.ytdl.ExtractedPlaylist(entries))
+            states.append(state)
+
+        active = self._settle()
+
+        # Like $stop, after which the guild stays connected with nothing to play.
+        for state in states:
+            state.playlist.clear()
+            state.syncer.stop()
+
+        idle = self._settle()
+        del states, state
+
+        evicted_count = player.evict_idle_player_states(idle_after=0)
+        evicted = self._settle()
+
+        return {
+            'guilds': config.guilds,
+            'evicted': evicted_count,
+            'active_bytes_per_guild': (active - baseline) // config.guilds,
+            'idle_bytes_per_guild': (idle - baseline) // config.guilds,
+            'evicted_bytes_per_guild': max(0, evicted - baseline) // config.guilds,
+        }
+
+    def _measure_infos(self):
+        config = self.config
+        fields = [_fields(config, 'track-%s' % i) for i in range(config.infos)]
+        # The strings are shared by both, what we're after is the record around them.
+        for field in fields:
+            field['upload_date'] = None
+
+        results = {}
+        for name, cls in (('slotted', player.ytdl.ExtractedInfo), ('unslotted', _UnslottedInfo)):
+            gc.collect()
+            before = tracemalloc.get_traced_memory()[0]
+            infos = []
+            for i, field in enumerate(fields):
+                info = cls()
+                for key, value in field.items():
+                    setattr(info, key, value)
+
+                info.url = 'track-%s' % i
+                infos.append(info)
+
+            results['%s_info_bytes' % name] = (tracemalloc.get_traced_memory()[0] - before) // config.infos
+            del infos
+
+        return results
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        extract_info = player.extract_info
+        player.extract_info = self._extract_info
+        tracemalloc.start()
+        try:
+            self.bot = FakeBot(self.loop)
+            report = self._measure_guilds()
+            report.update(self._measure_infos())
+            return report
+
+        finally:
+            tracemalloc.stop()
+            player.extract_info = extract_info
+            asyncio.set_event_loop(None)
+            self.loop.close()
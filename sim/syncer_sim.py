@@ -0,0 +1,364 @@
+"""
+Runs many VoiceStateSyncers against a fake bot and fake workers on a virtual clock, to measure how quickly and how
+cheaply they converge on what users asked for, with RPC latency, failed calls and workers going down.
+"""
+import asyncio
+import random
+import sys
+import traceback
+from contextlib import contextmanager
+
+import syncer.voice_syncer
+from lib.event_emitter import EventEmitter
+from lib.stats import Samples
+from rpc.base import CallException, CallExceptionDown
+from sim.virtual_loop import VirtualClockLoop
+from syncer.scheduler import SyncerScheduler
+from syncer.voice_syncer import VoiceStateSyncer, SyncerState
+
+
+class SimConfig(object):
+    def __init__(self, **kwargs):
+        self.guilds = 200
+        self.workers = 4
+        self.seed = 1
+        # Seconds each remote call takes, picked uniformly from this range.
+        self.call_latency = (0.005, 0.05)
+        self.join_latency = (0.2, 1.0)
+        # Chance that any call, or join, fails outright.
+        self.call_failure_rate = 0.01
+        self.join_failure_rate = 0.05
+        # Users send commands for this long, at this many commands per guild per second.
+        self.command_period = 5.0
+        self.command_rate = 1.0
+        # Which workers go down and when (worker index, time), and how long until they come back.
+        self.worker_kills = [(0, 3.0)]
+        self.worker_down_for = 10.0
+        self.duration = 120.0
+
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise TypeError('Unknown simulation option %s' % key)
+
+            setattr(self, key, value)
+
+
+class SimStats(object):
+    def __init__(self):
+        self.remote_calls = 0
+        self.failed_calls = 0
+        self.wasted_calls = 0
+        self.joins = 0
+        self.failed_joins = 0
+        self.concurrent_joins = 0
+        self.max_concurrent_joins = 0
+        # Exceptions that weren't one of the failures we simulate, which are always a bug.
+        self.task_errors = 0
+
+
+class FakeWorker(object):
+    def __init__(self, sim, index):
+        self.sim = sim
+        self.index = index
+        self.alive = True
+        self.clients = set()
+
+    def kill(self):
+        self.alive = False
+        clients, self.clients = self.clients, set()
+        for client in clients:
+            client.emit('remote:down', 'simulated worker failure')
+
+    def revive(self):
+        self.alive = True
+
+
+class FakeRemoteVoiceClient(EventEmitter):
+    def __init__(self, sim, worker, guild):
+        super(FakeRemoteVoiceClient, self).__init__()
+        self.sim = sim
+        self.worker = worker
+        self.guild = guild
+        self.playing_url = None
+        self.volume = None
+        self.suspended = False
+        self._playback_ref_seq = 0
+
+    async def _remote(self, kind):
+        stats = self.sim.stats
+        stats.remote_calls += 1
+        await asyncio.sleep(random.uniform(*self.sim.config.call_latency))
+
+        if not self.worker.alive or self not in self.worker.clients:
+            stats.failed_calls += 1
+            stats.wasted_calls += 1
+            raise CallExceptionDown(kind)
+
+        if random.random() < self.sim.config.call_failure_rate:
+            stats.failed_calls += 1
+            stats.wasted_calls += 1
+            raise CallException('simulated failure')
+
+        self.guild.record_call(self, kind)
+
+    async def play(self, volume, url, progress=0, source_key=None, started_at=None, codec=None, is_live=False):
+        await self._remote('track')
+        self.playing_url = url
+        self.volume = volume
+        self.suspended = False
+        self._playback_ref_seq += 1
+        return '%s.%s' % (id(self), self._playback_ref_seq)
+
+    async def stop(self):
+        await self._remote('track')
+        self.playing_url = None
+        self.suspended = False
+
+    async def preload(self, url=None, source_key=None, codec=None, is_live=False):
+        await self._remote('preload')
+
+    async def set_volume(self, volume):
+        await self._remote('volume')
+        self.volume = volume
+
+    async def suspend(self):
+        await self._remote('suspend')
+        self.suspended = True
+        return 0
+
+    async def unsuspend(self, volume):
+        await self._remote('suspend')
+        self.suspended = False
+        self.volume = volume
+
+    async def disconnect(self):
+        await self._remote('disconnect')
+        self.worker.clients.discard(self)
+
+    @staticmethod
+    def to_local_time(remote_timestamp):
+        return remote_timestamp
+
+    @staticmethod
+    def to_remote_time(timestamp):
+        return timestamp
+
+
+class FakeBot(object):
+    def __init__(self, sim, loop):
+        self.sim = sim
+        self.loop = loop
+        self.syncer_scheduler = SyncerScheduler(loop)
+
+    async def join_voice_channel(self, guild):
+        stats = self.sim.stats
+        stats.joins += 1
+        stats.concurrent_joins += 1
+        stats.max_concurrent_joins = max(stats.max_concurrent_joins, stats.concurrent_joins)
+
+        try:
+            await asyncio.sleep(random.uniform(*self.sim.config.join_latency))
+            workers = [worker for worker in self.sim.workers if worker.alive]
+            if not workers or random.random() < self.sim.config.join_failure_rate:
+                stats.failed_joins += 1
+                return None
+
+            worker = min(workers, key=lambda w: len(w.clients))
+            client = FakeRemoteVoiceClient(self.sim, worker, guild)
+            worker.clients.add(client)
+            return client
+
+        finally:
+            stats.concurrent_joins -= 1
+
+
+class FakePlayerState(object):
+    def __init__(self, bot):
+        self.bot = bot
+
+
+class SimGuild(object):
+    """A guild, what its users last asked for, and the calls made on its behalf."""
+
+    def __init__(self, sim, index):
+        self.sim = sim
+        self.index = index
+        self.syncer = VoiceStateSyncer(FakePlayerState(sim.bot))
+        self.target_url = None
+        self.target_volume = 1.0
+        self.disrupted_at = 0.0
+        self.converged_at = None
+        # The last call of each kind that went through, a newer one makes the older one wasted.
+        self._last_calls = {}
+
+    def record_call(self, client, kind):
+        if kind in self._last_calls:
+            self.sim.stats.wasted_calls += 1
+
+        self._last_calls[kind] = client
+
+    def disrupt(self):
+        self.disrupted_at = self.sim.loop.time()
+        self.converged_at = None
+
+    def command(self, op, *args):
+        self.disrupt()
+        if op == 'play':
+            self.target_url = args[0]
+            self.syncer.play(args[0])
+
+        elif op == 'stop':
+            self.target_url = None
+            self.syncer.stop()
+
+        elif op == 'volume':
+            self.target_volume = args[0]
+            self.syncer.volume(args[0])
+
+    def is_converged(self):
+        client = self.syncer.state.get('client')
+        return (
+            self.syncer.fsm_state == SyncerState.CONNECTED and client is not None and client.worker.alive and
+            client in client.worker.clients and client.playing_url == self.target_url and
+            (self.target_url is None or client.volume == self.target_volume)
+        )
+
+    def check(self):
+        if self.converged_at is None and self.is_converged():
+            self.converged_at = self.sim.loop.time()
+            self.sim.convergence_times.add(self.converged_at - self.disrupted_at)
+            # Calls made before this point can't be superseded any more.
+            self._last_calls.clear()
+
+
+class Simulation(object):
+    def __init__(self, config=None):
+        self.config = config or SimConfig()
+        self.loop = VirtualClockLoop()
+        self.stats = SimStats()
+        self.convergence_times = Samples(maxlen=None)
+        self.bot = None
+        self.workers = []
+        self.guilds = []
+
+    @contextmanager
+    def _patched_clock(self):
+        # The syncer keeps wall clock timestamps, which have to come from the simulated clock too.
+        real_time = syncer.voice_syncer.time
+        syncer.voice_syncer.time = self.loop.time
+        try:
+            yield
+        finally:
+            syncer.voice_syncer.time = real_time
+
+    @contextmanager
+    def _quiet_simulated_failures(self):
+        # Failed calls make reconciles raise, and the scheduler prints every one of them. Those are expected, and
+        # counted already. Anything else is printed as usual, and counted as a task error.
+        real_print_exc = traceback.print_exc
+
+        def print_exc(*args, **kwargs):
+            if isinstance(sys.exc_info()[1], CallException):
+                return
+
+            self.stats.task_errors += 1
+            real_print_exc(*args, **kwargs)
+
+        traceback.print_exc = print_exc
+        try:
+            yield
+        finally:
+            traceback.print_exc = real_print_exc
+
+    def _handle_exception(self, loop, context):
+        # An exception that nobody handled, from a task or a callback.
+        self.stats.task_errors += 1
+        loop.default_exception_handler(context)
+
+    async def _user(self, guild):
+        config = self.config
+        guild.syncer.connect(guild)
+        guild.command('play', 'song-%s-0' % guild.index)
+
+        song = 1
+        while self.loop.time() < config.command_period:
+            await asyncio.sleep(random.expovariate(config.command_rate))
+            roll = random.random()
+            if roll < 0.6:
+                guild.command('volume', round(random.uniform(0.1, 1.5), 2))
+            elif roll < 0.9:
+                guild.command('play', 'song-%s-%s' % (guild.index, song))
+                song += 1
+            else:
+                guild.command('stop')
+
+    async def _chaos(self):
+        config = self.config
+        for index, at in sorted(config.worker_kills, key=lambda kill: kill[1]):
+            await asyncio.sleep(max(0, at - self.loop.time()))
+            worker = self.workers[index]
+            for guild in self.guilds:
+                client = guild.syncer.state.get('client')
+                if client and client.worker is worker:
+                    guild.disrupt()
+
+            worker.kill()
+            self.loop.call_later(config.worker_down_for, worker.revive)
+
+    async def _monitor(self):
+        while self.loop.time() < self.config.duration:
+            for guild in self.guilds:
+                guild.check()
+
+            last_disruption = max(self.config.command_period, max(at for _, at in self.config.worker_kills or [(0, 0)]))
+            if self.loop.time() > last_disruption and all(guild.converged_at is not None for guild in self.guilds):
+                return
+
+            await asyncio.sleep(0.01)
+
+    async def _run(self):
+        config = self.config
+        self.bot = FakeBot(self, self.loop)
+        self.workers = [FakeWorker(self, i) for i in range(config.workers)]
+        self.guilds = [SimGuild(self, i) for i in range(config.guilds)]
+
+        users = [self.loop.create_task(self._user(guild)) for guild in self.guilds]
+        chaos = self.loop.create_task(self._chaos())
+        await self._monitor()
+
+        for task in users + [chaos]:
+            task.cancel()
+
+    def run(self):
+        random.seed(self.config.seed)
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_exception_handler(self._handle_exception)
+        try:
+            with self._patched_clock(), self._quiet_simulated_failures():
+                self.loop.run_until_complete(self._run())
+
+        finally:
+            asyncio.set_event_loop(None)
+            self.loop.close()
+
+        return self.report()
+
+    def report(self):
+        stats = self.stats
+        unconverged = sum(1 for guild in self.guilds if guild.converged_at is None)
+        return {
+            'simulated_seconds': round(self.loop.time(), 2),
+            'guilds': len(self.guilds),
+            'unconverged_guilds': unconverged,
+            'task_errors': stats.task_errors,
+            'convergence_seconds': self.convergence_times.summary(),
+            'remote_calls': stats.remote_calls,
+            'failed_calls': stats.failed_calls,
+            'wasted_calls': stats.wasted_calls,
+            'joins': stats.joins,
+            'failed_joins': stats.failed_joins,
+            'max_concurrent_joins': stats.max_concurrent_joins,
+            'reconciles': self.bot.syncer_scheduler.reconciles,
+            'reconcile_errors': self.bot.syncer_scheduler.errors,
+            'recovery_seconds': self.bot.syncer_scheduler.recovery_times.summary(),
+        }
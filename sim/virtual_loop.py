@@ -0,0 +1,42 @@
+import asyncio
+import selectors
+
+
+class _VirtualSelector(selectors.SelectSelector):
+    """Never waits on anything, sleeping just moves the loop's clock forward."""
+
+    def __init__(self, clock):
+        super(_VirtualSelector, self).__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError('Nothing left to run, the simulation would wait forever.')
+
+        self.clock.advance(timeout)
+        return []
+
+
+class VirtualClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return self.now
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    An event loop that runs on simulated time: whenever it would block waiting for the next timer, it jumps
+    straight to it. Nothing real can be waited on, only sleeps, timers and futures.
+    """
+
+    def __init__(self):
+        self.clock = VirtualClock()
+        super(VirtualClockLoop, self).__init__(selector=_VirtualSelector(self.clock))
+
+    def time(self):
+        return self.clock.time()
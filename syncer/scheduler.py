@@ -0,0 +1,109 @@
+import asyncio
+import collections
+import traceback
+
+from lib.stats import Samples
+
+
+class SyncerScheduler(object):
+    """
+    Reconciles VoiceStateSyncers that have pending messages, using at most `concurrency` tasks.
+
+    Syncers with nothing to do cost nothing here, tasks only exist while there is dirty work, and a syncer is never
+    reconciled by two tasks at once.
+    """
+
+    def __init__(self, loop, concurrency=32, rejoin_concurrency=8):
+        self.loop = loop
+        self.concurrency = concurrency
+        self.reconciles = 0
+        self.errors = 0
+        # Shared by every syncer, this is what keeps a worker failure from turning into a join stampede.
+        self.rejoin_slots = asyncio.Semaphore(rejoin_concurrency)
+        # How long it took guilds to get a new client after theirs went down.
+        self.recovery_times = Samples()
+
+        self._dirty = collections.deque()
+        self._queued = set()
+        self._running = set()
+        self._tasks = 0
+
+    def schedule(self, syncer):
+        if syncer in self._queued or syncer in self._running:
+            return
+
+        self._queued.add(syncer)
+        self._dirty.append(syncer)
+        self._start_task()
+
+    def _start_task(self):
+        if self._dirty and self._tasks < self.concurrency:
+            self._tasks += 1
+            self.loop.create_task(self._run())
+
+    def rejoin_slot(self):
+        """
+        One of `rejoin_slots`, for use with `async with`. While waiting for one, the reconcile gives its task's place
+        up, so syncers that only have commands to send aren't stuck behind a queue of rejoins.
+        """
+        return RejoinSlot(self)
+
+    async def _run(self):
+        try:
+            # A task that got its place back after waiting on a rejoin slot may have been replaced in the meantime.
+            while self._dirty and self._tasks <= self.concurrency:
+                syncer = self._dirty.popleft()
+                self._queued.discard(syncer)
+                self._running.add(syncer)
+
+                try:
+                    self.reconciles += 1
+                    await syncer.reconcile()
+
+                except Exception:
+                    self.errors += 1
+                    traceback.print_exc()
+
+                finally:
+                    self._running.discard(syncer)
+
+                # Messages that arrived while it was reconciling.
+                if syncer.has_pending:
+                    self.schedule(syncer)
+
+        finally:
+            self._tasks -= 1
+
+    def get_stats(self):
+        return {
+            'dirty': len(self._dirty),
+            'running': len(self._running),
+            'tasks': self._tasks,
+            'reconciles': self.reconciles,
+            'errors': self.errors,
+            'recovery_seconds': self.recovery_times.summary(),
+        }
+
+
+class RejoinSlot(object):
+    __slots__ = ('scheduler',)
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __aenter__(self):
+        scheduler = self.scheduler
+        if not scheduler.rejoin_slots.locked():
+            await scheduler.rejoin_slots.acquire()
+            return
+
+        scheduler._tasks -= 1
+        scheduler._start_task()
+        try:
+            await scheduler.rejoin_slots.acquire()
+
+        finally:
+            scheduler._tasks += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.rejoin_slots.release()
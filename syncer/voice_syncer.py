@@ -1,6 +1,7 @@
+import traceback
 from copy import copy
-import asyncio
 
+from lib.backoff import Backoff
 from lib.event_emitter import EventEmitter
 from time import time
 
@@ -12,6 +13,12 @@ class SyncerState(object):
 
 
 class VoiceStateSyncer(EventEmitter):
+    reconnect_base_delay = 1
+    reconnect_max_delay = 30
+    # After a reconcile fails, its messages are retried after this backoff.
+    retry_base_delay = 0.5
+    retry_max_delay = 30
+
     def __init__(self, player_state):
         super(VoiceStateSyncer, self).__init__()
 
@@ -21,37 +28,59 @@ class VoiceStateSyncer(EventEmitter):
             playback_started_timestamp=None,
             playback_progress=None,
             playback_ref=None,
-            client=None
+            client=None,
+            suspended=False
         )
 
         self.bot = player_state.bot
-        self._loop_task = None
-        self._queue = asyncio.Queue()
-
-    def start(self):
-        if not self._loop_task:
-            self._loop_task = self.bot.loop.create_task(self.main_loop())
-
-        return self
+        self._pending = []
+        self._reconnect_backoff = Backoff(base=self.reconnect_base_delay, maximum=self.reconnect_max_delay)
+        self._retry_backoff = Backoff(base=self.retry_base_delay, maximum=self.retry_max_delay)
+        self._retry_handle = None
 
     def send(self, op, **data):
-        message = dict(op=op, **data)
-        self.bot.loop.call_soon(self._queue.put_nowait, message)
+        # Once halted, the syncer doesn't process anything else.
+        if self.state['fsm_state'] == SyncerState.HALT:
+            return
+
+        self._pending.append(dict(op=op, **data))
+        # While backing off from a failed reconcile, messages wait for the retry.
+        if self._retry_handle is None:
+            self.bot.syncer_scheduler.schedule(self)
 
-    async def main_loop(self):
+    @property
+    def has_pending(self):
+        return bool(self._pending) and self.state['fsm_state'] != SyncerState.HALT and self._retry_handle is None
+
+    async def reconcile(self):
+        # Fold everything that piled up since the last reconcile into a single target state, so that
+        # commands which have already been superseded never make it to the client.
+        items, self._pending = self._pending, []
+        prev_state = copy(self.state)
         try:
-            while True:
-                item = await self._queue.get()
-                prev_state = copy(self.state)
-                # Prev State -> Update -> Next State -> Did Update -> Final State
-                next_state = await self.state_update(prev_state, item)
-                self.state = await self.state_did_update(prev_state, next_state)
+            # Prev State -> Update(s) -> Next State -> Did Update -> Final State
+            next_state = prev_state
+            for item in items:
+                next_state = await self.state_update(next_state, item)
+
+            self.state = await self.state_did_update(prev_state, next_state)
+
+        except Exception:
+            # The state is left as it was, so the same messages (and whatever arrived since) get another go.
+            self._pending[:0] = items
+            self._schedule_retry()
+            raise
 
-                if self.state['fsm_state'] == SyncerState.HALT:
-                    return
+        self._retry_backoff.reset()
 
-        finally:
-            self._loop_task = None
+    def _schedule_retry(self):
+        if self._retry_handle is None:
+            self._retry_handle = self.bot.loop.call_later(self._retry_backoff.delay(), self._retry)
+
+    def _retry(self):
+        self._retry_handle = None
+        if self.has_pending:
+            self.bot.syncer_scheduler.schedule(self)
 
     async def state_did_update(self, prev_state, next_state):
         fsm_state = next_state.get('fsm_state')
@@ -71,26 +100,82 @@ class VoiceStateSyncer(EventEmitter):
     async def state_update(state, data):
         op = data['op']
         if op == 'connect':
-            return dict(state, channel=data['channel'], fsm_state=SyncerState.AWAITING_CLIENT)
+            # Asked for by a user, which is worth a try straight away, backing off or not.
+            state = dict(state, channel=data['channel'], fsm_state=SyncerState.AWAITING_CLIENT)
+            state.pop('retry_at', None)
+            return state
 
         if op == 'down':
-            return dict(state, client=None, fsm_state=SyncerState.AWAITING_CLIENT)
+            return dict(state, client=None, fsm_state=SyncerState.AWAITING_CLIENT, down_at=state.get('down_at') or time())
 
         if op == 'play':
-            return dict(state, playing_url=data['url'], playback_progress=0)
+            progress = data.get('progress') or 0
+            return dict(
+                state,
+                playing_url=data['url'],
+                source_key=data.get('source_key'),
+                codec=data.get('codec'),
+                is_live=data.get('is_live', False),
+                playback_progress=0,
+                start_offset=progress,
+                playback_started_timestamp=time() - progress
+            )
 
         if op == 'stop':
             return dict(state, playing_url=None, playback_started_timestamp=None)
 
+        if op == 'refresh_url':
+            # The same track with a new download url. The client carries on, it only needs it to start the track again.
+            if state.get('playing_url') != data['old_url']:
+                return state
+
+            return dict(state, playing_url=data['url'], refreshed_from=data['old_url'])
+
+        if op == 'preload':
+            return dict(
+                state, next_url=data['url'], next_source_key=data.get('source_key'), next_codec=data.get('codec'),
+                next_is_live=data.get('is_live', False)
+            )
+
+        if op == 'advanced':
+            # The client moved on to the preloaded track by itself. Unless we've asked for something else since.
+            if data['previous_ref'] != state['playback_ref'] or data['url'] != state.get('next_url'):
+                return state
+
+            observed_at = data.get('observed_at') or time()
+            return dict(
+                state,
+                playing_url=data['url'],
+                source_key=state.get('next_source_key'),
+                codec=state.get('next_codec'),
+                is_live=state.get('next_is_live', False),
+                playback_ref=data['playback_ref'],
+                playback_progress=0,
+                start_offset=0,
+                playback_started_timestamp=observed_at,
+                next_url=None,
+                next_source_key=None,
+                next_codec=None,
+                next_is_live=False,
+                handoff_url=data['url']
+            )
+
         if op == 'volume':
             return dict(state, volume=data['volume'])
 
         if op == 'playback_progress':
             if data['playback_ref'] == state['playback_ref']:
-                return dict(state, playback_started_timestamp=time() - data['playback_progress'])
+                observed_at = data.get('observed_at') or time()
+                return dict(state, playback_started_timestamp=observed_at - data['playback_progress'])
 
             return state
 
+        if op == 'suspend':
+            return dict(state, suspended=True)
+
+        if op == 'unsuspend':
+            return dict(state, suspended=False)
+
         if op == 'halt':
             return dict(state, fsm_state=SyncerState.HALT)
 
@@ -99,27 +184,54 @@ class VoiceStateSyncer(EventEmitter):
     async def state_do_connect(self, prev_state, next_state):
         # FSM Wants a client, so let's try and get one.
 
+        # We're backing off from a failed attempt, other messages shouldn't make us retry any sooner.
+        if next_state.get('timeout') and next_state.get('retry_at', 0) > self.bot.loop.time():
+            return next_state
+
+        next_state.pop('retry_at', None)
         timeout = next_state.pop('timeout', None)
         if timeout:
             timeout.cancel()
 
         old_client = next_state.pop('client', None)
         if old_client:
-            await old_client.disconnect()
+            await self.disconnect_client(old_client)
 
-        client = await self.bot.join_voice_channel(next_state['channel'])
+        scheduler = self.bot.syncer_scheduler
+        client = None
+        try:
+            # When a worker goes down, every guild on it lands here at once, so only so many may join at a time.
+            async with scheduler.rejoin_slot():
+                client = await self.bot.join_voice_channel(next_state['channel'])
+
+        except Exception:
+            traceback.print_exc()
 
         if client:
+            self._reconnect_backoff.reset()
+            down_at = next_state.pop('down_at', None)
+            if down_at is not None:
+                scheduler.recovery_times.add(time() - down_at)
+
             client.once('remote:down', self._down)
             client.on('playback:progress', self._sync_playback_progress)
+            client.on('playback:advanced', self._sync_playback_advanced)
             self.emit('client:connected', client)
-            return await self.state_do_sync(
-                prev_state,
-                dict(next_state, client=client, playback_ref=None, fsm_state=SyncerState.CONNECTED)
-            )
-
-        timeout = self.bot.loop.call_later(2, self.send, 'progress')
-        return dict(next_state, timeout=timeout)
+            try:
+                return await self.state_do_sync(
+                    prev_state,
+                    dict(next_state, client=client, playback_ref=None, fsm_state=SyncerState.CONNECTED)
+                )
+
+            except Exception:
+                # The reconcile is rolled back, and nothing would remember this client, which would be left
+                # connected on its worker. The retry joins again.
+                await self.disconnect_client(client)
+                raise
+
+        delay = self._reconnect_backoff.delay()
+        timeout = self.bot.loop.call_later(delay, self.send, 'progress')
+        return dict(next_state, timeout=timeout, retry_at=self.bot.loop.time() + delay)
 
     @staticmethod
     async def state_do_halt(prev_state, next_state):
@@ -130,10 +242,19 @@ class VoiceStateSyncer(EventEmitter):
 
         old_client = next_state.pop('client', None)
         if old_client:
-            await old_client.disconnect()
+            await VoiceStateSyncer.disconnect_client(old_client)
 
         return next_state
 
+    @staticmethod
+    async def disconnect_client(client):
+        # A client we're letting go of is usually on a worker that's gone, which mustn't stop us from moving on.
+        try:
+            await client.disconnect()
+
+        except Exception:
+            traceback.print_exc()
+
     @staticmethod
     async def state_do_sync(prev_state, next_state):
         # FSM Wants us to sync the state.
@@ -141,25 +262,104 @@ class VoiceStateSyncer(EventEmitter):
         next_url = next_state.get('playing_url')
         next_volume = next_state.get('volume')
         client = next_state['client']
+        is_new_client = prev_state.get('client') != client
+
+        # The worker plays the preloaded track by itself when the current one ends, so it's always kept up to date.
+        next_preload = next_state.get('next_url')
+        if next_preload != prev_state.get('next_url') or (is_new_client and next_preload):
+            await client.preload(
+                next_preload, next_state.get('next_source_key'), next_state.get('next_codec'),
+                next_state.get('next_is_live', False)
+            )
+
+        # The download url of what's playing was swapped for a fresh one. The worker carries on as it is, and uses
+        # the new one the next time it has to start the track again, suspended or not.
+        if 'refreshed_from' in next_state:
+            next_state = dict(next_state)
+            refreshed_from = next_state.pop('refreshed_from')
+            if refreshed_from == prev_url and not is_new_client:
+                await client.refresh_url(refreshed_from, next_url)
+                prev_url = next_url
+
+            if next_state.get('suspended_url') == refreshed_from:
+                next_state['suspended_url'] = next_url
+
+        # Nobody is listening, so the worker shouldn't be decoding anything. Remember where we were.
+        if next_state.get('suspended'):
+            if 'suspended_url' in next_state:
+                return next_state
+
+            # Only a client that was playing, and was told to suspend, remembers the track. Any other has to be
+            # told to play it again once we unsuspend.
+            suspended_state = dict(
+                next_state,
+                suspended_url=prev_url,
+                suspended_client=None,
+                suspended_progress=VoiceStateSyncer.estimate_progress(next_state),
+                playback_started_timestamp=None
+            )
+            if prev_url and not is_new_client:
+                suspended_state['suspended_client'] = client
+                position = await client.suspend()
+                if position is not None:
+                    suspended_state['suspended_progress'] = position
+
+            return suspended_state
+
+        if 'suspended_url' in next_state:
+            next_state = dict(next_state)
+            suspended_url = next_state.pop('suspended_url')
+            suspended_client = next_state.pop('suspended_client')
+            suspended_progress = next_state.pop('suspended_progress')
+            if next_url and next_url == suspended_url:
+                next_state['playback_started_timestamp'] = time() - (suspended_progress or 0)
+
+                # The worker still remembers the track, so it can pick up from the same spot by itself.
+                if suspended_client == client:
+                    await client.unsuspend(next_volume)
+                    return next_state
+
+                prev_state = dict(prev_state, playing_url=None)
+                is_new_client = True
+
+            else:
+                # What we play or stop next takes the worker out of suspension.
+                prev_state = dict(prev_state, playing_url=suspended_url)
+
+            prev_url = prev_state.get('playing_url')
+
+        # The client is already playing this, it got there by itself.
+        if 'handoff_url' in next_state:
+            next_state = dict(next_state)
+            if next_state.pop('handoff_url') == next_url and not is_new_client:
+                prev_url = next_url
 
         # We don't have a URL, so we should stop.
         if not next_url and prev_url:
             await client.stop()
             return dict(next_state, playing_url=None, playback_ref=None)
 
-        is_new_client = prev_state.get('client') != client
         # We have a next url, or the client changed, so we should tell the client to play the new URL.
         if next_url and (prev_url != next_url or is_new_client):
             if not is_new_client:
-                estimated_progress = 0
+                estimated_progress = next_state.get('start_offset') or 0
             else:
-                estimated_progress = time() - (next_state.get('playback_started_timestamp', None) or time())
+                estimated_progress = VoiceStateSyncer.estimate_progress(next_state)
+
+            # A new client has to pick up where the last one was. Tell it when playback started on its own
+            # clock, so it can work out the position when it actually starts, RPC latency included.
+            started_at = None
+            if is_new_client:
+                started_at = client.to_remote_time(time() - estimated_progress)
 
-            playback_ref = await client.play(next_volume, next_url, estimated_progress)
+            playback_ref = await client.play(
+                next_volume, next_url, estimated_progress, source_key=next_state.get('source_key'),
+                started_at=started_at, codec=next_state.get('codec'), is_live=next_state.get('is_live', False)
+            )
             new_state = dict(next_state, playback_ref=playback_ref)
 
             if not is_new_client:
-                new_state['playback_started_timestamp'] = time()
+                new_state['playback_started_timestamp'] = time() - estimated_progress
 
             return new_state
 
@@ -170,10 +370,19 @@ class VoiceStateSyncer(EventEmitter):
         return next_state
 
     def connect(self, channel):
+        self._reconnect_backoff.reset()
         self.send('connect', channel=channel)
 
-    def play(self, url):
-        self.send('play', url=url)
+    def play(self, url, source_key=None, progress=0, codec=None, is_live=False):
+        self.send('play', url=url, source_key=source_key, progress=progress, codec=codec, is_live=is_live)
+
+    def refresh_url(self, old_url, url):
+        """Swaps the download url of what's playing for a fresh one, without interrupting playback."""
+        self.send('refresh_url', old_url=old_url, url=url)
+
+    def preload(self, url=None, source_key=None, codec=None, is_live=False):
+        """Tells the client what to play as soon as the current track ends, so it doesn't have to wait on us."""
+        self.send('preload', url=url, source_key=source_key, codec=codec, is_live=is_live)
 
     def volume(self, volume):
         self.send('volume', volume=volume)
@@ -184,8 +393,25 @@ class VoiceStateSyncer(EventEmitter):
     def _down(self, reason=None):
         self.send('down')
 
-    def _sync_playback_progress(self, playback_ref, playback_progress):
-        self.send('playback_progress', playback_ref=playback_ref, playback_progress=playback_progress)
+    def _sync_playback_progress(self, playback_ref, playback_progress, timestamp=None):
+        # The worker tells us when it measured the position on its clock, which we turn into ours.
+        client = self.state.get('client')
+        observed_at = client.to_local_time(timestamp) if client and timestamp else time()
+        self.send(
+            'playback_progress', playback_ref=playback_ref, playback_progress=playback_progress,
+            observed_at=observed_at
+        )
+
+    def _sync_playback_advanced(self, previous_ref, playback_ref, download_url):
+        self.send(
+            'advanced', previous_ref=previous_ref, playback_ref=playback_ref, url=download_url, observed_at=time()
+        )
+
+    def suspend(self):
+        self.send('suspend')
+
+    def unsuspend(self):
+        self.send('unsuspend')
 
     def disconnect(self):
         self.send('halt')
@@ -198,6 +424,17 @@ class VoiceStateSyncer(EventEmitter):
     def playback_ref(self):
         return self.state.get('playback_ref')
 
+    @property
+    def suspended(self):
+        return self.state.get('suspended', False)
+
+    @staticmethod
+    def estimate_progress(state):
+        if state.get('suspended_progress') is not None:
+            return state['suspended_progress']
+
+        return time() - (state.get('playback_started_timestamp', None) or time())
+
     @property
     def estimated_progress(self):
-        return time() - (self.state.get('playback_started_timestamp', None) or time())
\ No newline at end of file
+        return self.estimate_progress(self.state)
\ No newline at end of file
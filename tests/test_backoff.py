@@ -0,0 +1,34 @@
+import random
+import unittest
+
+from lib.backoff import Backoff
+
+
+class BackoffTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+
+    def test_delays_stay_under_a_growing_cap(self):
+        backoff = Backoff(base=1, maximum=30, factor=2)
+        for cap in (1, 2, 4, 8, 16, 30, 30, 30):
+            delay = backoff.delay()
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, cap)
+
+    def test_delays_are_jittered(self):
+        backoff = Backoff(base=10, maximum=10)
+        delays = {backoff.delay() for _ in range(20)}
+        self.assertGreater(len(delays), 1)
+
+    def test_reset_starts_over_from_the_base(self):
+        backoff = Backoff(base=1, maximum=1000, factor=10)
+        for _ in range(5):
+            backoff.delay()
+
+        backoff.reset()
+        self.assertEqual(backoff.attempts, 0)
+        self.assertLessEqual(backoff.delay(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import asyncio
+import gc
+import unittest
+
+from lib.event_emitter import EventEmitter
+
+
+class Listener(object):
+    def __init__(self):
+        self.calls = []
+
+    def on_event(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+
+class EventEmitterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.emitter = EventEmitter()
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_listeners_get_the_arguments_in_order(self):
+        calls = []
+        self.emitter.on('event', lambda *args, **kwargs: calls.append(('first', args, kwargs)))
+        self.emitter.on('event', lambda *args, **kwargs: calls.append(('second', args, kwargs)))
+        self.emitter.emit('event', 1, key='value')
+
+        self.assertEqual(calls, [('first', (1,), {'key': 'value'}), ('second', (1,), {'key': 'value'})])
+        self.assertEqual(self.emitter.emit_counts['event'], 1)
+
+    def test_once_is_only_called_once(self):
+        calls = []
+        self.emitter.once('event', calls.append)
+        self.emitter.emit('event', 1)
+        self.emitter.emit('event', 2)
+
+        self.assertEqual(calls, [1])
+        self.assertNotIn('event', self.emitter._events)
+
+    def test_off_and_cancel_remove_listeners(self):
+        calls = []
+        self.emitter.on('event', calls.append)
+        subscription = self.emitter.on('event', lambda value: calls.append(-value))
+        self.emitter.off('event', calls.append)
+        subscription.cancel()
+        self.emitter.emit('event', 1)
+
+        self.assertEqual(calls, [])
+        with self.assertRaises(ValueError):
+            self.emitter.off('event', calls.append)
+
+    def test_listener_removed_while_emitting_is_still_called_this_time(self):
+        calls = []
+        second = None
+
+        def first(value):
+            calls.append('first')
+            second.cancel()
+
+        self.emitter.on('event', first)
+        second = self.emitter.on('event', lambda value: calls.append('second'))
+        self.emitter.emit('event', 1)
+        self.emitter.emit('event', 2)
+
+        self.assertEqual(calls, ['first', 'second', 'first'])
+
+    def test_failing_listener_doesnt_stop_the_rest(self):
+        calls = []
+        self.emitter.on('event', lambda value: 1 / 0)
+        self.emitter.on('event', calls.append)
+        self.emitter.emit('event', 1)
+
+        self.assertEqual(calls, [1])
+
+    def test_coroutine_listeners_are_scheduled(self):
+        calls = []
+
+        async def listener(value):
+            calls.append(value)
+
+        self.emitter.on('event', listener)
+        self.emitter.emit('event', 1)
+        self.assertEqual(calls, [])
+
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(calls, [1])
+
+    def test_weak_bound_method_goes_away_with_its_object(self):
+        listener = Listener()
+        self.emitter.on('event', listener.on_event, weak=True)
+        self.emitter.emit('event', 1)
+        self.assertEqual(listener.calls, [((1,), {})])
+
+        del listener
+        gc.collect()
+        self.emitter.emit('event', 2)
+        self.assertNotIn('event', self.emitter._events)
+
+    def test_weak_bound_method_can_be_removed_with_off(self):
+        listener = Listener()
+        self.emitter.on('event', listener.on_event, weak=True)
+        self.emitter.off('event', listener.on_event)
+        self.emitter.emit('event', 1)
+
+        self.assertEqual(listener.calls, [])
+
+    def test_scope_removes_all_its_subscriptions(self):
+        calls = []
+        scope = self.emitter.scope()
+        scope.on('one', calls.append)
+        scope.once('two', calls.append)
+        self.emitter.on('one', lambda value: calls.append('kept'))
+        scope.close()
+        self.emitter.emit('one', 1)
+        self.emitter.emit('two', 2)
+
+        self.assertEqual(calls, ['kept'])
+
+
+if __name__ == '__main__':
+    unittest.main()
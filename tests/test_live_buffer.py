@@ -0,0 +1,131 @@
+import os
+import unittest
+
+from voice.live_buffer import LiveBuffer
+
+FRAME_SIZE = 4
+
+
+class FakeProcess(object):
+    """A decoder whose output is written by the test."""
+
+    def __init__(self, data=b'', ended=False):
+        read_fd, self._write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self.killed = False
+        if data:
+            self.write(data)
+
+        if ended:
+            self.end()
+
+    def write(self, data):
+        os.write(self._write_fd, data)
+
+    def end(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def kill(self):
+        self.killed = True
+        self.end()
+
+    def wait(self):
+        pass
+
+
+def frames(*names):
+    return b''.join(name * FRAME_SIZE for name in names)
+
+
+class LiveBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.respawns = []
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.end()
+            process.stdout.close()
+
+    def make_process(self, *args, **kwargs):
+        process = FakeProcess(*args, **kwargs)
+        self.processes.append(process)
+        return process
+
+    def make_buffer(self, process, **kwargs):
+        kwargs.setdefault('prebuffer_frames', 3)
+        kwargs.setdefault('rebuffer_frames', 2)
+        return LiveBuffer(process, FRAME_SIZE, lambda buffer, attempt: self.respawns.append(attempt), **kwargs)
+
+    def test_playback_waits_for_the_prebuffer(self):
+        process = self.make_process(frames(b'a', b'b'))
+        buffer = self.make_buffer(process)
+        self.assertIsNone(buffer.read(FRAME_SIZE))
+
+        process.write(frames(b'c'))
+        self.assertEqual([buffer.read(FRAME_SIZE) for _ in range(3)], [frames(b'a'), frames(b'b'), frames(b'c')])
+
+    def test_running_dry_waits_for_the_rebuffer(self):
+        process = self.make_process(frames(b'a', b'b', b'c'))
+        buffer = self.make_buffer(process)
+        for _ in range(3):
+            buffer.read(FRAME_SIZE)
+
+        self.assertIsNone(buffer.read(FRAME_SIZE))
+        self.assertEqual(buffer.underruns, 1)
+
+        process.write(frames(b'd'))
+        self.assertIsNone(buffer.read(FRAME_SIZE))
+        process.write(frames(b'e'))
+        self.assertEqual(buffer.read(FRAME_SIZE), frames(b'd'))
+        self.assertTrue(buffer.get_stats()['depth_ms'] > 0)
+
+    def test_decoder_exit_is_respawned_and_the_buffer_keeps_playing(self):
+        process = self.make_process(frames(b'a', b'b', b'c') + b'xx', ended=True)
+        buffer = self.make_buffer(process)
+        self.assertEqual(buffer.read(FRAME_SIZE), frames(b'a'))
+        self.assertEqual(self.respawns, [0])
+
+        new_process = self.make_process(frames(b'd'))
+        buffer.attach(new_process)
+        self.assertEqual(buffer.read(FRAME_SIZE), frames(b'b'))
+        self.assertTrue(process.killed)
+        self.assertEqual(buffer.reconnects, 1)
+
+        # The half sample the old decoder left behind was dropped, so the new one's frames line up.
+        self.assertEqual(buffer.read(FRAME_SIZE), frames(b'c'))
+        self.assertEqual(buffer.read(FRAME_SIZE), frames(b'd'))
+
+    def test_gives_up_after_too_many_empty_reconnects(self):
+        buffer = self.make_buffer(self.make_process(ended=True), max_reconnects=2)
+        self.assertIsNone(buffer.read(FRAME_SIZE))
+        for _ in range(2):
+            buffer.attach(self.make_process(ended=True))
+            buffer.read(FRAME_SIZE)
+
+        self.assertEqual(self.respawns, [1, 2])
+        self.assertTrue(buffer.gave_up)
+        self.assertEqual(buffer.read(FRAME_SIZE), b'')
+
+    def test_failed_respawn_counts_as_an_empty_reconnect(self):
+        buffer = self.make_buffer(self.make_process(ended=True), max_reconnects=1)
+        buffer.read(FRAME_SIZE)
+        buffer.respawn_failed()
+        buffer.read(FRAME_SIZE)
+
+        self.assertEqual(self.respawns, [1])
+        self.assertTrue(buffer.gave_up)
+
+    def test_decoder_attached_after_close_is_killed(self):
+        buffer = self.make_buffer(self.make_process())
+        buffer.close()
+        late_process = self.make_process()
+        buffer.attach(late_process)
+
+        self.assertTrue(late_process.killed)
+
+
+if __name__ == '__main__':
+    unittest.main()
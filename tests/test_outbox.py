@@ -0,0 +1,115 @@
+import asyncio
+import unittest
+
+from bot.outbox import MessageOutbox
+from sim.virtual_loop import VirtualClockLoop
+
+
+class FakeChannel(object):
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class MessageOutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+        self.sent = []
+        self.fail_sends = 0
+        self.channel = FakeChannel('1')
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    async def send_message(self, channel, message):
+        if self.fail_sends:
+            self.fail_sends -= 1
+            raise RuntimeError('simulated failure')
+
+        self.sent.append((round(self.loop.time(), 3), channel.id, message))
+
+    def make_outbox(self, **kwargs):
+        return MessageOutbox(self.loop, self.send_message, **kwargs)
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_messages_close_together_are_sent_as_one(self):
+        outbox = self.make_outbox()
+        outbox.send(self.channel, 'one')
+        outbox.send(self.channel, 'two')
+        self.run_for(1)
+
+        self.assertEqual(self.sent, [(0.5, '1', 'one\ntwo')])
+        self.assertEqual(outbox.coalesced, 1)
+
+    def test_keyed_message_replaces_the_queued_one(self):
+        outbox = self.make_outbox()
+        outbox.send(self.channel, 'Playing a', key='playing')
+        outbox.send(self.channel, 'Queued c')
+        outbox.send(self.channel, 'Playing b', key='playing')
+        self.run_for(1)
+
+        self.assertEqual([message for _, _, message in self.sent], ['Queued c\nPlaying b'])
+        self.assertEqual(outbox.superseded, 1)
+
+    def test_channel_rate_limit_holds_messages_back_and_coalesces_them(self):
+        outbox = self.make_outbox(channel_rate=2, channel_per=5)
+        for at, message in ((0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')):
+            self.loop.call_later(at, outbox.send, self.channel, message)
+
+        self.run_for(10)
+        self.assertEqual(self.sent, [(0.5, '1', 'a'), (1.5, '1', 'b'), (5.5, '1', 'c\nd')])
+
+    def test_channels_are_queued_separately(self):
+        outbox = self.make_outbox(channel_rate=1, channel_per=5)
+        outbox.send(self.channel, 'one')
+        outbox.send(FakeChannel('2'), 'two')
+        self.run_for(1)
+
+        self.assertEqual(sorted(self.sent), [(0.5, '1', 'one'), (0.5, '2', 'two')])
+
+    def test_oldest_messages_are_dropped_past_max_queued(self):
+        outbox = self.make_outbox(max_queued=2)
+        for message in ('a', 'b', 'c'):
+            outbox.send(self.channel, message)
+
+        self.assertEqual(outbox.depth(self.channel), 2)
+        self.run_for(1)
+        self.assertEqual([message for _, _, message in self.sent], ['b\nc'])
+        self.assertEqual(outbox.dropped, 1)
+
+    def test_messages_are_split_at_the_length_limit(self):
+        outbox = self.make_outbox()
+        outbox.max_message_length = 10
+        for message in ('aaaa', 'bbbb', 'cccc'):
+            outbox.send(self.channel, message)
+
+        self.run_for(1)
+        self.assertEqual([message for _, _, message in self.sent], ['aaaa\nbbbb', 'cccc'])
+
+    def test_failed_send_is_counted_and_the_queue_carries_on(self):
+        outbox = self.make_outbox()
+        outbox.max_message_length = 4
+        self.fail_sends = 1
+        outbox.send(self.channel, 'one')
+        outbox.send(self.channel, 'two')
+        self.run_for(1)
+
+        self.assertEqual([message for _, _, message in self.sent], ['two'])
+        self.assertEqual(outbox.errors, 1)
+        self.assertEqual(outbox.get_stats()['sent'], 1)
+
+    def test_idle_channel_queue_is_discarded(self):
+        outbox = self.make_outbox(channel_per=5)
+        outbox.send(self.channel, 'one')
+        self.run_for(1)
+        self.assertEqual(outbox.get_stats()['channels'], 1)
+
+        self.run_for(10)
+        self.assertEqual(outbox.get_stats()['channels'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
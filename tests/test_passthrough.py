@@ -0,0 +1,119 @@
+import struct
+import unittest
+
+from voice.passthrough import OggOpusReader, PassthroughUnsupported, opus_packet_duration
+
+# TOC bytes for single frame CELT packets.
+TOC_20MS = bytes([31 << 3])
+TOC_10MS = bytes([30 << 3])
+
+
+def ogg_page(*packets, continued=False):
+    """An ogg page holding the packets, the last one left open (to carry on into the next page) if it's a tuple."""
+    lacing = bytearray()
+    body = bytearray()
+    for packet in packets:
+        open_ended = isinstance(packet, tuple)
+        if open_ended:
+            packet = packet[0]
+
+        size = len(packet)
+        while size >= 255:
+            lacing.append(255)
+            size -= 255
+
+        if not open_ended:
+            lacing.append(size)
+
+        body += packet
+
+    header = b'OggS' + struct.pack('<BBqIIIB', 0, 1 if continued else 0, 0, 1, 0, 0, len(lacing))
+    return header + bytes(lacing) + bytes(body)
+
+
+class FakeSource(object):
+    """The parts of a PipeReader the reader uses, fed by hand."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.eof = False
+
+    def feed(self, data):
+        self.buffer += data
+
+    def fill(self):
+        pass
+
+    def peek(self, size):
+        if len(self.buffer) < size:
+            return None
+
+        return bytes(self.buffer[:size])
+
+    def skip(self, size):
+        del self.buffer[:size]
+
+
+HEADERS = ogg_page(b'OpusHead' + b'\0' * 11) + ogg_page(b'OpusTags' + b'\0' * 8)
+
+
+class OpusPacketDurationTest(unittest.TestCase):
+    def test_frame_counts(self):
+        self.assertEqual(opus_packet_duration(TOC_20MS + b'x'), 200)
+        # Code 1 and 2 packets have two frames.
+        self.assertEqual(opus_packet_duration(bytes([30 << 3 | 1]) + b'x'), 200)
+        # Code 3 packets say how many frames they have.
+        self.assertEqual(opus_packet_duration(bytes([16 << 3 | 3, 4]) + b'x'), 100)
+
+    def test_truncated_code_3_packet(self):
+        with self.assertRaises(PassthroughUnsupported):
+            opus_packet_duration(bytes([16 << 3 | 3]))
+
+
+class OggOpusReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.source = FakeSource()
+        self.reader = OggOpusReader(self.source)
+
+    def test_headers_are_skipped_and_packets_read_in_order(self):
+        self.source.feed(HEADERS + ogg_page(TOC_20MS + b'one', TOC_20MS + b'two'))
+
+        self.assertEqual(self.reader.read(), TOC_20MS + b'one')
+        self.assertEqual(self.reader.read(), TOC_20MS + b'two')
+        self.assertIsNone(self.reader.read())
+
+        self.source.eof = True
+        self.assertEqual(self.reader.read(), b'')
+
+    def test_page_that_hasnt_all_arrived_is_left_for_later(self):
+        page = ogg_page(TOC_20MS + b'one')
+        self.source.feed(HEADERS + page[:-1])
+        self.assertIsNone(self.reader.read())
+
+        self.source.feed(page[-1:])
+        self.assertEqual(self.reader.read(), TOC_20MS + b'one')
+
+    def test_packet_carrying_on_into_the_next_page(self):
+        packet = TOC_20MS + b'x' * 599
+        self.source.feed(HEADERS + ogg_page((packet[:510],)) + ogg_page(packet[510:], continued=True))
+
+        self.assertEqual(self.reader.read(), packet)
+
+    def test_not_an_opus_stream(self):
+        self.source.feed(ogg_page(b'\x01vorbis') + ogg_page(TOC_20MS + b'one'))
+        with self.assertRaises(PassthroughUnsupported):
+            self.reader.read()
+
+    def test_lost_sync(self):
+        self.source.feed(HEADERS + b'garbage' + b'\0' * 30)
+        with self.assertRaises(PassthroughUnsupported):
+            self.reader.read()
+
+    def test_packets_of_the_wrong_length(self):
+        self.source.feed(HEADERS + ogg_page(TOC_10MS + b'one'))
+        with self.assertRaises(PassthroughUnsupported):
+            self.reader.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
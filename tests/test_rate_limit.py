@@ -0,0 +1,45 @@
+import unittest
+
+from lib.rate_limit import RateLimit
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.rate_limit = RateLimit(3, 5, clock=self.clock)
+
+    def test_first_count_slots_are_free(self):
+        self.assertEqual([self.rate_limit.reserve() for _ in range(3)], [0, 0, 0])
+
+    def test_next_slot_waits_for_the_window(self):
+        for _ in range(3):
+            self.rate_limit.reserve()
+
+        self.clock.now += 2
+        self.assertEqual(self.rate_limit.reserve(), 3)
+
+    def test_reserved_slots_queue_up_behind_each_other(self):
+        self.assertEqual([self.rate_limit.reserve() for _ in range(7)], [0, 0, 0, 5, 5, 5, 10])
+
+    def test_window_slides(self):
+        self.rate_limit.reserve()
+        self.clock.now += 3
+        self.rate_limit.reserve()
+        self.rate_limit.reserve()
+
+        # Only the first one has left the window by now.
+        self.clock.now += 2
+        self.assertEqual(self.rate_limit.reserve(), 0)
+        self.assertEqual(self.rate_limit.reserve(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
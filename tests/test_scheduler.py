@@ -0,0 +1,38 @@
+import unittest
+from unittest import mock
+
+from voice.scheduler import ScheduledPlayer
+
+
+def make_player(**kwargs):
+    voice_client = mock.Mock()
+    voice_client.encoder.frame_length = 20
+    voice_client.encoder.frame_size = 3840
+    return ScheduledPlayer(mock.Mock(), mock.Mock(), voice_client, **kwargs)
+
+
+class ScheduledPlayerTest(unittest.TestCase):
+    def test_gain_rides_along_with_the_volume(self):
+        player = make_player(gain=2.0)
+        self.assertEqual(player.volume, 2.0)
+
+        player.set_volume(0.5)
+        self.assertEqual(player.volume, 1.0)
+
+    def test_passed_through_packets_play_at_their_own_level(self):
+        player = make_player(passthrough=True, gain=2.0)
+        player.set_volume(1.0)
+
+        self.assertEqual((player.gain, player.volume), (1.0, 1.0))
+
+    def test_stop(self):
+        player = make_player()
+        self.assertFalse(player.stopped or player.released)
+
+        player.stop(release=True)
+        self.assertTrue(player.is_done())
+        self.assertEqual((player.stopped, player.released), (True, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+try:
+    import discord
+except ImportError:
+    discord = None
+
+if discord:
+    from voice.server import Server
+
+
+class FakeWorker(object):
+    """The parts of a ClientHandler that picking a worker looks at."""
+
+    def __init__(self, client_count=0, max_clients=10, refs=0, pending_joins=0, acceptable_regions='all',
+                 region_latency=None):
+        self.client_count = client_count
+        self.remote_info = {'max_clients': max_clients, 'acceptable_regions': acceptable_regions}
+        self.refs = {'ref-%s' % i: None for i in range(refs)}
+        self.pending_joins = {'pending-%s' % i for i in range(pending_joins)}
+        self.region_latency = region_latency or {}
+
+
+@unittest.skipUnless(discord, 'discord.py is not installed')
+class SelectClientTest(unittest.TestCase):
+    def select(self, *workers, region='us-east'):
+        server = Server.__new__(Server)
+        server.clients = list(workers)
+        return server.select_client(region)
+
+    def test_suspended_clients_dont_count_against_a_worker(self):
+        # The worker only counts clients that aren't suspended, the other five refs are idle suspended guilds.
+        suspended = FakeWorker(client_count=1, max_clients=4, refs=6)
+        busy = FakeWorker(client_count=2, max_clients=4, refs=2)
+
+        self.assertIs(self.select(busy, suspended), suspended)
+
+    def test_joins_in_flight_count_against_a_worker(self):
+        joining = FakeWorker(client_count=0, max_clients=2, refs=2, pending_joins=2)
+        other = FakeWorker(client_count=1, max_clients=2, refs=1)
+
+        self.assertIs(self.select(joining, other), other)
+        self.assertIsNone(self.select(joining))
+
+    def test_measured_and_unmeasured_workers_are_ranked_together(self):
+        far = FakeWorker(region_latency={'us-east': {'latency_ms': 250, 'loss': 0}})
+        unmeasured = FakeWorker(acceptable_regions=['us-east'])
+
+        self.assertIs(self.select(far, unmeasured), unmeasured)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import player
+from player.snapshot import PlayerStateSnapshotter, SNAPSHOT_VERSION
+from sim.virtual_loop import VirtualClockLoop
+
+
+class FakeState(object):
+    def __init__(self, record=None):
+        self.record = record
+        self.restored = []
+
+    def snapshot(self):
+        return self.record
+
+    def restore(self, record):
+        self.restored.append(record)
+
+
+class FakeServer(object):
+    def __init__(self, server_id):
+        self.id = server_id
+
+
+class FakeBot(object):
+    def __init__(self, server_ids=(), channel_ids=()):
+        self.servers = {server_id: FakeServer(server_id) for server_id in server_ids}
+        self.channel_ids = set(channel_ids)
+
+    def get_server(self, server_id):
+        return self.servers.get(server_id)
+
+    def get_channel(self, channel_id):
+        return object() if channel_id in self.channel_ids else None
+
+
+def record(voice_channel_id):
+    return {'voice_channel_id': voice_channel_id, 'text_channel_id': None, 'playing_url': None, 'volume': 1.0}
+
+
+class PlayerStateSnapshotterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'player_states.json')
+        self.states = {}
+        patcher = mock.patch.dict(player._player_states, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def make_snapshotter(self, bot=None, **kwargs):
+        return PlayerStateSnapshotter(bot or FakeBot(), path=self.path, **kwargs)
+
+    def write_snapshot(self, guilds, version=None):
+        with open(self.path, 'w') as f:
+            json.dump({'version': version or SNAPSHOT_VERSION, 'taken_at': 0, 'guilds': guilds}, f)
+
+    def get_player_state(self, server, bot=None, create=False):
+        return self.states.setdefault(server.id, FakeState())
+
+    def restore(self, snapshotter):
+        with mock.patch.object(player, 'get_player_state', self.get_player_state):
+            self.loop.run_until_complete(snapshotter.restore())
+
+    def test_nothing_is_saved_until_the_old_snapshot_is_restored(self):
+        self.write_snapshot({'1': record('10')})
+        player._player_states['2'] = FakeState(record('20'))
+        snapshotter = self.make_snapshotter()
+
+        self.assertEqual(snapshotter.save(), 0)
+        self.assertEqual(snapshotter.load(), {'1': record('10')})
+
+    def test_save_and_load(self):
+        player._player_states['1'] = FakeState(record('10'))
+        player._player_states['2'] = FakeState(None)
+        snapshotter = self.make_snapshotter()
+        self.restore(snapshotter)
+
+        self.assertEqual(snapshotter.save(), 1)
+        self.assertEqual(snapshotter.load(), {'1': record('10')})
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_missing_corrupt_or_old_snapshots_load_as_empty(self):
+        snapshotter = self.make_snapshotter()
+        self.assertEqual(snapshotter.load(), {})
+
+        self.write_snapshot({'1': record('10')}, version=SNAPSHOT_VERSION + 1)
+        self.assertEqual(snapshotter.load(), {})
+
+        with open(self.path, 'w') as f:
+            f.write('{"version": 1, "guil')
+        self.assertEqual(snapshotter.load(), {})
+
+    def test_restore_in_batches_skipping_guilds_that_are_gone(self):
+        guilds = {str(i): record(str(i * 10)) for i in range(1, 6)}
+        self.write_snapshot(guilds)
+        # Guild 4 has left, and guild 5's voice channel was deleted.
+        bot = FakeBot(server_ids=['1', '2', '3', '5'], channel_ids=['10', '20', '30', '40'])
+        snapshotter = self.make_snapshotter(bot, restore_batch_size=2, restore_batch_interval=2)
+        self.restore(snapshotter)
+
+        self.assertEqual(sorted(self.states), ['1', '2', '3'])
+        self.assertEqual(self.states['1'].restored, [record('10')])
+        self.assertEqual(self.loop.time(), 4)
+
+    def test_restore_only_runs_once(self):
+        self.write_snapshot({'1': record('10')})
+        snapshotter = self.make_snapshotter(FakeBot(server_ids=['1'], channel_ids=['10']))
+        self.restore(snapshotter)
+        self.restore(snapshotter)
+
+        self.assertEqual(len(self.states['1'].restored), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
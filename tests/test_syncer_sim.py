@@ -0,0 +1,28 @@
+import io
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+from sim.syncer_sim import SimConfig, Simulation
+from syncer.voice_syncer import VoiceStateSyncer
+
+
+class SimulationTest(unittest.TestCase):
+    def test_every_guild_converges(self):
+        for seed in (1, 2, 3):
+            report = Simulation(SimConfig(guilds=100, seed=seed, call_failure_rate=0.05)).run()
+            self.assertEqual(report['unconverged_guilds'], 0, 'seed %s: %r' % (seed, report))
+            self.assertEqual(report['task_errors'], 0, 'seed %s: %r' % (seed, report))
+
+    def test_unexpected_exceptions_are_counted(self):
+        config = SimConfig(guilds=5, call_failure_rate=0, worker_kills=[], duration=5)
+        with mock.patch.object(VoiceStateSyncer, 'estimate_progress', side_effect=ValueError('bug')), \
+                redirect_stderr(io.StringIO()) as stderr:
+            report = Simulation(config).run()
+
+        self.assertGreater(report['task_errors'], 0)
+        self.assertIn('ValueError: bug', stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import player
+from player.ytdl import ExtractedInfo, ExtractedPlaylist, ExtractionError
+from sim.virtual_loop import VirtualClockLoop
+
+
+def make_info(url):
+    info = ExtractedInfo()
+    info.download_url = 'https://media.example.com/%s.webm' % url
+    info.url = url
+    return info
+
+
+class TrackQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+        self.extracted = []
+        self.resolved = []
+        patcher = mock.patch.object(player, 'extract_info', self.extract_info)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    async def extract_info(self, loop, url, *, ytdl_options=None, refresh=False, **kwargs):
+        self.extracted.append(url)
+        await asyncio.sleep(1)
+        if url.startswith('bad'):
+            raise ExtractionError('simulated failure')
+
+        return make_info(url)
+
+    def make_queue(self, urls, first=None, lookahead=2):
+        queue = player.TrackQueue(self.loop, lookahead=lookahead, on_resolved=self.resolved.append)
+        queue.extend(ExtractedPlaylist([(url, url.title()) for url in urls], first=first))
+        return queue
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_only_the_lookahead_is_resolved(self):
+        queue = self.make_queue(['a', 'b', 'c', 'd'])
+        self.run_for(5)
+
+        self.assertEqual(self.extracted, ['a', 'b'])
+        self.assertEqual([track.url for track in self.resolved], ['a', 'b'])
+        self.assertTrue(queue.peek().is_ready)
+
+    def test_popping_resolves_the_next_one(self):
+        queue = self.make_queue(['a', 'b', 'c', 'd'])
+        self.run_for(5)
+        track = queue.pop()
+        self.run_for(5)
+
+        self.assertEqual(track.url, 'a')
+        self.assertEqual(self.extracted, ['a', 'b', 'c'])
+        self.assertEqual(len(queue), 3)
+
+    def test_already_resolved_first_track_isnt_extracted_again(self):
+        first = make_info('a')
+        queue = self.make_queue(['a', 'b'], first=first)
+        self.run_for(5)
+
+        self.assertIs(queue.peek().info, first)
+        self.assertEqual(self.extracted, ['b'])
+
+    def test_expired_track_is_resolved_again(self):
+        expired = make_info('a')
+        expired.download_url = 'https://example.googlevideo.com/videoplayback?expire=1'
+        queue = self.make_queue(['a'], first=expired)
+        self.assertTrue(self.loop.run_until_complete(queue.resolve(queue.peek())))
+
+        self.assertEqual(self.extracted, ['a'])
+        self.assertIsNot(queue.peek().info, expired)
+
+    def test_failed_track_is_marked_and_not_retried(self):
+        queue = self.make_queue(['bad', 'b'])
+        track = queue.peek()
+        self.assertFalse(self.loop.run_until_complete(queue.resolve(track)))
+        self.assertFalse(self.loop.run_until_complete(queue.resolve(track)))
+
+        self.assertTrue(track.failed)
+        self.assertEqual(self.extracted, ['bad', 'b'])
+
+    def test_clear_cancels_resolving_tracks(self):
+        queue = self.make_queue(['a', 'b'])
+        self.run_for(0.5)
+        queue.clear()
+        self.run_for(5)
+
+        self.assertEqual(len(queue), 0)
+        self.assertIsNone(queue.pop())
+        self.assertEqual(self.resolved, [])
+
+
+class FakeSyncer(object):
+    playback_ref = None
+
+    def __init__(self):
+        self.played = []
+
+    def on(self, event, listener):
+        pass
+
+    def play(self, url, **kwargs):
+        self.played.append(url)
+
+    def preload(self, url=None, **kwargs):
+        pass
+
+
+class FakePlayerState(object):
+    def __init__(self, loop):
+        self.bot = mock.Mock(loop=loop)
+        self.syncer = FakeSyncer()
+
+    def say(self, message, key=None):
+        pass
+
+
+class PlaylistPagesTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+        patcher = mock.patch.object(player, 'extract_info', self.extract_info)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.playlist = player.Playlist(FakePlayerState(self.loop))
+        # Something is already playing, so what's enqueued stays queued.
+        self.playlist.current = player.QueuedTrack('playing')
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    async def extract_info(self, loop, url, *, ytdl_options=None, refresh=False, **kwargs):
+        return make_info(url)
+
+    def paged(self, *pages):
+        async def next_page():
+            await asyncio.sleep(10)
+            return self.paged(*pages[1:]) if len(pages) > 1 else None
+
+        return ExtractedPlaylist([(url, None) for url in pages[0]], next_page=next_page)
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def queued(self):
+        return [track.url for track in self.playlist.queue]
+
+    def test_first_page_is_queued_while_the_rest_load(self):
+        self.playlist.enqueue(self.paged(['a', 'b'], ['c', 'd'], ['e']))
+        self.run_for(1)
+        self.assertEqual(self.queued(), ['a', 'b'])
+
+        self.run_for(30)
+        self.assertEqual(self.queued(), ['a', 'b', 'c', 'd', 'e'])
+        self.assertIsNone(self.playlist._loading_task)
+
+    def test_whats_enqueued_while_loading_goes_after_the_rest(self):
+        self.playlist.enqueue(self.paged(['a'], ['b']))
+        self.playlist.enqueue(ExtractedPlaylist([('c', None)]))
+        self.run_for(30)
+
+        self.assertEqual(self.queued(), ['a', 'b', 'c'])
+
+    def test_clear_stops_loading(self):
+        self.playlist.enqueue(self.paged(['a'], ['b']))
+        self.run_for(1)
+        self.playlist.clear()
+        self.run_for(30)
+
+        self.assertEqual(self.queued(), [])
+        self.assertIsNone(self.playlist._loading_task)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,322 @@
+import asyncio
+import unittest
+
+from lib.event_emitter import EventEmitter
+from rpc.base import CallException
+from sim.virtual_loop import VirtualClockLoop
+from syncer.scheduler import SyncerScheduler
+from syncer.voice_syncer import VoiceStateSyncer, SyncerState
+
+
+class FakeClient(EventEmitter):
+    def __init__(self, fail_plays=0):
+        super(FakeClient, self).__init__()
+        self.fail_plays = fail_plays
+        self.plays = []
+        self.calls = []
+        self.url = None
+        self.volume = None
+        self.disconnected = False
+
+    async def play(self, volume, url, progress=0, source_key=None, started_at=None, codec=None, is_live=False):
+        await asyncio.sleep(0.01)
+        if self.fail_plays:
+            self.fail_plays -= 1
+            raise CallException('simulated failure')
+
+        self.plays.append(url)
+        self.calls.append('play')
+        self.url = url
+        self.volume = volume
+        return 'ref-%s' % len(self.plays)
+
+    async def preload(self, url=None, source_key=None, codec=None, is_live=False):
+        pass
+
+    async def set_volume(self, volume):
+        self.volume = volume
+
+    async def stop(self):
+        self.calls.append('stop')
+
+    async def refresh_url(self, old_url, download_url):
+        self.calls.append('refresh_url')
+        if self.url == old_url:
+            self.url = download_url
+
+    async def suspend(self):
+        self.calls.append('suspend')
+        return 5
+
+    async def unsuspend(self, volume):
+        self.calls.append('unsuspend')
+
+    async def disconnect(self):
+        self.disconnected = True
+
+    @staticmethod
+    def to_remote_time(timestamp):
+        return timestamp
+
+
+class FakeBot(object):
+    def __init__(self, loop, clients, **scheduler_kwargs):
+        self.loop = loop
+        self.syncer_scheduler = SyncerScheduler(loop, **scheduler_kwargs)
+        self.clients = clients
+        self.joins = 0
+        self.join_delay = 0
+
+    async def join_voice_channel(self, channel):
+        self.joins += 1
+        if self.join_delay:
+            await asyncio.sleep(self.join_delay)
+
+        # None is a join that failed.
+        return self.clients.pop(0)
+
+
+class FakePlayerState(object):
+    def __init__(self, bot):
+        self.bot = bot
+
+
+class ReconcileFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_failed_sync_after_join_is_retried(self):
+        first, second = FakeClient(fail_plays=1), FakeClient()
+        bot = FakeBot(self.loop, [first, second])
+        syncer = VoiceStateSyncer(FakePlayerState(bot))
+
+        syncer.connect('channel')
+        syncer.play('song')
+        syncer.volume(0.5)
+        self.run_for(60)
+
+        # The client that failed to play was let go of rather than leaked, and the retry got everything through.
+        self.assertTrue(first.disconnected)
+        self.assertEqual(bot.joins, 2)
+        self.assertEqual(syncer.fsm_state, SyncerState.CONNECTED)
+        self.assertIs(syncer.state['client'], second)
+        self.assertEqual(second.plays, ['song'])
+        self.assertEqual(second.volume, 0.5)
+        self.assertEqual(bot.syncer_scheduler.errors, 1)
+
+    def test_failed_command_is_retried_by_itself(self):
+        client = FakeClient()
+        bot = FakeBot(self.loop, [client])
+        syncer = VoiceStateSyncer(FakePlayerState(bot))
+        syncer.connect('channel')
+        self.run_for(1)
+
+        client.fail_plays = 2
+        syncer.play('song')
+        self.run_for(60)
+
+        self.assertEqual(bot.joins, 1)
+        self.assertEqual(client.plays, ['song'])
+        self.assertEqual(syncer.state['playing_url'], 'song')
+        self.assertFalse(syncer.has_pending)
+
+    def test_messages_during_backoff_wait_for_the_retry(self):
+        client = FakeClient()
+        bot = FakeBot(self.loop, [client])
+        syncer = VoiceStateSyncer(FakePlayerState(bot))
+        syncer._retry_backoff.base = syncer._retry_backoff.maximum = 10
+        syncer.connect('channel')
+        self.run_for(1)
+
+        client.fail_plays = 1
+        syncer.play('first')
+        self.run_for(0.1)
+        syncer.play('second')
+        self.assertFalse(syncer.has_pending)
+        self.run_for(30)
+
+        self.assertEqual(client.plays, ['second'])
+        self.assertEqual(bot.syncer_scheduler.errors, 1)
+
+
+class RejoinTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_connect_skips_the_backoff(self):
+        client = FakeClient()
+        bot = FakeBot(self.loop, [None, client])
+        syncer = VoiceStateSyncer(FakePlayerState(bot))
+        syncer._reconnect_backoff.delay = lambda: 100
+        syncer.connect('channel')
+        self.run_for(1)
+        self.assertEqual(syncer.fsm_state, SyncerState.AWAITING_CLIENT)
+
+        syncer.connect('channel')
+        self.run_for(1)
+        self.assertEqual(bot.joins, 2)
+        self.assertIs(syncer.state['client'], client)
+
+    def test_waiting_rejoins_dont_hold_up_other_syncers(self):
+        connected_client = FakeClient()
+        bot = FakeBot(self.loop, [connected_client, FakeClient(), FakeClient()], concurrency=2, rejoin_concurrency=1)
+        connected = VoiceStateSyncer(FakePlayerState(bot))
+        connected.connect('channel')
+        self.run_for(1)
+
+        bot.join_delay = 10
+        rejoining = [VoiceStateSyncer(FakePlayerState(bot)) for _ in range(2)]
+        for syncer in rejoining:
+            syncer.connect('channel')
+
+        self.run_for(0.1)
+        # One is joining, the other waiting for its turn, and neither is in the way of a volume change.
+        connected.volume(0.5)
+        self.run_for(1)
+        self.assertEqual(connected_client.volume, 0.5)
+
+        self.run_for(30)
+        self.assertEqual([syncer.fsm_state for syncer in rejoining], [SyncerState.CONNECTED] * 2)
+        self.assertLessEqual(bot.syncer_scheduler.get_stats()['tasks'], 2)
+
+
+class SuspendTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_same_client_resumes_by_itself(self):
+        client = FakeClient()
+        syncer = VoiceStateSyncer(FakePlayerState(FakeBot(self.loop, [client])))
+        syncer.connect('channel')
+        syncer.play('song')
+        self.run_for(1)
+
+        syncer.suspend()
+        self.run_for(1)
+        syncer.unsuspend()
+        self.run_for(1)
+
+        self.assertEqual(client.calls, ['play', 'suspend', 'unsuspend'])
+
+    def test_rejoined_client_is_told_to_play(self):
+        first, second = FakeClient(), FakeClient()
+        syncer = VoiceStateSyncer(FakePlayerState(FakeBot(self.loop, [first, second])))
+        syncer.connect('channel')
+        syncer.play('song')
+        self.run_for(1)
+
+        # The new client never played anything, so it has nothing to suspend, or to resume later.
+        syncer._down()
+        syncer.suspend()
+        self.run_for(1)
+        self.assertIs(syncer.state['client'], second)
+        self.assertEqual(second.calls, [])
+
+        syncer.unsuspend()
+        self.run_for(1)
+        self.assertEqual(second.calls, ['play'])
+        self.assertEqual(second.plays, ['song'])
+
+    def test_client_joined_after_a_suspend_during_backoff_is_told_to_play(self):
+        client = FakeClient()
+        bot = FakeBot(self.loop, [None, client])
+        syncer = VoiceStateSyncer(FakePlayerState(bot))
+        syncer._reconnect_backoff.delay = lambda: 10
+        syncer.connect('channel')
+        syncer.play('song')
+        self.run_for(1)
+
+        syncer.suspend()
+        self.run_for(20)
+        self.assertIs(syncer.state['client'], client)
+        self.assertEqual(client.calls, [])
+
+        syncer.unsuspend()
+        self.run_for(1)
+        self.assertEqual(client.calls, ['play'])
+        self.assertEqual(syncer.state['playing_url'], 'song')
+
+
+class RefreshUrlTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_client_keeps_playing_with_the_new_url(self):
+        client = FakeClient()
+        syncer = VoiceStateSyncer(FakePlayerState(FakeBot(self.loop, [client])))
+        syncer.connect('channel')
+        syncer.play('old')
+        self.run_for(1)
+
+        syncer.refresh_url('old', 'new')
+        self.run_for(1)
+
+        self.assertEqual(client.calls, ['play', 'refresh_url'])
+        self.assertEqual(client.url, 'new')
+        self.assertEqual(syncer.state['playing_url'], 'new')
+
+    def test_refresh_while_suspended_resumes_with_the_new_url(self):
+        client = FakeClient()
+        syncer = VoiceStateSyncer(FakePlayerState(FakeBot(self.loop, [client])))
+        syncer.connect('channel')
+        syncer.play('old')
+        self.run_for(1)
+
+        syncer.suspend()
+        self.run_for(1)
+        syncer.refresh_url('old', 'new')
+        self.run_for(1)
+        syncer.unsuspend()
+        self.run_for(1)
+
+        self.assertEqual(client.calls, ['play', 'suspend', 'refresh_url', 'unsuspend'])
+        self.assertEqual(client.url, 'new')
+
+    def test_rejoined_client_plays_the_new_url(self):
+        first, second = FakeClient(), FakeClient()
+        syncer = VoiceStateSyncer(FakePlayerState(FakeBot(self.loop, [first, second])))
+        syncer.connect('channel')
+        syncer.play('old')
+        self.run_for(1)
+
+        syncer.refresh_url('old', 'new')
+        syncer._down()
+        self.run_for(1)
+
+        self.assertEqual(second.plays, ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
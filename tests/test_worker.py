@@ -0,0 +1,105 @@
+import asyncio
+import unittest
+from unittest import mock
+
+try:
+    import discord
+except ImportError:
+    discord = None
+
+if discord:
+    from voice.loudness import LoudnessMeter, TrackCacheEntry
+    from voice.worker import RemoteVoiceClientWrapper
+
+
+class FakeBuffer(object):
+    frames_read = 100
+
+
+class FakePlayer(object):
+    def __init__(self):
+        self.buff = FakeBuffer()
+        self.delay = 0.02
+        self.released = False
+        self.stopped = False
+
+    def stop(self, release=False):
+        self.stopped = True
+        self.released = release
+
+    def resume(self):
+        pass
+
+
+@unittest.skipUnless(discord, 'discord.py is not installed')
+class RefreshUrlTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.started = []
+        self.wrapper = RemoteVoiceClientWrapper(None, 'ref')
+        self.wrapper._start_player = lambda url, position, playback_ref: self.started.append((url, position))
+        self.wrapper._playback_url = 'old'
+        self.wrapper._playback_ref = 'ref.1'
+
+    def tearDown(self):
+        self.loop.close()
+
+    def refresh(self, old_url, download_url):
+        return self.loop.run_until_complete(self.wrapper.refresh_url(old_url, download_url))
+
+    def test_resume_after_a_release_uses_the_new_url(self):
+        self.wrapper._released_position = 10
+        self.assertTrue(self.refresh('old', 'new'))
+        self.assertEqual(self.started, [])
+
+        self.loop.run_until_complete(self.wrapper.resume())
+        self.assertEqual(self.started, [('new', 10)])
+
+    def test_restart_uses_the_new_url(self):
+        self.wrapper.current_player = FakePlayer()
+        self.refresh('old', 'new')
+        self.wrapper._restart_player()
+
+        self.assertEqual(self.started, [('new', 2)])
+
+    def test_url_of_another_track_is_ignored(self):
+        self.assertFalse(self.refresh('other', 'new'))
+        self.assertEqual(self.wrapper._playback_url, 'old')
+
+
+@unittest.skipUnless(discord, 'discord.py is not installed')
+class PassthroughTest(unittest.TestCase):
+    def setUp(self):
+        self.wrapper = RemoteVoiceClientWrapper(mock.Mock(opus_passthrough=True), 'ref')
+        self.wrapper._codec = 'opus'
+
+    def measured(self, loudness):
+        entry = TrackCacheEntry()
+        entry.loudness = loudness
+        self.wrapper.gain = entry.gain
+        return self.wrapper._can_pass_through(None)
+
+    def test_first_play_is_decoded_to_be_measured(self):
+        self.assertFalse(self.wrapper._can_pass_through(LoudnessMeter()))
+
+    def test_measured_track_within_the_tolerance_is_passed_through(self):
+        # -18 LUFS is the target, so these are within 1 dB of needing no gain at all.
+        self.assertTrue(self.measured(-18.0))
+        self.assertTrue(self.measured(-17.2))
+        self.assertTrue(self.measured(-18.9))
+
+    def test_measured_track_outside_the_tolerance_is_decoded_to_be_normalized(self):
+        self.assertFalse(self.measured(-16.5))
+        self.assertFalse(self.measured(-20.0))
+
+    def test_volume_or_other_codecs_are_decoded(self):
+        self.wrapper.volume = 0.5
+        self.assertFalse(self.measured(-18.0))
+
+        self.wrapper.volume = 1.0
+        self.wrapper._codec = 'vorbis'
+        self.assertFalse(self.measured(-18.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
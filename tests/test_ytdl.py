@@ -0,0 +1,131 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from player import ytdl
+from player.ytdl import ExtractionCache, ExtractedInfo, download_url_expiry, extract_playlist, normalize_query
+
+NOW = 1500000000.0
+
+
+def make_info(download_url='https://media.example.com/audio.webm'):
+    info = ExtractedInfo()
+    info.download_url = download_url
+    return info
+
+
+class NormalizeQueryTest(unittest.TestCase):
+    def test_search_ignores_case_and_spacing(self):
+        self.assertEqual(normalize_query('  Some   Song '), 'some song')
+
+    def test_url_keeps_the_case_of_its_video_id(self):
+        self.assertEqual(
+            normalize_query('HTTPS://WWW.YouTube.com/watch?v=dQw4w9WgXcQ#t=10'),
+            'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+        )
+
+    def test_download_url_expiry(self):
+        url = 'https://example.googlevideo.com/videoplayback?expire=1500000600'
+        self.assertEqual(download_url_expiry(url), 1500000600)
+        self.assertIsNone(download_url_expiry('https://example.com/audio.webm'))
+        self.assertIsNone(download_url_expiry('https://example.com/audio.webm?expire=soon'))
+
+
+class ExtractionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = NOW
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_hit_and_miss(self):
+        cache = ExtractionCache()
+        info = make_info()
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', info)
+
+        self.assertIs(cache.get('key'), info)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = ExtractionCache(ttl=600)
+        cache.put('key', make_info())
+        self.now += 601
+
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+
+    def test_entries_expire_before_their_download_url_does(self):
+        cache = ExtractionCache(ttl=600, expiry_margin=120)
+        cache.put('key', make_info('https://example.googlevideo.com/videoplayback?expire=%d' % (NOW + 200)))
+        self.now += 79
+        self.assertIsNotNone(cache.get('key'))
+
+        self.now += 2
+        self.assertIsNone(cache.get('key'))
+
+    def test_download_url_about_to_expire_isnt_cached(self):
+        cache = ExtractionCache(expiry_margin=120)
+        cache.put('key', make_info('https://example.googlevideo.com/videoplayback?expire=%d' % (NOW + 60)))
+
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ExtractionCache(max_entries=2)
+        cache.put('a', make_info())
+        cache.put('b', make_info())
+        cache.get('a')
+        cache.put('c', make_info())
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_invalidate(self):
+        cache = ExtractionCache()
+        cache.put('key', make_info())
+        cache.invalidate('key')
+        cache.invalidate('missing')
+
+        self.assertIsNone(cache.get('key'))
+
+
+class ExtractPlaylistTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.pages = []
+        patcher = mock.patch.object(ytdl.extraction_pool, 'run', self.run_extraction)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def run_extraction(self, loop, func, url, opts, options_key, flat=False, page=None):
+        self.pages.append(page)
+        first, last = page
+        entries = [('track-%s' % i, 'Track %s' % i) for i in range(first, min(last, 5) + 1)]
+        return {'entries': entries, 'count': len(entries)}
+
+    def test_playlist_is_extracted_a_page_at_a_time(self):
+        playlist = self.loop.run_until_complete(extract_playlist(self.loop, 'https://example.com/list', page_size=2))
+        self.assertEqual([url for url, _ in playlist.entries], ['track-1', 'track-2'])
+        self.assertEqual(self.pages, [(1, 2)])
+
+        urls = []
+        while playlist.next_page:
+            playlist = self.loop.run_until_complete(playlist.next_page())
+            urls.extend(url for url, _ in playlist.entries)
+
+        self.assertEqual(urls, ['track-3', 'track-4', 'track-5'])
+        self.assertEqual(self.pages, [(1, 2), (3, 4), (5, 6)])
+
+    def test_full_last_page_ends_with_an_empty_one(self):
+        playlist = self.loop.run_until_complete(extract_playlist(self.loop, 'https://example.com/list', page_size=5))
+
+        self.assertEqual(len(playlist), 5)
+        self.assertIsNone(self.loop.run_until_complete(playlist.next_page()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import time
+
+
+class CapacityEstimator(object):
+    """
+    Works out how many voice clients this worker can take on, from how close it is to running out of
+    CPU, how late the frame scheduler is ticking, and how lagged the event loop is.
+
+    The advertised capacity only drops once the estimate is `hysteresis` clients below it, and only rises
+    once the estimate has stayed `hysteresis` clients above it for `raise_after` samples in a row.
+    """
+    sample_interval = 5
+
+    def __init__(self, loop, max_clients, min_clients=1, cpu_target=0.8, lateness_target=0.015,
+                 lag_target=0.02, hysteresis=2, raise_after=3):
+        self.loop = loop
+        self.max_clients = max_clients
+        self.min_clients = min_clients
+        self.cpu_target = cpu_target
+        self.lateness_target = lateness_target
+        self.lag_target = lag_target
+        self.hysteresis = hysteresis
+        self.raise_after = raise_after
+
+        self.capacity = max_clients
+        self.cpu = 0.0
+        self.frame_lateness = 0.0
+        self.loop_lag = 0.0
+
+        self._worst_lateness = 0.0
+        self._raise_streak = 0
+        self._last_cpu_sample = None
+
+    def record_frame_lateness(self, lateness):
+        # Called from the frame scheduler's thread, a lost update here just means a slightly lower sample.
+        if lateness > self._worst_lateness:
+            self._worst_lateness = lateness
+
+    def _sample_cpu(self):
+        if hasattr(os, 'getloadavg'):
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+        now, cpu_time = time.monotonic(), time.process_time()
+        last, self._last_cpu_sample = self._last_cpu_sample, (now, cpu_time)
+        if not last or now == last[0]:
+            return 0.0
+
+        return (cpu_time - last[1]) / (now - last[0]) / (os.cpu_count() or 1)
+
+    def estimate(self, active_clients):
+        pressure = max(
+            self.cpu / self.cpu_target,
+            self.frame_lateness / self.lateness_target,
+            self.loop_lag / self.lag_target
+        )
+
+        if not active_clients or pressure <= 0:
+            estimate = self.max_clients if pressure < 1 else self.min_clients
+        else:
+            estimate = int(active_clients / pressure)
+
+        return max(self.min_clients, min(self.max_clients, estimate))
+
+    def update(self, active_clients):
+        """Takes a sample and returns True if the advertised capacity changed."""
+        self.cpu = self._sample_cpu()
+        self.frame_lateness, self._worst_lateness = self._worst_lateness, 0.0
+
+        estimate = self.estimate(active_clients)
+        if estimate <= self.capacity - self.hysteresis or (estimate < self.capacity and estimate == self.min_clients):
+            self._raise_streak = 0
+            self.capacity = estimate
+            return True
+
+        if estimate >= self.capacity + self.hysteresis or (estimate > self.capacity and estimate == self.max_clients):
+            self._raise_streak += 1
+            if self._raise_streak >= self.raise_after:
+                self._raise_streak = 0
+                self.capacity = estimate
+                return True
+
+        else:
+            self._raise_streak = 0
+
+        return False
+
+    async def run(self, get_active_clients, on_change):
+        while True:
+            started = self.loop.time()
+            await asyncio.sleep(self.sample_interval)
+            self.loop_lag = max(0.0, self.loop.time() - started - self.sample_interval)
+
+            if self.update(get_active_clients()):
+                on_change(self.capacity)
+
+    def get_stats(self):
+        return {
+            'capacity': self.capacity,
+            'ceiling': self.max_clients,
+            'cpu': round(self.cpu, 3),
+            'frame_lateness_ms': round(self.frame_lateness * 1000, 1),
+            'loop_lag_ms': round(self.loop_lag * 1000, 1),
+        }
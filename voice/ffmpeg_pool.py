@@ -0,0 +1,236 @@
+import collections
+import math
+import subprocess
+import time
+
+import discord.opus
+
+from lib.stats import Samples
+from voice.live_buffer import LiveBuffer
+from voice.passthrough import OggOpusReader
+from voice.scheduler import PipeReader, ScheduledPlayer
+
+# A pooled process is a shell blocked on reading a single line from stdin. Once it receives
+# "<mode> <seek> <url>" it execs straight into ffmpeg, so the fork of our (large) process and the shell
+# startup are paid ahead of time, off the event loop, instead of inside `play`. In "copy" mode ffmpeg
+# only remuxes the source's Opus packets into Ogg. "live" sources can't be seeked, and have ffmpeg
+# reconnect by itself when the connection drops. Everything is decoded to PCM.
+FFMPEG_LAUNCHER = (
+    'read -r mode seek url || exit 1; '
+    'if [ "$mode" = copy ]; then '
+    'exec ffmpeg -nostdin -ss "$seek" -i "$url" -map 0:a:0 -c:a copy -f ogg -loglevel warning pipe:1; '
+    'fi; '
+    'if [ "$mode" = live ]; then '
+    'exec ffmpeg -nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -i "$url" '
+    '-f s16le -ar {rate} -ac {channels} -loglevel warning pipe:1; '
+    'fi; '
+    'exec ffmpeg -nostdin -ss "$seek" -i "$url" -f s16le -ar {rate} -ac {channels} -loglevel warning pipe:1'
+).format(rate=discord.opus.Encoder.SAMPLING_RATE, channels=discord.opus.Encoder.CHANNELS)
+
+
+class DecoderOutput(object):
+    """
+    Wraps a decoder's stdout, counting the frames read from it and reporting how long it took for the first
+    frame to arrive. If a loudness meter is attached, every frame is fed to it.
+    """
+
+    def __init__(self, stream, started_at, callback):
+        self.stream = stream
+        self.started_at = started_at
+        self.callback = callback
+        self.frames_read = 0
+        self.meter = None
+
+    def read(self, size):
+        data = self.stream.read(size)
+        # Nothing has arrived yet, or the stream has ended.
+        if not data:
+            return data
+
+        self.frames_read += 1
+        if self.meter:
+            self.meter.add(data)
+
+        if self.callback:
+            callback, self.callback = self.callback, None
+            callback(time.monotonic() - self.started_at)
+
+        return data
+
+    def close(self):
+        close = getattr(self.stream, 'close', None)
+        if close:
+            close()
+
+
+class FFmpegProcessPool(object):
+    def __init__(self, loop, scheduler, min_size=1, max_size=4, demand_window=300):
+        self.loop = loop
+        self.scheduler = scheduler
+        self.min_size = min_size
+        self.max_size = max_size
+        self.demand_window = demand_window
+
+        self.hits = 0
+        self.misses = 0
+        self.passthrough_started = 0
+        self.transcode_started = 0
+        self.live_started = 0
+        self.live_respawns = 0
+        self.pooled_first_frame = Samples()
+        self.cold_first_frame = Samples()
+
+        self._idle = collections.deque()
+        self._demand = collections.deque()
+        self._spawning = 0
+        self._refill_handle = None
+        self._closed = False
+
+    @property
+    def target_size(self):
+        # Keep about as many warm processes as we've been starting per minute recently.
+        now = time.monotonic()
+        while self._demand and now - self._demand[0] > self.demand_window:
+            self._demand.popleft()
+
+        per_minute = len(self._demand) * 60.0 / self.demand_window
+        return max(self.min_size, min(self.max_size, int(math.ceil(per_minute))))
+
+    @staticmethod
+    def _spawn():
+        return subprocess.Popen(['sh', '-c', FFMPEG_LAUNCHER], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _acquire(self):
+        while self._idle:
+            process = self._idle.popleft()
+            if process.poll() is None:
+                return process, True
+
+        return self._spawn(), False
+
+    def create_player(self, voice_client, download_url, progress=0, after=None, passthrough=False, live=False,
+                      gain=1.0):
+        """
+        A player for the url, starting `progress` seconds in, with `gain` applied on top of its volume. With
+        `passthrough`, the source has to be Opus, and its packets are sent as they are, at their own volume. A `live`
+        source plays through a LiveBuffer, which starts a new decoder whenever the last one gives up.
+        """
+        started_at = time.monotonic()
+        self._demand.append(started_at)
+
+        process, pooled = self._acquire()
+        if pooled:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        mode = 'live' if live else 'copy' if passthrough else 'pcm'
+        self._launch(process, mode, progress, download_url)
+
+        player = ScheduledPlayer(self.scheduler, process, voice_client, after, passthrough=passthrough, gain=gain)
+        if live:
+            self.live_started += 1
+            stream = LiveBuffer(
+                process, player.frame_size, self._live_respawner(download_url), frame_length=player.delay
+            )
+        elif passthrough:
+            self.passthrough_started += 1
+            stream = OggOpusReader(PipeReader(process.stdout))
+        else:
+            self.transcode_started += 1
+            stream = PipeReader(process.stdout)
+
+        samples = self.pooled_first_frame if pooled else self.cold_first_frame
+        # The callback fires on the scheduler's thread.
+        player.buff = DecoderOutput(
+            stream, started_at, lambda elapsed: self.loop.call_soon_threadsafe(samples.add, elapsed)
+        )
+
+        self.schedule_refill()
+        return player
+
+    @staticmethod
+    def _launch(process, mode, progress, download_url):
+        process.stdin.write(('%s %s %s\n' % (mode, progress or 0, download_url)).encode('utf-8'))
+        process.stdin.close()
+
+    def _live_respawner(self, download_url):
+        def respawn(buffer, attempt):
+            # Called on the frame scheduler's thread. Back off if the last few came to nothing.
+            delay = min(2 ** attempt - 1, 10)
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self._respawn_live, buffer, download_url)
+
+        return respawn
+
+    def _respawn_live(self, buffer, download_url):
+        self.live_respawns += 1
+
+        def spawn():
+            process = self._spawn()
+            self._launch(process, 'live', 0, download_url)
+            return process
+
+        def spawned(future):
+            if future.exception():
+                print("failed to respawn live ffmpeg", future.exception())
+                buffer.respawn_failed()
+                return
+
+            buffer.attach(future.result())
+
+        self.loop.run_in_executor(None, spawn).add_done_callback(spawned)
+
+    def schedule_refill(self):
+        if self._refill_handle is None and not self._closed:
+            self._refill_handle = self.loop.call_soon(self._refill)
+
+    def _refill(self):
+        self._refill_handle = None
+        target = self.target_size
+
+        while len(self._idle) > target:
+            self._kill(self._idle.pop())
+
+        for _ in range(target - len(self._idle) - self._spawning):
+            self._spawning += 1
+            self.loop.run_in_executor(None, self._spawn).add_done_callback(self._spawned)
+
+    def _spawned(self, future):
+        self._spawning -= 1
+        if future.exception():
+            print("failed to spawn pooled ffmpeg", future.exception())
+            return
+
+        process = future.result()
+        if self._closed:
+            self._kill(process)
+        else:
+            self._idle.append(process)
+
+    @staticmethod
+    def _kill(process):
+        process.kill()
+        process.wait()
+
+    def close(self):
+        self._closed = True
+        if self._refill_handle:
+            self._refill_handle.cancel()
+            self._refill_handle = None
+
+        while self._idle:
+            self._kill(self._idle.pop())
+
+    def get_stats(self):
+        return {
+            'idle': len(self._idle),
+            'target': self.target_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'passthrough_started': self.passthrough_started,
+            'transcode_started': self.transcode_started,
+            'live_started': self.live_started,
+            'live_respawns': self.live_respawns,
+            'first_frame_pooled_ms': self.pooled_first_frame.summary(scale=1000),
+            'first_frame_cold_ms': self.cold_first_frame.summary(scale=1000),
+        }
@@ -0,0 +1,159 @@
+import threading
+import traceback
+
+from voice.scheduler import PipeReader
+
+# s16le stereo, a stream that ended mid-sample has its tail dropped so the next one lines up.
+SAMPLE_ALIGNMENT = 4
+
+
+class LiveBuffer(object):
+    """
+    A jitter buffer in front of a live source's decoder. Playback only starts once `prebuffer_frames` have been
+    read ahead, and after running dry it waits for `rebuffer_frames` before carrying on, rather than cutting in and
+    out frame by frame. At most `max_frames` are read ahead.
+
+    When the decoder exits (the upstream connection dropped for longer than ffmpeg's own reconnects could cover),
+    `respawn(buffer, attempt)` is called to start another one, which is handed back with `attach`. What's still
+    buffered keeps playing meanwhile. After `max_reconnects` decoders in a row that produce nothing, the stream
+    is considered over.
+
+    `read` is called on the frame scheduler's thread, `attach` on the event loop.
+    """
+
+    def __init__(self, process, frame_size, respawn, frame_length=0.02, prebuffer_frames=50, rebuffer_frames=25,
+                 max_frames=250, max_reconnects=5):
+        self.frame_size = frame_size
+        self.frame_length = frame_length
+        self.respawn = respawn
+        self.prebuffer_frames = prebuffer_frames
+        self.rebuffer_frames = rebuffer_frames
+        self.max_reconnects = max_reconnects
+
+        self.process = process
+        self.reader = PipeReader(process.stdout, max_buffered=max_frames * frame_size)
+        self.underruns = 0
+        self.reconnects = 0
+        self.gave_up = False
+
+        self._refill_to = prebuffer_frames
+        self._reconnecting = False
+        self._failed_reconnects = 0
+        self._received = False
+        self._pending_process = None
+        self._respawn_failed = False
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def depth(self):
+        """How many frames are buffered."""
+        return len(self.reader.buffer) // self.frame_size
+
+    def attach(self, process):
+        with self._lock:
+            if not self._closed:
+                self._pending_process, process = process, None
+
+        # Closed while the decoder was starting.
+        if process is not None:
+            self._kill(process)
+
+    def respawn_failed(self):
+        """The decoder couldn't even be started, which counts the same as one that produced nothing."""
+        with self._lock:
+            self._respawn_failed = True
+
+    def _swap_process(self):
+        with self._lock:
+            process, self._pending_process = self._pending_process, None
+            respawn_failed, self._respawn_failed = self._respawn_failed, False
+
+        if respawn_failed:
+            self._reconnecting = False
+            self._received = False
+
+        if process is None:
+            return
+
+        self._kill(self.process)
+        reader = self.reader
+        del reader.buffer[len(reader.buffer) - len(reader.buffer) % SAMPLE_ALIGNMENT:]
+        self.reader = PipeReader(process.stdout, max_buffered=reader.max_buffered)
+        self.reader.buffer = reader.buffer
+        self.process = process
+        self._reconnecting = False
+        self._received = False
+
+    def _check_upstream(self):
+        reader = self.reader
+        before = len(reader.buffer)
+        reader.fill()
+        if len(reader.buffer) != before:
+            self._received = True
+            self._failed_reconnects = 0
+
+        if not reader.eof or self._reconnecting or self.gave_up:
+            return
+
+        if not self._received:
+            self._failed_reconnects += 1
+            if self._failed_reconnects > self.max_reconnects:
+                self.gave_up = True
+                return
+
+        self._reconnecting = True
+        self.reconnects += 1
+        try:
+            self.respawn(self, self._failed_reconnects)
+        except Exception:
+            traceback.print_exc()
+            self.gave_up = True
+
+    def read(self, size):
+        """A frame, None while (re)buffering, or b'' once the stream is over."""
+        self._swap_process()
+        self._check_upstream()
+
+        depth = self.depth
+        if self.gave_up:
+            return self.reader.read(size) if depth else b''
+
+        if self._refill_to:
+            if depth < self._refill_to:
+                return None
+
+            self._refill_to = 0
+
+        if not depth:
+            self.underruns += 1
+            self._refill_to = self.rebuffer_frames
+            return None
+
+        return self.reader.read(size)
+
+    @staticmethod
+    def _kill(process):
+        try:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+        except Exception:
+            traceback.print_exc()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            pending, self._pending_process = self._pending_process, None
+
+        self._kill(self.process)
+        if pending is not None:
+            self._kill(pending)
+
+    def get_stats(self):
+        return {
+            'depth_ms': int(self.depth * self.frame_length * 1000),
+            'underruns': self.underruns,
+            'reconnects': self.reconnects,
+            'buffering': bool(self._refill_to),
+        }
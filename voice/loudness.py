@@ -0,0 +1,89 @@
+import audioop
+import collections
+import math
+
+# Everything is measured in dB relative to full scale 16 bit PCM. This is not K-weighted like EBU R128,
+# but it uses the same gating and is close enough to even out tracks mastered at different levels.
+TARGET_LOUDNESS = -18.0
+MAX_BOOST = 6.0
+MAX_CUT = -15.0
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+FULL_SCALE = 32768.0 ** 2
+
+
+class LoudnessMeter(object):
+    """Measures the gated loudness of 16 bit PCM, in blocks of `frames_per_block` frames."""
+
+    def __init__(self, frames_per_block=20):
+        self.frames_per_block = frames_per_block
+        self.blocks = []
+        self._block_power = 0.0
+        self._block_frames = 0
+
+    def add(self, data):
+        rms = audioop.rms(data, 2)
+        self._block_power += rms * rms
+        self._block_frames += 1
+
+        if self._block_frames == self.frames_per_block:
+            self.blocks.append(self._block_power / self._block_frames / FULL_SCALE)
+            self._block_power = 0.0
+            self._block_frames = 0
+
+    @property
+    def measured_seconds(self):
+        # 20ms frames.
+        return len(self.blocks) * self.frames_per_block * 0.02
+
+    @staticmethod
+    def _to_db(power):
+        return 10 * math.log10(power) if power > 0 else float('-inf')
+
+    def integrated(self):
+        gated = [power for power in self.blocks if self._to_db(power) > ABSOLUTE_GATE]
+        if not gated:
+            return None
+
+        relative_gate = self._to_db(sum(gated) / len(gated)) + RELATIVE_GATE
+        gated = [power for power in gated if self._to_db(power) > relative_gate]
+        return self._to_db(sum(gated) / len(gated))
+
+
+class TrackCacheEntry(object):
+    __slots__ = ('loudness',)
+
+    def __init__(self):
+        self.loudness = None
+
+    @property
+    def gain(self):
+        """The linear gain that brings this track to the target loudness."""
+        if self.loudness is None:
+            return 1.0
+
+        gain_db = max(MAX_CUT, min(MAX_BOOST, TARGET_LOUDNESS - self.loudness))
+        return 10 ** (gain_db / 20.0)
+
+
+class TrackCache(object):
+    """What the worker remembers about the sources it has played, keyed by the source key from HQ."""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def get(self, source_key, create=False):
+        entry = self._entries.get(source_key)
+        if entry is not None:
+            self._entries.move_to_end(source_key)
+
+        elif create:
+            entry = self._entries[source_key] = TrackCacheEntry()
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
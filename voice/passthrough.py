@@ -0,0 +1,104 @@
+import collections
+
+# Frame durations, in tenths of a millisecond, for each of the 32 Opus TOC configurations (RFC 6716 section 3.1).
+_OPUS_FRAME_DURATIONS = (
+    [100, 200, 400, 600] * 3 +   # SILK
+    [100, 200] * 2 +             # Hybrid
+    [25, 50, 100, 200] * 4       # CELT
+)
+
+
+class PassthroughUnsupported(Exception):
+    """The source can't be sent as is, and has to be transcoded instead."""
+
+
+def opus_packet_duration(packet):
+    """The duration of an Opus packet in tenths of a millisecond."""
+    toc = packet[0]
+    code = toc & 0x3
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    elif len(packet) > 1:
+        frames = packet[1] & 0x3f
+    else:
+        raise PassthroughUnsupported('Truncated opus packet')
+
+    return _OPUS_FRAME_DURATIONS[toc >> 3] * frames
+
+
+class OggOpusReader(object):
+    """
+    Pulls Opus packets out of an Ogg stream, like the one `ffmpeg -c:a copy -f ogg` writes, as they arrive on a
+    PipeReader. Every packet has to be exactly one voice frame long, since that's what the voice connection stamps
+    on each one it sends.
+    """
+
+    def __init__(self, source, frame_duration=200):
+        self.source = source
+        self.frame_duration = frame_duration
+        self._packets = collections.deque()
+        self._partial = bytearray()
+        # OpusHead and OpusTags come first, neither is audio.
+        self._headers_left = 2
+
+    def _read_page(self):
+        """Consumes the next page if all of it has arrived, returning whether it had."""
+        source = self.source
+        header = source.peek(27)
+        if header is None:
+            return False
+
+        if header[:4] != b'OggS':
+            raise PassthroughUnsupported('Lost sync with the ogg stream')
+
+        header_size = 27 + header[26]
+        header = source.peek(header_size)
+        if header is None:
+            return False
+
+        lacing = header[27:]
+        page = source.peek(header_size + sum(lacing))
+        if page is None:
+            return False
+
+        source.skip(len(page))
+        offset = header_size
+        for size in lacing:
+            self._partial += page[offset:offset + size]
+            offset += size
+            # A packet carries on into the next segment (or page) for as long as the segments are full.
+            if size < 255:
+                packet = bytes(self._partial)
+                self._partial.clear()
+                if self._headers_left:
+                    if self._headers_left == 2 and not packet.startswith(b'OpusHead'):
+                        raise PassthroughUnsupported('Not an opus stream')
+
+                    self._headers_left -= 1
+
+                elif packet:
+                    self._packets.append(packet)
+
+        return True
+
+    def read(self, size=None):
+        """
+        The next packet, None if it hasn't arrived yet, or b'' once the stream has ended. `size` is ignored,
+        packets are what they are.
+        """
+        if not self._packets:
+            self.source.fill()
+            while self._read_page():
+                pass
+
+            if not self._packets:
+                return b'' if self.source.eof else None
+
+        packet = self._packets.popleft()
+        duration = opus_packet_duration(packet)
+        if duration != self.frame_duration:
+            raise PassthroughUnsupported('Opus packets are %.1fms long' % (duration / 10.0))
+
+        return packet
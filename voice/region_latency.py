@@ -0,0 +1,107 @@
+import asyncio
+import collections
+import time
+import traceback
+
+
+class RegionLatency(object):
+    __slots__ = ('latency', 'loss', 'samples', 'endpoints')
+
+    def __init__(self, max_endpoints):
+        self.latency = None
+        self.loss = 0.0
+        self.samples = 0
+        # Most recently served last.
+        self.endpoints = collections.deque(maxlen=max_endpoints)
+
+
+class RegionLatencyTracker(object):
+    """
+    Keeps track of the voice endpoints this worker has served in each region, and probes them every
+    `probe_interval` seconds with a TCP connect to port 443 (voice servers don't answer pings). Round trip time and
+    loss are kept as exponentially weighted averages per region, with `alpha` the weight of each new probe.
+    """
+
+    def __init__(self, loop, probe_interval=30, alpha=0.2, timeout=2.0, max_endpoints=4):
+        self.loop = loop
+        self.probe_interval = probe_interval
+        self.alpha = alpha
+        self.timeout = timeout
+        self.max_endpoints = max_endpoints
+        self.probes = 0
+        self.failed_probes = 0
+        self._regions = {}
+
+    def observe(self, region, endpoint):
+        """Remembers an endpoint we've been sent to for a region, like 'us-west123.discord.gg:80'."""
+        if not region or not endpoint:
+            return
+
+        host = endpoint.rsplit(':', 1)[0]
+        entry = self._regions.get(region)
+        if entry is None:
+            entry = self._regions[region] = RegionLatency(self.max_endpoints)
+
+        if host in entry.endpoints:
+            entry.endpoints.remove(host)
+
+        entry.endpoints.append(host)
+
+    async def _probe(self, host):
+        """The time it took to connect, or None if it didn't."""
+        self.probes += 1
+        started = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, 443, loop=self.loop), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.failed_probes += 1
+            return None
+
+        elapsed = time.monotonic() - started
+        writer.close()
+        return elapsed
+
+    def _record(self, entry, latency):
+        alpha = self.alpha
+        entry.samples += 1
+        entry.loss = (1 - alpha) * entry.loss + alpha * (0.0 if latency is not None else 1.0)
+        if latency is not None:
+            entry.latency = latency if entry.latency is None else (1 - alpha) * entry.latency + alpha * latency
+
+    async def probe_all(self):
+        regions = list(self._regions.values())
+        probes = [(entry, host) for entry in regions for host in entry.endpoints]
+        results = await asyncio.gather(*(self._probe(host) for _, host in probes), loop=self.loop)
+        for (entry, _), latency in zip(probes, results):
+            self._record(entry, latency)
+
+    def table(self):
+        """{region: {'latency_ms', 'loss', 'samples'}} for every region that has been probed."""
+        return {
+            region: {
+                'latency_ms': round(entry.latency * 1000, 1) if entry.latency is not None else None,
+                'loss': round(entry.loss, 3),
+                'samples': entry.samples,
+            }
+            for region, entry in self._regions.items() if entry.samples
+        }
+
+    async def run(self, on_update):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await self.probe_all()
+                on_update(self.table())
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                traceback.print_exc()
+
+    def get_stats(self):
+        return {
+            'regions': len(self._regions),
+            'probes': self.probes,
+            'failed_probes': self.failed_probes,
+        }
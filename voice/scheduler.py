@@ -0,0 +1,291 @@
+import audioop
+import os
+import threading
+import time
+import traceback
+
+from lib.stats import Samples
+from voice.passthrough import PassthroughUnsupported
+
+
+class PipeReader(object):
+    """
+    Non-blocking reads from a decoder's stdout. At most `max_buffered` bytes are read ahead, after which the
+    decoder blocks on its own writes until we catch up.
+    """
+
+    def __init__(self, pipe, max_buffered=1 << 18):
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        self.max_buffered = max_buffered
+        self.buffer = bytearray()
+        self.eof = False
+        os.set_blocking(self.fd, False)
+
+    def fill(self):
+        while not self.eof and len(self.buffer) < self.max_buffered:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+
+            if chunk:
+                self.buffer += chunk
+            else:
+                self.eof = True
+
+    def peek(self, size):
+        """The next `size` bytes, without consuming them, or None if they haven't all arrived yet."""
+        if len(self.buffer) < size:
+            return None
+
+        return bytes(self.buffer[:size])
+
+    def skip(self, size):
+        del self.buffer[:size]
+
+    def read(self, size):
+        """The next `size` bytes, None if they haven't arrived yet, or b'' once the stream has ended."""
+        self.fill()
+        data = self.peek(size)
+        if data is not None:
+            self.skip(size)
+            return data
+
+        return b'' if self.eof else None
+
+
+class ScheduledPlayer(object):
+    """
+    Plays a decoder's output on a voice client, one frame per tick of a FrameScheduler. It stands in for
+    discord.py's ProcessPlayer, minus the thread: start, stop, pause, resume, is_playing and volume all behave
+    the same, and `after` is called on the scheduler's thread once it's done.
+    """
+
+    def __init__(self, scheduler, process, voice_client, after=None, passthrough=False, gain=1.0):
+        self.scheduler = scheduler
+        self.process = process
+        self.voice_client = voice_client
+        self.after = after
+        self.passthrough = passthrough
+        # The normalization gain, which rides along with the volume in the one multiply every frame gets. Passed
+        # through packets can't be scaled, so they play at their own level.
+        self.gain = 1.0 if passthrough else gain
+        self.buff = None
+        self.volume = self.gain
+        # Whether it was stopped before it could finish, and if so, whether only to be started again later.
+        self.stopped = False
+        self.released = False
+        self.delay = voice_client.encoder.frame_length / 1000.0
+        self.frame_size = voice_client.encoder.frame_size
+        # Set when a passthrough source turned out not to be usable, and has to be transcoded after all.
+        self.unsupported = None
+        self.underruns = 0
+        self._paused = False
+        self._end = threading.Event()
+
+    def start(self):
+        self.scheduler.add(self)
+
+    def stop(self, release=False):
+        self.stopped = True
+        self.released = release
+        self._end.set()
+
+    def set_volume(self, volume):
+        self.volume = volume * self.gain
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def is_playing(self):
+        return not self._paused and not self._end.is_set()
+
+    def is_done(self):
+        return self._end.is_set()
+
+    def tick(self):
+        """Sends the frame that's due, returning False once the player is done."""
+        if self._end.is_set() or not self.voice_client._connected.is_set():
+            return False
+
+        if self._paused:
+            return True
+
+        try:
+            data = self.buff.read(self.frame_size)
+        except PassthroughUnsupported as e:
+            self.unsupported = e
+            return False
+
+        if data is None:
+            # The decoder hasn't kept up, this frame is skipped rather than holding up everyone else. Its time still
+            # passes though, so the RTP timestamp moves on as if it had been sent, and the receiver can tell a frame
+            # went missing rather than playing what comes next early.
+            self.underruns += 1
+            self.voice_client.checked_add('timestamp', self.voice_client.encoder.samples_per_frame, 4294967295)
+            return True
+
+        if self.passthrough:
+            if not data:
+                return False
+
+            self.voice_client.play_audio(data, encode=False)
+            return True
+
+        if len(data) != self.frame_size:
+            return False
+
+        if self.volume != 1.0:
+            data = audioop.mul(data, 2, min(self.volume, 2.0))
+
+        self.voice_client.play_audio(data)
+        return True
+
+    def finish(self):
+        self._end.set()
+        try:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            # Sources that start decoders of their own have to stop them too.
+            self.buff.close()
+        except Exception:
+            traceback.print_exc()
+
+        if self.after:
+            self.after()
+
+
+class FrameScheduler(object):
+    """
+    Drives every ScheduledPlayer on the worker from one thread, on one monotonic clock: each tick, every stream
+    gets its due frame sent, in one pass. How late each tick starts is the scheduling lag, and is handed to
+    `on_lag` (from the scheduler's thread) as well as kept for stats.
+
+    Encoding happens in the pass too, so a worker's streams all share one core. A host with more cores than one
+    worker can keep busy should run more workers.
+    """
+
+    # Once we're this many ticks behind, we stop trying to catch up and start counting from now.
+    max_ticks_behind = 5
+
+    def __init__(self, frame_length=0.02, on_lag=None):
+        self.frame_length = frame_length
+        self.on_lag = on_lag
+        self.ticks = 0
+        self.late_ticks = 0
+        self.skipped_ticks = 0
+        self.frames_sent = 0
+        self.underruns = 0
+        self.errors = 0
+        self.lag = Samples(maxlen=1000)
+
+        self._players = []
+        self._added = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def add(self, player):
+        with self._lock:
+            self._added.append(player)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='frame-scheduler', daemon=True)
+            self._thread.start()
+
+        self._wakeup.set()
+
+    def __len__(self):
+        return len(self._players) + len(self._added)
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._closed:
+            with self._lock:
+                self._players.extend(self._added)
+                self._added.clear()
+
+            if not self._players:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                next_tick = time.monotonic()
+                continue
+
+            lag = time.monotonic() - next_tick
+            self._record_lag(lag)
+            self._tick()
+
+            next_tick += self.frame_length
+            behind = time.monotonic() - next_tick
+            if behind > self.max_ticks_behind * self.frame_length:
+                skipped = int(behind / self.frame_length)
+                self.skipped_ticks += skipped
+                next_tick += skipped * self.frame_length
+
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _record_lag(self, lag):
+        self.ticks += 1
+        if lag > self.frame_length / 2:
+            self.late_ticks += 1
+
+        with self._lock:
+            self.lag.add(max(0.0, lag))
+
+        if self.on_lag:
+            self.on_lag(max(0.0, lag))
+
+    def _tick(self):
+        finished = []
+        for player in self._players:
+            underruns = player.underruns
+            try:
+                playing = player.tick()
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+                playing = False
+
+            if player.underruns != underruns:
+                self.underruns += 1
+            elif playing and player.is_playing():
+                self.frames_sent += 1
+
+            if not playing:
+                finished.append(player)
+
+        for player in finished:
+            self._players.remove(player)
+            player.finish()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        with self._lock:
+            players = self._players + self._added
+
+        for player in players:
+            player.stop()
+
+    def get_stats(self):
+        with self._lock:
+            lag = self.lag.summary(scale=1000)
+
+        return {
+            'streams': len(self),
+            'ticks': self.ticks,
+            'late_ticks': self.late_ticks,
+            'skipped_ticks': self.skipped_ticks,
+            'frames_sent': self.frames_sent,
+            'underruns': self.underruns,
+            'errors': self.errors,
+            'lag_ms': lag,
+        }
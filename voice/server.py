@@ -5,7 +5,7 @@ import discord
 
 import rpc.server
 from lib.event_emitter import EventEmitter
-from rpc.base import s
+from rpc.base import s, CallException
 
 
 class RemoteVoiceClient(EventEmitter):
@@ -21,18 +21,36 @@ class RemoteVoiceClient(EventEmitter):
         kwargs.pop('loop')
         self.channel = kwargs.pop('channel')
         self.guild_id = kwargs['data']['guild_id']
+        kwargs['region'] = str(self.channel.server.region)
+
+        # The worker sets up the voice client and connects it in one go.
+        try:
+            await self.remote_call('join', *args, **kwargs)
+
+        finally:
+            # By now the worker has counted it, or it isn't going to.
+            self.client.pending_joins.discard(self.remote_ref)
 
-        await self.remote_call('__init_voice_client__', *args, **kwargs)
         return self
 
     def remote_call(self, func, *args, **kwargs):
         print('remote call', func, args, kwargs)
-        return self.client.call('remote_voice_client__call', func, self.remote_ref, *args, **kwargs, _timeout=10)
+        # Voice handshakes take seconds, and would hold up everything batched with them.
+        if func in self.client.unbatched_calls:
+            return self.client.direct_call(func, self.remote_ref, *args, **kwargs)
+
+        return self.client.batched_call(func, self.remote_ref, *args, **kwargs)
 
     @property
     def server(self):
         return self.channel.server
 
+    def to_local_time(self, remote_timestamp):
+        return self.client.to_local_time(remote_timestamp)
+
+    def to_remote_time(self, timestamp):
+        return self.client.to_remote_time(timestamp)
+
     async def move_to(self, channel):
         if str(getattr(channel, 'type', 'text')) != 'voice':
             raise discord.InvalidArgument('Must be a voice channel.')
@@ -40,10 +58,17 @@ class RemoteVoiceClient(EventEmitter):
         await self.client.server.discord.ws.voice_state(self.guild_id, channel.id)
 
     async def disconnect(self):
-        await self.client.server.discord.ws.voice_state(self.guild_id, None, self_mute=True)
-        return await self.remote_call('disconnect', silent=True)
-        # self.emit('disconnect', ret_value)
-        # return ret_value
+        try:
+            await self.client.server.discord.ws.voice_state(self.guild_id, None, self_mute=True)
+            return await self.remote_call('disconnect', silent=True)
+
+        finally:
+            self.release()
+
+    def release(self):
+        # We're done with this client, and the listeners on it would otherwise keep its guild around for good.
+        self.client.refs.pop(self.remote_ref, None)
+        self.client.pending_joins.discard(self.remote_ref)
 
     def connect(self):
         return self.remote_call('connect')
@@ -68,11 +93,23 @@ class RemoteVoiceClient(EventEmitter):
 
 
 class ClientHandler(rpc.server.ClientHandler):
+    unbatched_calls = frozenset(('join', 'connect', 'disconnect'))
+    batched_call_timeout = 10
+    # A voice handshake takes a few seconds, and more when the voice server is slow to answer.
+    unbatched_call_timeout = 30
+
     def __init__(self, *args, **kwargs):
         super(ClientHandler, self).__init__(*args, **kwargs)
         self.refs = {}
+        # Refs we've handed out that the worker hasn't heard about yet, which its client_count doesn't include.
+        self.pending_joins = set()
         self.client_count = 0
         self.client_connection_id = None
+        self._voice_client_ref_seq = 0
+        self.stats = {}
+        self.region_latency = {}
+        self._pending_calls = []
+        self._flush_calls_handle = None
 
     def handle_call_info(self):
         return self.server.discord.user.name
@@ -83,6 +120,18 @@ class ClientHandler(rpc.server.ClientHandler):
     def handle_cast_client_count_update(self, client_count):
         self.client_count = client_count
 
+    def handle_cast_capacity_update(self, max_clients):
+        self.remote_info['max_clients'] = max_clients
+
+    def handle_cast_stats_update(self, stats):
+        self.stats = stats
+
+    def handle_cast_region_latency_update(self, table):
+        self.region_latency = table
+
+    def handle_ready(self, remote_info):
+        self.region_latency = remote_info.get('region_latency') or {}
+
     def handle_cast_remote_emit(self, remote_ref, event, *args, **kwargs):
         remote_voice_client = self.refs.get(remote_ref)
         if remote_voice_client:
@@ -94,10 +143,88 @@ class ClientHandler(rpc.server.ClientHandler):
             voice_client.emit('remote:down', reason)
 
         self.refs.clear()
+        self.pending_joins.clear()
+
+    def batched_call(self, func, remote_ref, *args, **kwargs):
+        """
+        Calls a function on a remote voice client. Calls made in the same loop iteration, across all of this
+        worker's voice clients, go out together as one remote_voice_client__batch call.
+        """
+        future = self.loop.create_future()
+        self._pending_calls.append((future, [func, remote_ref, args, kwargs]))
+        if self._flush_calls_handle is None:
+            self._flush_calls_handle = self.loop.call_soon(self._flush_calls)
+
+        return future
+
+    async def direct_call(self, func, remote_ref, *args, **kwargs):
+        """Calls a function on a remote voice client by itself, with a timeout of its own."""
+        # Anything batched for the client before this was asked for first, so it goes out first.
+        if self._flush_calls_handle is not None:
+            self._flush_calls_handle.cancel()
+            self._flush_calls()
+
+        return await self.call(
+            'remote_voice_client__call', func, remote_ref, *args, **kwargs, _timeout=self.unbatched_call_timeout
+        )
 
-    async def make_voice_client_ref(self):
-        ref = await self.call('make_voice_client_ref')
+    def _flush_calls(self):
+        self._flush_calls_handle = None
+        pending, self._pending_calls = self._pending_calls, []
+
+        try:
+            if len(pending) == 1:
+                future, (func, remote_ref, args, kwargs) = pending[0]
+                call_future = self.call(
+                    'remote_voice_client__call', func, remote_ref, *args, **kwargs, _timeout=self.batched_call_timeout
+                )
+                call_future.add_done_callback(lambda f: self._resolve_call(future, f.exception(), f))
+                return
+
+            call_future = self.call(
+                'remote_voice_client__batch', [call for _, call in pending], _timeout=self.batched_call_timeout
+            )
+
+        except CallException as e:
+            for future, _ in pending:
+                self._resolve_call(future, e)
+
+            return
+
+        def resolve_batch(f):
+            if f.exception():
+                for future, _ in pending:
+                    self._resolve_call(future, f.exception())
+
+                return
+
+            for (future, _), result in zip(pending, f.result()):
+                if 'exception' in result:
+                    self._resolve_call(future, CallException(result['exception']))
+                else:
+                    self._resolve_call(future, None, result=result['result'])
+
+        call_future.add_done_callback(resolve_batch)
+
+    @staticmethod
+    def _resolve_call(future, exception, result_future=None, result=None):
+        if future.done():
+            return
+
+        if exception is not None:
+            future.set_exception(exception)
+        elif result_future is not None:
+            future.set_result(result_future.result())
+        else:
+            future.set_result(result)
+
+    def make_voice_client_ref(self):
+        # The worker creates its side of the client when it first hears about the ref, so there's no need to ask it
+        # for one, which would be a round trip before we could even start joining.
+        self._voice_client_ref_seq += 1
+        ref = '%s.%s' % (self.client_connection_id, self._voice_client_ref_seq)
         remote_voice_client = self.refs[ref] = RemoteVoiceClient(self, ref)
+        self.pending_joins.add(ref)
         return remote_voice_client
 
     def __repr__(self):
@@ -111,6 +238,14 @@ class ClientHandler(rpc.server.ClientHandler):
 
 class Server(rpc.server.Server):
     client_handler_class = ClientHandler
+    # How much a completely full worker counts against it, in milliseconds of latency.
+    load_penalty_ms = 50
+    # A region this lossy is treated as if we had never measured it.
+    max_region_loss = 0.5
+    # What we assume a worker's latency is to a region it hasn't measured, so it can be ranked against the ones that
+    # have. A worker that takes any region, but didn't name this one, is assumed to be further away.
+    unmeasured_latency_ms = 150
+    unlisted_latency_ms = 300
 
     def __init__(self, *args, **kwargs):
         self.discord = kwargs.pop('discord')
@@ -137,17 +272,29 @@ class Server(rpc.server.Server):
         self.clients_by_connection_id[client.client_connection_id] = client
 
     def select_client(self, region):
+        # Workers are ranked by their latency to the region plus how loaded they are. Those that haven't measured the
+        # region are ranked the same way, with the latency we assume for them, as long as they said they accept it.
         eligible_clients = []
         for client in self.clients:
-            if client.client_count > client.remote_info['max_clients']:
+            max_clients = client.remote_info['max_clients']
+            # The worker's own count leaves out suspended clients, and the joins that haven't reached it yet.
+            client_count = client.client_count + len(client.pending_joins)
+            if client_count >= max_clients:
                 continue
 
+            measured = client.region_latency.get(region)
             acceptable_regions = client.remote_info['acceptable_regions']
-            if acceptable_regions == 'all' or region in acceptable_regions:
-                eligible_clients.append((client, (
-                    region not in acceptable_regions,
-                    client.client_count
-                )))
+            if measured and measured['latency_ms'] is not None and measured['loss'] <= self.max_region_loss:
+                latency_ms = measured['latency_ms']
+            elif acceptable_regions == 'all':
+                latency_ms = self.unlisted_latency_ms
+            elif region in acceptable_regions:
+                latency_ms = self.unmeasured_latency_ms
+            else:
+                continue
+
+            load = client_count / max_clients if max_clients else 1
+            eligible_clients.append((client, latency_ms + self.load_penalty_ms * load))
 
         if not eligible_clients:
             return None
@@ -155,12 +302,12 @@ class Server(rpc.server.Server):
         eligible_clients.sort(key=lambda c: c[1])
         return eligible_clients[0][0]
 
-    async def make_voice_client_proxy(self, region):
+    def make_voice_client_proxy(self, region):
         client = self.select_client(region)
         if not client:
             return None
 
-        return await client.make_voice_client_ref()
+        return client.make_voice_client_ref()
 
     def generate_id(self, client_id):
         while True:
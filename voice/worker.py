@@ -1,7 +1,18 @@
+import asyncio
+import collections
+import inspect
+import math
+import time
+import traceback
+
 import discord
 
 import rpc.client
-from lib.time_format import format_seconds_to_hhmmss
+from voice.capacity import CapacityEstimator
+from voice.ffmpeg_pool import FFmpegProcessPool
+from voice.loudness import LoudnessMeter, TrackCache
+from voice.region_latency import RegionLatencyTracker
+from voice.scheduler import FrameScheduler
 
 
 class RemoteVoiceClient(discord.VoiceClient):
@@ -31,18 +42,40 @@ class RemoteGateway(object):
 
 
 class RemoteVoiceClientWrapper(object):
+    # A paused player keeps its ffmpeg process, the upstream HTTP connection and its thread alive. Once a pause
+    # has lasted this long, we tear all of that down and seek back to the same position on resume.
+    release_paused_after = 120
+    # Normalization gains closer to unity than this (in dB) are skipped for Opus sources, so they can be passed
+    # through without decoding.
+    passthrough_gain_tolerance = 1.0
+
     def __init__(self, client, remote_ref):
         self.client = client
         self.remote_ref = remote_ref
         self.voice_client = None
         self.current_player = None
+        self.volume = 1.0
+        self.gain = 1.0
+        self._source_key = None
+        self._codec = None
+        self._is_live = False
         self._playback_ref_seq = 0
+        self._playback_ref = None
+        self._playback_url = None
+        self._playback_offset = 0
+        self._released_position = None
+        self._release_handle = None
+        # What HQ wants played when the current track ends, so we can start it without waiting on HQ.
+        self._preloaded = None
+        self.suspended = False
 
     def __init_voice_client__(self, *args, **kwargs):
         if self.voice_client:
             return
 
         user_id = kwargs.pop('user_id')
+        # Not something discord.py knows about, HQ tells us so we can keep track of our latency to each region.
+        self.client.region_latency.observe(kwargs.pop('region', None), kwargs['data'].get('endpoint'))
         self.voice_client = RemoteVoiceClient(
             *args,
             channel=None, user=RemoteUser(user_id), loop=self.client.loop, main_ws=RemoteGateway(self),
@@ -52,68 +85,298 @@ class RemoteVoiceClientWrapper(object):
     def connect(self):
         return self.voice_client.connect()
 
+    async def join(self, *args, **kwargs):
+        """Sets up the voice client and connects it, all in the one call HQ has to wait on."""
+        self.__init_voice_client__(*args, **kwargs)
+        await self.connect()
+
     async def disconnect(self, silent=False):
-        await self.voice_client.disconnect(silent=silent)
+        self._reset_playback()
+        # HQ cleans up after a join that failed, which may not have got as far as setting up the voice client.
+        if self.voice_client:
+            await self.voice_client.disconnect(silent=silent)
+
         self.voice_client = None
-        self.current_player = None
         self.client.remove_remote_voice_client_wrapper(self.remote_ref)
 
-    async def play(self, volume, download_url, progress=0):
-        if self.current_player:
-            self.current_player.stop()
+    @property
+    def is_active(self):
+        return self.current_player is not None
 
-        self._playback_ref_seq += 1
-        playback_ref = '%s.%s' % (self.remote_ref, self._playback_ref_seq)
-        before_options = None
-        if progress:
-            before_options = '-ss %s' % format_seconds_to_hhmmss(progress)
-
-        self.current_player = player = self.voice_client.create_ffmpeg_player(
-            download_url,
-            before_options=before_options,
-            after=lambda: self.emit('playback:done', playback_ref=playback_ref)
+    @property
+    def position(self):
+        if self._released_position is not None:
+            return self._released_position
+
+        if not self.current_player:
+            return None
+
+        return self._playback_offset + self.current_player.buff.frames_read * self.current_player.delay
+
+    def _start_player(self, download_url, progress, playback_ref):
+        source_key = self._source_key
+        entry = self.client.track_cache.get(source_key) if source_key else None
+        self.gain = entry.gain if entry else 1.0
+
+        # Measure the track the first time we play it from the start, so later plays can be normalized. Live
+        # streams never end, so there's nothing to measure.
+        meter = None
+        if source_key and not progress and not self._is_live and (entry is None or entry.loudness is None):
+            meter = LoudnessMeter()
+
+        passthrough = self._can_pass_through(meter)
+
+        def after():
+            # Called on the frame scheduler's thread. Only a track that played to the end has been measured, one that
+            # was stopped or released part way through would leave a partial reading behind for good.
+            if meter and not player.stopped:
+                self.client.loop.call_soon_threadsafe(self.client.store_loudness, source_key, meter)
+
+            self.client.loop.call_soon_threadsafe(self._player_finished, player, playback_ref)
+
+        # The track's gain stays as it is, for when a passed through one has to be transcoded after all.
+        player = self.client.ffmpeg_pool.create_player(
+            self.voice_client, download_url, progress, after=after, passthrough=passthrough, live=self._is_live,
+            gain=self.gain
         )
-        self.current_player.volume = volume
+        player.buff.meter = meter
+        player.set_volume(self.volume)
         player.start()
-        return playback_ref
 
-    async def set_volume(self, new_volume):
-        if self.current_player:
-            self.current_player.volume = new_volume
+        self.current_player = player
+        self._playback_ref = playback_ref
+        self._playback_url = download_url
+        self._playback_offset = progress or 0
+
+    def _can_pass_through(self, meter):
+        """
+        Whether an Opus source can skip decoding, and have its packets sent as they are. A track is always decoded
+        the first time it plays from the start, to measure its loudness. After that, it's passed through as long
+        as the volume is at 100% and its normalization gain is within `passthrough_gain_tolerance` dB of unity,
+        which is then skipped. Louder or quieter tracks are always decoded, to be normalized.
+        """
+        return (
+            self.client.opus_passthrough and self._codec == 'opus' and meter is None and self.volume == 1.0 and
+            not self._is_live and abs(20 * math.log10(self.gain)) <= self.passthrough_gain_tolerance
+        )
 
-    def emit(self, event, *args, **kwargs):
-        self.client.cast('remote_emit', self.remote_ref, event, *args, **kwargs)
+    def _player_finished(self, player, playback_ref):
+        if player.released:
+            return
+
+        # The source wasn't what it said it was, so play it again from the same spot, transcoding this time.
+        if player.passthrough and player.unsupported and player is self.current_player:
+            print("opus passthrough failed, transcoding instead:", player.unsupported)
+            self._codec = None
+            self._restart_player()
+            return
+
+        # The decoder gave up before producing anything, which is almost always a signed url that has expired.
+        # HQ finds out straight away, and can get a new one and try again from the same spot.
+        if not player.stopped and not player.buff.frames_read:
+            if player is self.current_player:
+                self.current_player = None
+
+            self.emit('playback:error', playback_ref=playback_ref, position=self._playback_offset, reason='no audio')
+            return
+
+        # The track ran out by itself and HQ already told us what comes next, so carry straight on.
+        if not player.stopped and player is self.current_player and self._preloaded:
+            self._handoff(playback_ref)
+            return
+
+        if player is self.current_player:
+            self.current_player = None
+
+        self.emit('playback:done', playback_ref=playback_ref, finished=not player.stopped)
+
+    def _handoff(self, previous_ref):
+        download_url, source_key, codec, is_live = self._preloaded
+        self._preloaded = None
+        self._source_key = source_key
+        self._codec = codec
+        self._is_live = is_live
+        playback_ref = self._next_playback_ref()
+        self._start_player(download_url, 0, playback_ref)
+        self.emit(
+            'playback:advanced', previous_ref=previous_ref, playback_ref=playback_ref, download_url=download_url
+        )
+
+    def _next_playback_ref(self):
+        self._playback_ref_seq += 1
+        return '%s.%s' % (self.remote_ref, self._playback_ref_seq)
+
+    @staticmethod
+    def _stop_player(player, release=False):
+        player.stop(release=release)
+        # A paused player's thread is blocked waiting to be resumed, so it has to be woken up to see the stop.
+        player.resume()
+
+    def _restart_player(self):
+        """Starts the current track over from the same position, picking passthrough or transcoding afresh."""
+        player = self.current_player
+        position = self.position
+        self.current_player = None
+        self._stop_player(player, release=True)
+        self._start_player(self._playback_url, position, self._playback_ref)
+
+    def _cancel_release(self):
+        if self._release_handle:
+            self._release_handle.cancel()
+            self._release_handle = None
+
+    def _release(self):
+        self._release_handle = None
+        player = self.current_player
+        if not player:
+            return
+
+        self._released_position = self.position
+        self.current_player = None
+        self._stop_player(player, release=True)
+
+    def _reset_playback(self):
+        """Stops whatever is playing or released, returning whether there was anything to stop."""
+        self._cancel_release()
+        if self._released_position is not None:
+            self._released_position = None
+            self.emit('playback:done', playback_ref=self._playback_ref)
+            return True
 
-    async def stop(self):
         if self.current_player:
-            self.current_player.stop()
+            self._stop_player(self.current_player)
             self.current_player = None
             return True
 
         return False
 
+    async def play(self, volume, download_url, progress=0, source_key=None, started_at=None, codec=None,
+                   is_live=False):
+        # HQ gives us the start time, already on our clock, when we are taking over from another client.
+        if started_at is not None:
+            progress = max(0, time.time() - started_at)
+
+        self._reset_playback()
+        self._set_suspended(False)
+        self.volume = volume
+        self._source_key = source_key
+        self._codec = codec
+        self._is_live = is_live
+        playback_ref = self._next_playback_ref()
+        self._start_player(download_url, progress, playback_ref)
+        return playback_ref
+
+    async def preload(self, download_url=None, source_key=None, codec=None, is_live=False):
+        """Remembers what to play once the current track ends, or forgets it when there's no url."""
+        self._preloaded = (download_url, source_key, codec, is_live) if download_url else None
+        return True
+
+    async def set_volume(self, new_volume):
+        self.volume = new_volume
+        player = self.current_player
+        if not player:
+            return
+
+        if player.passthrough and new_volume != 1.0:
+            # Passed through packets can't be scaled, so the track has to be transcoded from here on. A paused
+            # one is released, and picks that up when it's resumed.
+            if player.is_playing():
+                self._restart_player()
+            else:
+                self._cancel_release()
+                self._release()
+            return
+
+        player.set_volume(new_volume)
+
+    def emit(self, event, *args, **kwargs):
+        self.client.cast('remote_emit', self.remote_ref, event, *args, **kwargs)
+
+    def get_live_stats(self):
+        """How the live stream's jitter buffer is doing, if we're playing one."""
+        if self._is_live and self.current_player:
+            return self.current_player.buff.stream.get_stats()
+
+        return None
+
+    def emit_progress(self, now):
+        if self.current_player and self.current_player.is_playing():
+            self.emit('playback:progress', playback_ref=self._playback_ref, playback_progress=self.position, timestamp=now)
+
+    async def stop(self):
+        self._set_suspended(False)
+        self._preloaded = None
+        return self._reset_playback()
+
     async def pause(self):
         if self.current_player:
             self.current_player.pause()
+            self._cancel_release()
+            self._release_handle = self.client.loop.call_later(self.release_paused_after, self._release)
             return True
 
         return False
 
     async def resume(self):
+        self._cancel_release()
+        if self._released_position is not None:
+            position, self._released_position = self._released_position, None
+            self._start_player(self._playback_url, position, self._playback_ref)
+            return True
+
         if self.current_player:
             self.current_player.resume()
             return True
 
         return False
 
+    async def refresh_url(self, old_url, download_url):
+        """Swaps the download url of the current track for a fresh one, for the next time it has to be started again."""
+        if self._playback_url != old_url:
+            return False
+
+        self._playback_url = download_url
+        return True
+
+    async def suspend(self):
+        """Releases the decoder straight away because nobody is listening, returning the playback position."""
+        self._cancel_release()
+        self._release()
+        self._set_suspended(True)
+        return self.position
+
+    async def unsuspend(self, volume):
+        self._set_suspended(False)
+        await self.set_volume(volume)
+        return await self.resume()
+
+    def _set_suspended(self, suspended):
+        if self.suspended != suspended:
+            self.suspended = suspended
+            self.client.send_client_count_update()
+
 
 class VoiceWorker(rpc.client.Client):
-    def __init__(self, *args, **kwargs):
+    stats_interval = 15
+    # Under the bot's own timeout for a batch, so a stuck call is reported as such rather than failing the lot.
+    batched_call_timeout = 8
+    progress_interval = 10
+
+    def __init__(self, *args, max_clients=15, opus_passthrough=True, **kwargs):
         super(VoiceWorker, self).__init__(*args, **kwargs)
         self.client_connection_id = None
-        self._voice_client_ref_seq = 0
+        self.capacity = CapacityEstimator(self.loop, max_clients)
+        self.frame_scheduler = FrameScheduler(on_lag=self.capacity.record_frame_lateness)
+        self.ffmpeg_pool = FFmpegProcessPool(self.loop, self.frame_scheduler)
+        self.track_cache = TrackCache()
+        self.opus_passthrough = opus_passthrough
+        self.region_latency = RegionLatencyTracker(self.loop)
+        self._stats_loop_task = None
+        self._progress_loop_task = None
+        self._capacity_loop_task = None
+        self._region_latency_task = None
         self._voice_clients = {}
-        self._max_clients = 15
+        # Only used by HQ for regions we haven't measured yet.
         self._acceptable_regions = [
             'us-west', 'us-east'
         ]
@@ -121,29 +384,135 @@ class VoiceWorker(rpc.client.Client):
     async def handle_ready(self, info):
         self.client_connection_id = info['connection_id']
         print("Connected to HQ:", info)
+        self.ffmpeg_pool.schedule_refill()
+        self._stats_loop_task = self.loop.create_task(self._stats_loop())
+        self._progress_loop_task = self.loop.create_task(self._progress_loop())
+        self._capacity_loop_task = self.loop.create_task(
+            self.capacity.run(self.get_active_client_count, self._send_capacity_update)
+        )
+        self._region_latency_task = self.loop.create_task(self.region_latency.run(self._send_region_latency_update))
+
+    def _send_capacity_update(self, max_clients):
+        print("Capacity is now", max_clients)
+        self.cast('capacity_update', max_clients)
+
+    def _send_region_latency_update(self, table):
+        self.cast('region_latency_update', table)
+
+    async def _progress_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                now = time.time()
+                for voice_client in self._voice_clients.values():
+                    voice_client.emit_progress(now)
+
+        except asyncio.CancelledError:
+            pass
+
+    async def _stats_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(self.stats_interval)
+                self.ffmpeg_pool.schedule_refill()
+                self.cast('stats_update', self.get_stats())
+
+        except asyncio.CancelledError:
+            pass
+
+    def store_loudness(self, source_key, meter):
+        # A few seconds of audio isn't representative of the whole track.
+        if meter.measured_seconds < 30:
+            return
+
+        loudness = meter.integrated()
+        if loudness is not None:
+            self.track_cache.get(source_key, create=True).loudness = loudness
+
+    def get_active_client_count(self):
+        return sum(1 for voice_client in self._voice_clients.values() if voice_client.is_active)
+
+    def get_live_stats(self):
+        stats = {}
+        for remote_ref, voice_client in self._voice_clients.items():
+            live_stats = voice_client.get_live_stats()
+            if live_stats:
+                stats[remote_ref] = live_stats
+
+        return stats
+
+    def get_stats(self):
+        return {
+            'ffmpeg_pool': self.ffmpeg_pool.get_stats(),
+            'capacity': self.capacity.get_stats(),
+            'region_latency': self.region_latency.get_stats(),
+            'live_streams': self.get_live_stats(),
+            'frame_scheduler': self.frame_scheduler.get_stats(),
+            'track_cache': {'entries': len(self.track_cache)}
+        }
 
     def get_remote_voice_client_wrapper(self, remote_ref):
         if remote_ref not in self._voice_clients:
             self._voice_clients[remote_ref] = RemoteVoiceClientWrapper(self, remote_ref)
-            self.cast('client_count_update', len(self._voice_clients))
+            self.send_client_count_update()
 
         return self._voice_clients[remote_ref]
 
     def remove_remote_voice_client_wrapper(self, remote_ref):
         if remote_ref in self._voice_clients:
             del self._voice_clients[remote_ref]
-            self.cast('client_count_update', len(self._voice_clients))
+            self.send_client_count_update()
 
-    def handle_call_make_voice_client_ref(self):
-        self._voice_client_ref_seq += 1
-        remote_ref = self._voice_client_ref_seq
-        return '%s.%s' % (self.client_connection_id, remote_ref)
+    def send_client_count_update(self):
+        # Suspended clients aren't decoding anything, so they don't count towards our load.
+        client_count = sum(1 for voice_client in self._voice_clients.values() if not voice_client.suspended)
+        self.cast('client_count_update', client_count)
 
     def handle_call_remote_voice_client__call(self, func, remote_ref, *args, **kwargs):
         print("handle call remote", func, remote_ref, args, kwargs)
         return getattr(self.get_remote_voice_client_wrapper(remote_ref), func)(*args, **kwargs)
 
+    async def handle_call_remote_voice_client__batch(self, calls):
+        # A later call for the same client may depend on an earlier one, so those run in order. Different clients'
+        # calls run side by side, and each gets its own timeout, so one that's stuck holds up nobody else.
+        results = [None] * len(calls)
+        calls_by_ref = collections.OrderedDict()
+        for index, (func, remote_ref, args, kwargs) in enumerate(calls):
+            calls_by_ref.setdefault(remote_ref, []).append((index, func, args, kwargs))
+
+        async def run_calls(remote_ref, ref_calls):
+            for index, func, args, kwargs in ref_calls:
+                try:
+                    result = self.handle_call_remote_voice_client__call(func, remote_ref, *args, **kwargs)
+                    if inspect.isawaitable(result):
+                        result = await asyncio.wait_for(result, self.batched_call_timeout, loop=self.loop)
+
+                    results[index] = {'result': result}
+
+                except Exception as e:
+                    traceback.print_exc()
+                    results[index] = {'exception': str(e) or e.__class__.__name__}
+
+        await asyncio.gather(*(run_calls(*item) for item in calls_by_ref.items()), loop=self.loop)
+        return results
+
     def handle_close(self, reason=None):
+        if self._stats_loop_task:
+            self._stats_loop_task.cancel()
+            self._stats_loop_task = None
+
+        if self._capacity_loop_task:
+            self._capacity_loop_task.cancel()
+            self._capacity_loop_task = None
+
+        if self._progress_loop_task:
+            self._progress_loop_task.cancel()
+            self._progress_loop_task = None
+
+        if self._region_latency_task:
+            self._region_latency_task.cancel()
+            self._region_latency_task = None
+
         for voice_client in self._voice_clients.values():
             self.loop.create_task(voice_client.disconnect(silent=True))
 
@@ -151,7 +520,8 @@ class VoiceWorker(rpc.client.Client):
 
     def get_client_info(self):
         return {
-            "max_clients": self._max_clients,
-            "acceptable_regions": self._acceptable_regions
+            "max_clients": self.capacity.capacity,
+            "acceptable_regions": self._acceptable_regions,
+            "region_latency": self.region_latency.table()
         }
 